@@ -19,6 +19,8 @@ ClientStorage -- the main class, implementing the Storage API
 
 """
 import BTrees.IOBTree
+import collections
+import copy
 import gc
 import logging
 import os
@@ -39,7 +41,6 @@ import ZODB.BaseStorage
 import ZODB.interfaces
 import ZODB.event
 import zope.interface
-import six
 from persistent.TimeStamp import TimeStamp
 from ZEO._compat import Pickler, Unpickler, get_ident, PY3
 from ZEO.auth import get_module
@@ -96,6 +97,32 @@ disconnected_stub = DisconnectedServerStub()
 
 MB = 1024**2
 
+class _Load(object):
+    """A server load that concurrent loadBefore calls share.
+    """
+
+    valid = True  # Cleared, under _lock, if the object is invalidated
+    result = error = None
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wait(self):
+        """Wait for the thread making the load and return its result.
+
+        If the load failed, each waiting thread raises its own copy of
+        the error, so they don't all add to one exception's traceback.
+        """
+        self.event.wait()
+        error = self.error
+        if error is not None:
+            try:
+                error = copy.copy(error)
+            except Exception:
+                pass
+            raise error
+        return self.result
+
 class ClientStorage(object):
     """A storage class that is a network client to a remote storage.
 
@@ -117,6 +144,10 @@ class ClientStorage(object):
     ConnectionManagerClass = ConnectionManager
     StorageServerStubClass = ServerStub.stub
 
+    # The number of cached objects sent to the server in each
+    # verifyMany request during full cache verification.
+    _verify_batch_size = 10000
+
     def __init__(self, addr, storage='1', cache_size=20 * MB,
                  name='', client=None, var=None,
                  min_disconnect_poll=1, max_disconnect_poll=30,
@@ -128,6 +159,9 @@ class ClientStorage(object):
                  blob_dir=None, shared_blob_dir=False,
                  blob_cache_size=None, blob_cache_size_check=10,
                  client_label=None,
+                 cache_profile_size=0, cache_warm_batch_size=100,
+                 cache_background_scan=False, cache_write_behind_size=0,
+                 cache_memory_size=0, cache_noncurrent_fraction=None,
                  ):
         """ClientStorage constructor.
 
@@ -242,6 +276,37 @@ class ClientStorage(object):
         client_label
             A label to include in server log messages for the client.
 
+        cache_profile_size
+            If not 0, and the cache is persistent, the oids of up to
+            this many of the most often loaded objects are saved when
+            the cache is closed.  When the storage is reopened, the
+            cache is warmed up in a separate thread: the saved objects
+            that are in the cache file are read, and the others are
+            loaded from the server once a connection is made.
+
+        cache_warm_batch_size
+            The number of objects the warm-up thread loads from the
+            server in each request.  Defaults to 100.
+
+        cache_background_scan
+            If true, and a persistent cache file has to be scanned to
+            build the cache index, it's scanned in a separate thread,
+            so the storage doesn't wait for it to open.
+
+        cache_write_behind_size
+            If not 0, objects stored in the cache are queued, up to
+            this many bytes of data, and written to the cache file in
+            batches by a separate thread.
+
+        cache_memory_size
+            If not 0, up to this many bytes of recently loaded objects
+            are kept in memory, in front of the cache file.
+
+        cache_noncurrent_fraction
+            If not None, non-current object revisions are kept in a
+            separate cache of this fraction of cache_size.  If 0,
+            non-current revisions aren't cached.
+
         Note that the authentication protocol is defined by the server
         and is detected by the ClientStorage upon connecting (see
         testConnection() and doAuth() for details).
@@ -364,14 +429,24 @@ class ClientStorage(object):
         self._oid_lock = threading.Lock()
         self._oids = [] # Object ids retrieved from new_oids()
 
-        # load() and tpc_finish() must be serialized to guarantee
-        # that cache modifications from each occur atomically.
-        # It also prevents multiple load calls occuring simultaneously,
-        # which simplifies the cache logic.
-        self._load_lock = threading.Lock()
-        # _load_oid and _load_status are protected by _lock
-        self._load_oid = None
-        self._load_status = None
+        # Server loads in progress, {oid -> {tid -> _Load}}, so that
+        # concurrent loads of the same data share a server request,
+        # and so that loads of objects invalidated while the request
+        # is in progress don't store stale data in the cache.
+        # Protected by _lock.
+        self._loads = {}
+
+        # (oid, tid) pairs queued by prefetch() for the prefetch thread
+        # to load.  Protected by _prefetch_condition.
+        self._prefetch_queue = []
+        self._prefetch_condition = threading.Condition(threading.Lock())
+        self._prefetch_closing = False
+
+        # Objects put in the cache by prefetch() that haven't been
+        # loaded since, in the order they were prefetched, for the
+        # prefetch statistics.  Protected by _lock.
+        self._prefetched = collections.OrderedDict()
+        self._n_prefetches = self._n_prefetch_hits = 0
 
         # Can't read data in one thread while writing data
         # (tpc_finish) in another thread.  In general, the lock
@@ -405,7 +480,22 @@ class ClientStorage(object):
         else:
             cache_path = None
 
-        self._cache = self.ClientCacheClass(cache_path, size=cache_size)
+        # Only options that are set are passed, so that a
+        # ClientCacheClass needn't support them all.
+        cache_options = {}
+        if cache_profile_size:
+            cache_options['profile_size'] = cache_profile_size
+        if cache_background_scan:
+            cache_options['background_scan'] = cache_background_scan
+        if cache_write_behind_size:
+            cache_options['write_behind_size'] = cache_write_behind_size
+        if cache_memory_size:
+            cache_options['memory_size'] = cache_memory_size
+        if cache_noncurrent_fraction is not None:
+            cache_options['noncurrent_fraction'] = cache_noncurrent_fraction
+        self._cache = self.ClientCacheClass(
+            cache_path, size=cache_size, **cache_options)
+        self._cache_warm_batch_size = cache_warm_batch_size
 
 
         self._blob_cache_size = blob_cache_size
@@ -420,6 +510,10 @@ class ClientStorage(object):
                                                     tmin=min_disconnect_poll,
                                                     tmax=max_disconnect_poll)
 
+        # The warming thread stops once _rpc_mgr is cleared by close(),
+        # so it's started only after the connection manager exists.
+        self._start_warm_cache()
+
         if wait:
             self._wait(wait_timeout)
         else:
@@ -469,6 +563,13 @@ class ClientStorage(object):
         self._connection = None
 
         _rpc_mgr.close()
+        if self._warm_cache_thread is not None:
+            self._warm_cache_thread.join()
+        if self._prefetch_thread is not None:
+            with self._prefetch_condition:
+                self._prefetch_closing = True
+                self._prefetch_condition.notify()
+            self._prefetch_thread.join()
         self._tbuf.close()
         if self._cache is not None:
             self._cache.close()
@@ -502,6 +603,51 @@ class ClientStorage(object):
         check_blob_size_thread.start()
         self._check_blob_size_thread = check_blob_size_thread
 
+    _warm_cache_thread = None
+    def _start_warm_cache(self):
+        profile = getattr(self._cache, 'profile', None)
+        if not profile:
+            return
+        warm_cache_thread = threading.Thread(
+            target=self._warm_cache, args=(profile,),
+            name="%s zeo client warm cache thread" % self.__name__,
+            )
+        warm_cache_thread.setDaemon(True)
+        warm_cache_thread.start()
+        self._warm_cache_thread = warm_cache_thread
+
+    def _warm_cache(self, oids):
+        # Read the cached objects in the cache's profile and load the
+        # others from the server, a batch at a time, waiting for a
+        # connection before each batch.  Stop when the storage is closed.
+        logger.info("%s Warming up the cache with %d objects",
+                    self.__name__, len(oids))
+        oids = self._cache.warm(oids)
+        batch_size = self._cache_warm_batch_size
+        i = 0
+        while i < len(oids):
+            while not self._ready.wait(1):
+                if self._rpc_mgr is None:
+                    return
+            if self._rpc_mgr is None:
+                return
+            batch = oids[i:i+batch_size]
+            try:
+                # Objects deleted since the profile was saved get
+                # POSKeyErrors, which are ignored.
+                self.loadBeforeMany([(oid, m64) for oid in batch])
+            except ClientDisconnected:
+                if self._rpc_mgr is None:
+                    return
+                continue # Go on once we're reconnected.
+            except Exception:
+                if self._rpc_mgr is not None:
+                    logger.exception("%s Couldn't warm up the cache",
+                                     self.__name__)
+                return
+            i += len(batch)
+        logger.info("%s Finished warming up the cache", self.__name__)
+
     def registerDB(self, db):
         """Storage API: register a database for invalidation messages.
 
@@ -833,26 +979,223 @@ class ClientStorage(object):
         with self._lock:    # for atomic processing of invalidations
             result = self._cache.loadBefore(oid, tid)
             if result:
+                if self._prefetched:
+                    self._prefetch_hit(oid)
                 return result
 
-        if self._server is None:
-            raise ClientDisconnected()
+            if self._server is None:
+                raise ClientDisconnected()
 
-        with self._load_lock:
-            with self._lock:
-                self._load_oid = oid
-                self._load_status = 1
+            # Loads of different objects are sent to the server
+            # concurrently, but loads of the same data share a request.
+            loads = self._loads.setdefault(oid, {})
+            load = loads.get(tid)
+            leader = load is None
+            if leader:
+                load = loads[tid] = _Load()
 
-            result = self._server.loadBefore(oid, tid)
+        if not leader:
+            return load.wait()
 
-            with self._lock:    # for atomic processing of invalidations
-                if result and self._load_status:
-                    data, tid, end = result
-                    self._cache.store(oid, tid, end, data)
-                self._load_oid = None
+        try:
+            result = self._server.loadBefore(oid, tid)
+        except:
+            load.error = sys.exc_info()[1]
+            with self._lock:
+                self._end_load(oid, tid)
+            load.event.set()
+            raise
 
+        with self._lock:    # for atomic processing of invalidations
+            if result and load.valid:
+                data, start, end = result
+                self._cache.store(oid, start, end, data)
+            self._end_load(oid, tid)
+        load.result = result
+        load.event.set()
         return result
 
+    def loadBeforeMany(self, oid_tids):
+        """Load the object data written before many transaction ids
+
+        `oid_tids` is a sequence of (oid, tid) pairs.  A list is
+        returned with, for each pair, what loadBefore would return,
+        or the exception, such as POSKeyError, it would raise.  Data
+        that aren't in the cache are loaded from the server in one
+        round trip.
+        """
+        return self._load_many(oid_tids, False)
+
+    def _load_many(self, oid_tids, prefetch):
+        results = [None] * len(oid_tids)
+        misses = []
+        leading = []    # (i, oid, tid, load), for loads we make
+        following = []  # (i, load), for loads other threads make
+        with self._lock:    # for atomic processing of invalidations
+            for i, (oid, tid) in enumerate(oid_tids):
+                result = self._cache.loadBefore(oid, tid)
+                if result:
+                    results[i] = result
+                    if self._prefetched and not prefetch:
+                        self._prefetch_hit(oid)
+                else:
+                    misses.append(i)
+            if not misses:
+                return results
+
+            if self._server is None:
+                raise ClientDisconnected()
+
+            for i in misses:
+                oid, tid = oid_tids[i]
+                loads = self._loads.setdefault(oid, {})
+                load = loads.get(tid)
+                if load is None:
+                    load = loads[tid] = _Load()
+                    leading.append((i, oid, tid, load))
+                else:
+                    following.append((i, load))
+
+        if leading:
+            try:
+                loaded = self._server.loadBeforeMany(
+                    [(oid, tid) for (i, oid, tid, load) in leading])
+            except:
+                loaded = [sys.exc_info()[1]] * len(leading)
+                raise
+            finally:
+                self._end_loads(leading, loaded, results, prefetch)
+
+        for i, load in following:
+            try:
+                results[i] = load.wait()
+            except Exception:
+                results[i] = sys.exc_info()[1]
+        return results
+
+    def _end_loads(self, leading, loaded, results, prefetch):
+        stores = []
+        try:
+            with self._lock:
+                for (i, oid, tid, load), result in zip(leading, loaded):
+                    if isinstance(result, Exception):
+                        load.error = result
+                    else:
+                        load.result = result
+                        if result and load.valid:
+                            data, start, end = result
+                            stores.append((oid, start, end, data))
+                    results[i] = result
+                    self._end_load(oid, tid)
+                if stores:
+                    self._cache.store_many(stores)
+                    if prefetch:
+                        self._add_prefetched(stores)
+        finally:
+            for i, oid, tid, load in leading:
+                load.event.set()
+
+    def _add_prefetched(self, stores):
+        # Must be called with _lock already acquired.  Remember the
+        # objects a prefetch cached, but no more than the cache holds.
+        prefetched = self._prefetched
+        for oid, start, end, data in stores:
+            prefetched[oid] = None
+        self._n_prefetches += len(stores)
+        limit = len(self._cache)
+        while len(prefetched) > limit:
+            prefetched.popitem(False)
+
+    def _prefetch_hit(self, oid):
+        # Must be called with _lock already acquired.
+        if oid in self._prefetched:
+            del self._prefetched[oid]
+            self._n_prefetch_hits += 1
+
+    def _end_load(self, oid, tid):
+        # Must be called with _lock already acquired.
+        loads = self._loads[oid]
+        del loads[tid]
+        if not loads:
+            del self._loads[oid]
+
+    def _invalidate_loads(self, oids):
+        # Must be called with _lock already acquired.  Data loaded by
+        # server requests in progress for the oids may be stale, so it
+        # isn't cached.  Prefetched data for the oids isn't current
+        # any more, so later loads of them aren't prefetch hits.
+        loads = self._loads
+        if loads:
+            for oid in oids:
+                for load in loads.get(oid, {}).values():
+                    load.valid = False
+        prefetched = self._prefetched
+        if prefetched:
+            for oid in oids:
+                prefetched.pop(oid, None)
+
+    _prefetch_thread = None
+    def prefetch(self, oids, tid=None):
+        """Load objects into the cache in the background
+
+        The data of the objects with the given oids written before
+        `tid`, or their current data if `tid` is None, are loaded from
+        the server by a separate thread, so that later loads are cache
+        hits.  The call doesn't wait for the data.  Data invalidated
+        while they're being loaded aren't cached, and objects aren't
+        prefetched while the storage is disconnected.
+        """
+        if tid is None:
+            tid = m64
+        oid_tids = [(oid, tid) for oid in oids]
+        if not oid_tids or self._rpc_mgr is None:
+            return
+        with self._prefetch_condition:
+            if self._prefetch_thread is None:
+                prefetch_thread = threading.Thread(
+                    target=self._prefetch,
+                    name="%s zeo client prefetch thread" % self.__name__,
+                    )
+                prefetch_thread.setDaemon(True)
+                prefetch_thread.start()
+                self._prefetch_thread = prefetch_thread
+            self._prefetch_queue.extend(oid_tids)
+            self._prefetch_condition.notify()
+
+    def _prefetch(self):
+        # Load the objects queued by prefetch(), everything queued
+        # since the last request in one request, until the storage is
+        # closed.
+        condition = self._prefetch_condition
+        while True:
+            with condition:
+                while not (self._prefetch_queue or self._prefetch_closing):
+                    condition.wait()
+                if self._prefetch_closing:
+                    return
+                oid_tids = self._prefetch_queue
+                self._prefetch_queue = []
+            try:
+                # Errors for single objects, such as POSKeyErrors for
+                # deleted objects, are returned and ignored.
+                self._load_many(oid_tids, True)
+            except ClientDisconnected:
+                logger.debug("%s Dropped a prefetch of %d objects while "
+                             "disconnected", self.__name__, len(oid_tids))
+            except Exception:
+                if self._rpc_mgr is not None:
+                    logger.exception("%s Couldn't prefetch objects",
+                                     self.__name__)
+
+    def getPrefetchStats(self):
+        """Return prefetch statistics
+
+        A tuple is returned with the number of objects prefetch()
+        has loaded into the cache and the number of those that were
+        then loaded from the cache (prefetch hits).
+        """
+        return self._n_prefetches, self._n_prefetch_hits
+
     def new_oid(self):
         """Storage API: return a new object identifier."""
         if self._is_read_only:
@@ -1122,6 +1465,21 @@ class ClientStorage(object):
         with self._lock:
             return self._cache.getLastTid()
 
+    def resizeCache(self, size):
+        """Change the size of the client cache, keeping its contents.
+
+        Objects are evicted, least recently written first, if the cache
+        shrinks.  Unsupported is raised if the cache can't be resized.
+        """
+        with self._lock:
+            if self._cache is None:
+                raise ClientStorageError("The storage is closed")
+            resize = getattr(self._cache, 'resize', None)
+            if resize is None:
+                raise POSException.Unsupported(
+                    "A %s can't be resized" % self._cache.__class__.__name__)
+            resize(size)
+
     def tpc_abort(self, txn):
         """Storage API: abort a transaction."""
         if txn is not self._transaction:
@@ -1148,7 +1506,6 @@ class ClientStorage(object):
         if txn is not self._transaction:
             raise POSException.StorageTransactionError(
                 "tpc_finish called with wrong transaction")
-        self._load_lock.acquire()
         try:
             if self._midtxn_disconnect:
                 raise ClientDisconnected(
@@ -1177,7 +1534,6 @@ class ClientStorage(object):
 
             self.end_transaction()
         finally:
-            self._load_lock.release()
             self._iterator_gc()
 
     def _update_cache(self, tid):
@@ -1193,19 +1549,27 @@ class ClientStorage(object):
         if self._cache is None:
             return
 
-        for oid, _ in six.iteritems(self._seriald):
-            self._cache.invalidate(oid, tid)
+        self._invalidate_loads(self._seriald)
+        self._cache.invalidate_many(list(self._seriald), tid)
 
+        # Stores are batched, so the cache can write them together.
+        stores = []
         for oid, data in self._tbuf:
+            self._invalidate_loads((oid,))
             # If data is None, we just invalidate.
             if data is not None:
                 s = self._seriald[oid]
                 if s != ResolvedSerial:
                     assert s == tid, (s, tid)
-                    self._cache.store(oid, s, None, data)
+                    stores.append((oid, s, None, data))
             else:
                 # object deletion
+                if stores:
+                    self._cache.store_many(stores)
+                    stores = []
                 self._cache.invalidate(oid, tid)
+        if stores:
+            self._cache.store_many(stores)
 
         if self.fshelper is not None:
             blobs = self._tbuf.blobs
@@ -1386,8 +1750,14 @@ class ClientStorage(object):
             return "cache dropped"
 
         logger.info("%s Verifying cache", self.__name__)
+        batch = []
         for oid, tid in self._cache.contents():
-            server.verify(oid, tid)
+            batch.append(oid + tid)
+            if len(batch) >= self._verify_batch_size:
+                self._verify_many(server, batch)
+                batch = []
+        if batch:
+            self._verify_many(server, batch)
         server.endZeoVerify()
 
         with self._lock:
@@ -1400,6 +1770,18 @@ class ClientStorage(object):
 
         return "full verification"
 
+    def _verify_many(self, server, batch):
+        # Send a batch of packed oids and tids to the server and queue
+        # invalidations, as invalidateVerify does, for the stale oids
+        # it returns.
+        stale = server.verifyMany(b''.join(batch))
+        if stale:
+            oids = [stale[i:i+8] for i in range(0, len(stale), 8)]
+            logger.debug("%s Verification found %d stale objects",
+                         self.__name__, len(oids))
+            with self._lock:
+                self._pickler.dump((None, oids))
+
     def invalidateVerify(self, oid):
         """Server callback to invalidate an oid pair.
 
@@ -1471,9 +1853,8 @@ class ClientStorage(object):
             self._lock.release()
 
     def _process_invalidations(self, tid, oids):
+        self._invalidate_loads(oids)
         for oid in oids:
-            if oid == self._load_oid:
-                self._load_status = 0
             self._cache.invalidate(oid, tid)
 
         if self._db is not None:
@@ -14,6 +14,7 @@
 """RPC stubs for interface exported by StorageServer."""
 
 import time
+from ZEO.Exceptions import ClientDisconnected
 from ZODB.utils import z64
 
 ##
@@ -123,6 +124,17 @@ class StorageServer:
     def verify(self, oid, serial):
         self.rpc.callAsync('verify', oid, serial)
 
+    ##
+    # Check whether the current serial numbers of many objects are valid.
+    # @param oid_tids a string of 16-byte records, each an object id
+    #        followed by the client's current serial number for it
+    # @defreturn string
+    # @return the 8-byte ids of the objects whose serial numbers aren't
+    #         current
+
+    def verifyMany(self, oid_tids):
+        return self.rpc.call('verifyMany', oid_tids)
+
     ##
     # Signal to the server that cache verification is done.
     # @defreturn async
@@ -188,6 +200,17 @@ class StorageServer:
     def loadBefore(self, oid, tid):
         return self.rpc.call("loadBefore", oid, tid)
 
+    ##
+    # Load many objects in one round trip.
+    # @param oid_tids a sequence of (oid, tid) pairs, as passed to
+    #        loadBefore
+    # @defreturn list
+    # @return the loadBefore result, or the exception raised, for
+    #         each pair
+
+    def loadBeforeMany(self, oid_tids):
+        return self.rpc.call("loadBeforeMany", oid_tids)
+
     ##
     # Storage new revision of oid.
     # @param oid object id
@@ -305,7 +328,30 @@ class StorageServer:
     def set_client_label(self, label):
         return self.rpc.callAsync('set_client_label', label)
 
-class StorageServer308(StorageServer):
+class StorageServer401(StorageServer):
+
+    def verifyMany(self, oid_tids):
+        # Servers older than protocol Z402 get a verify call per object,
+        # and make invalidateVerify calls for the stale ones.
+        for i in range(0, len(oid_tids), 16):
+            self.verify(oid_tids[i:i+8], oid_tids[i+8:i+16])
+        return b''
+
+class StorageServer40(StorageServer401):
+
+    def loadBeforeMany(self, oid_tids):
+        # Servers older than protocol Z401 get a loadBefore call per pair.
+        results = []
+        for oid, tid in oid_tids:
+            try:
+                results.append(self.loadBefore(oid, tid))
+            except ClientDisconnected:
+                raise
+            except Exception as v:
+                results.append(v)
+        return results
+
+class StorageServer308(StorageServer40):
 
     def __init__(self, rpc):
         if rpc.peer_protocol_version == b'Z200':
@@ -313,7 +359,7 @@ class StorageServer308(StorageServer):
             self.getInvalidations = lambda tid: None
             self.getAuthProtocol = lambda: None
 
-        StorageServer.__init__(self, rpc)
+        StorageServer40.__init__(self, rpc)
 
     def history(self, oid, length=None):
         if length is None:
@@ -388,6 +434,10 @@ def stub(client, connection):
 
     if connection.peer_protocol_version < b'Z309':
         return StorageServer308(connection)
+    if connection.peer_protocol_version < b'Z401':
+        return StorageServer40(connection)
+    if connection.peer_protocol_version < b'Z402':
+        return StorageServer401(connection)
     return StorageServer(connection)
 
 
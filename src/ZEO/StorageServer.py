@@ -40,6 +40,7 @@ import six
 
 from ZEO._compat import Pickler, Unpickler, PY3, BytesIO
 from ZEO.Exceptions import AuthError
+from ZEO.invalidationlog import InvalidationLog
 from .monitor import StorageStats, StatsServer
 from .zrpc.connection import ManagedServerConnection, Delay, MTDelay, Result
 from .zrpc.server import Dispatcher
@@ -287,6 +288,18 @@ class ZEOStorage:
         self.stats.loads += 1
         return self.storage.loadBefore(oid, tid)
 
+    def loadBeforeMany(self, oid_tids):
+        # Return a list with the loadBefore result, or the exception
+        # raised, for each (oid, tid) pair.
+        results = []
+        for oid, tid in oid_tids:
+            self.stats.loads += 1
+            try:
+                results.append(self.storage.loadBefore(oid, tid))
+            except Exception as v:
+                results.append(v)
+        return results
+
     def getInvalidations(self, tid):
         invtid, invlist = self.server.get_invalidations(self.storage_id, tid)
         if invtid is None:
@@ -304,6 +317,23 @@ class ZEOStorage:
             if tid != t:
                 self.client.invalidateVerify(oid)
 
+    def verifyMany(self, oid_tids):
+        # oid_tids is a string of 16-byte records, each an oid followed
+        # by the tid of the client's cached data.  Return a string of
+        # the 8-byte oids whose cached data aren't current.
+        getTid = self.getTid
+        stale = []
+        for i in range(0, len(oid_tids), 16):
+            oid = oid_tids[i:i+8]
+            try:
+                tid = getTid(oid)
+            except KeyError:
+                stale.append(oid)
+            else:
+                if tid != oid_tids[i+8:i+16]:
+                    stale.append(oid)
+        return b''.join(stale)
+
     def zeoVerify(self, oid, s):
         if not self.verifying:
             self.verifying = 1
@@ -778,6 +808,81 @@ class StorageServerDB:
 
     transform_record_data = untransform_record_data = lambda self, data: data
 
+class InvalidationQueue:
+    """The invalidations of the last `size` transactions of a storage.
+
+    The (tid, oids) entries are kept, in tid order, in a ring, so adding
+    an entry takes constant time and the entries after a tid are found
+    with a binary search.  Iterating yields the entries, newest first.
+
+    Entries are added by the thread committing a transaction while
+    other threads read them, so access is protected by a lock.
+    """
+
+    def __init__(self, size, entries=()):
+        # The last entry is always kept, so that clients that are up to
+        # date can do quick verification.
+        size = max(size, 1)
+        self.size = size
+        self._ring = [None] * size
+        self._start = 0 # The index of the oldest entry in the ring
+        self._len = 0
+        self._lock = threading.Lock()
+        for tid, oids in entries:
+            self.append(tid, oids)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        with self._lock:
+            entries = [self._entry(i) for i in range(self._len - 1, -1, -1)]
+        return iter(entries)
+
+    def _entry(self, i):
+        # Return the i-th oldest entry.
+        return self._ring[(self._start + i) % self.size]
+
+    @property
+    def first_tid(self):
+        with self._lock:
+            return self._entry(0)[0] if self._len else None
+
+    def append(self, tid, oids):
+        with self._lock:
+            if self._len < self.size:
+                self._ring[(self._start + self._len) % self.size] = (
+                    tid, oids)
+                self._len += 1
+            else:
+                # Replace the oldest entry.
+                self._ring[self._start] = tid, oids
+                self._start = (self._start + 1) % self.size
+
+    def since(self, tid):
+        """Return the last tid and the set of oids invalidated after a tid.
+
+        None is returned if there are invalidations after the tid that
+        aren't in the queue.
+        """
+        with self._lock:
+            n = self._len
+            if not n or self._entry(0)[0] > tid:
+                return None
+            lo, hi = 1, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._entry(mid)[0] <= tid:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            latest_tid = self._entry(n - 1)[0]
+            invalidated = [self._entry(i)[1] for i in range(lo, n)]
+        oids = set()
+        for L in invalidated:
+            oids.update(L)
+        return latest_tid, oids
+
 class StorageServer:
 
     """The server side implementation of ZEO.
@@ -798,6 +903,9 @@ class StorageServer:
                  read_only=0,
                  invalidation_queue_size=100,
                  invalidation_age=None,
+                 invalidation_log_dir=None,
+                 invalidation_log_size=10 << 20,
+                 invalidation_log_age=None,
                  transaction_timeout=None,
                  monitor_address=None,
                  auth_protocol=None,
@@ -843,6 +951,20 @@ class StorageServer:
             invalidations will be computed by iterating over
             transactions later than the given transaction.
 
+        invalidation_log_dir -- If given, the invalidations of each
+            storage are also logged to a file in this directory, named
+            after the storage, with ".invlog" appended.  Clients whose
+            last transaction is older than the invalidation queue
+            covers, even across server restarts, can do quick
+            verification with the invalidations in the log.
+
+        invalidation_log_size -- The number of bytes of invalidations
+            kept in each invalidation log, or None for no size limit.
+            Defaults to 10MB.
+
+        invalidation_log_age -- If given, invalidations older than
+            this many seconds are dropped from the invalidation logs.
+
         transaction_timeout -- The maximum amount of time to wait for
             a transaction to commit after acquiring the storage lock.
             If the transaction takes too long, the client connection
@@ -890,14 +1012,21 @@ class StorageServer:
         self.database = None
         if auth_protocol:
             self._setup_auth(auth_protocol)
-        # A list, by server, of at most invalidation_queue_size invalidations.
-        # The list is kept in sorted order with the most recent
-        # invalidation at the front.  The list never has more than
-        # self.invq_bound elements.
+        # An InvalidationQueue, by storage, of the invalidations of the
+        # last invalidation_queue_size transactions.
         self.invq_bound = invalidation_queue_size
         self.invq = {}
+        # Invalidation logs, by storage, if there's an
+        # invalidation_log_dir.
+        self.invalidation_logs = {}
         for name, storage in storages.items():
             self._setup_invq(name, storage)
+            if invalidation_log_dir:
+                invalidation_log = InvalidationLog(
+                    os.path.join(invalidation_log_dir, '%s.invlog' % name),
+                    invalidation_log_size, invalidation_log_age)
+                invalidation_log.catch_up(storage)
+                self.invalidation_logs[name] = invalidation_log
             storage.registerDB(StorageServerDB(self, name))
         self.invalidation_age = invalidation_age
         self.connections = {}
@@ -939,10 +1068,12 @@ class StorageServer:
             # be good. :) Doing this allows clients that were up to
             # date when a server was restarted to pick up transactions
             # it subsequently missed.
-            self.invq[name] = [(storage.lastTransaction() or z64, None)]
+            self.invq[name] = InvalidationQueue(
+                self.invq_bound, [(storage.lastTransaction() or z64, None)])
         else:
-            self.invq[name] = list(lastInvalidations(self.invq_bound))
-            self.invq[name].reverse()
+            # lastInvalidations returns the oldest invalidations first.
+            self.invq[name] = InvalidationQueue(
+                self.invq_bound, lastInvalidations(self.invq_bound))
 
 
     def _setup_auth(self, protocol):
@@ -1024,8 +1155,7 @@ class StorageServer:
         # worry about interaction with the main thread.
 
         # 1. We modify self.invq which is read by get_invalidations
-        #    below. This is why get_invalidations makes a copy of
-        #    self.invq.
+        #    below.  InvalidationQueue has a lock for this.
 
         # 2. We access connections.  There are two dangers:
         #
@@ -1038,8 +1168,12 @@ class StorageServer:
         #    doesn't matter, bacause we can call should_close on a closed
         #    connection.
 
-        # Rebuild invq
-        self._setup_invq(storage_id, self.storages[storage_id])
+        # Rebuild invq, and start the invalidation log over
+        storage = self.storages[storage_id]
+        self._setup_invq(storage_id, storage)
+        invalidation_log = self.invalidation_logs.get(storage_id)
+        if invalidation_log is not None:
+            invalidation_log.clear(storage.lastTransaction() or z64)
 
         # Make a copy since we are going to be mutating the
         # connections indirectoy by closing them.  We don't care about
@@ -1082,8 +1216,7 @@ class StorageServer:
         # worry about interaction with the main thread.
 
         # 1. We modify self.invq which is read by get_invalidations
-        #    below. This is why get_invalidations makes a copy of
-        #    self.invq.
+        #    below.  InvalidationQueue has a lock for this.
 
         # 2. We access connections.  There are two dangers:
         #
@@ -1100,10 +1233,10 @@ class StorageServer:
 
 
         if invalidated:
-            invq = self.invq[storage_id]
-            if len(invq) >= self.invq_bound:
-                invq.pop()
-            invq.insert(0, (tid, invalidated))
+            self.invq[storage_id].append(tid, invalidated)
+            invalidation_log = self.invalidation_logs.get(storage_id)
+            if invalidation_log is not None:
+                invalidation_log.append(tid, invalidated)
 
         for p in self.connections[storage_id]:
             try:
@@ -1124,19 +1257,22 @@ class StorageServer:
         do full cache verification.
         """
 
-        # We make a copy of invq because it might be modified by a
-        # foreign (other than main thread) calling invalidate above.
-        invq = self.invq[storage_id][:]
+        invq = self.invq[storage_id]
+        queued = invq.since(tid)
+        logged = None
+        invalidation_log = self.invalidation_logs.get(storage_id)
+        if queued is None and invalidation_log is not None:
+            logged = invalidation_log.since(tid)
 
         oids = set()
         latest_tid = None
-        if invq and invq[-1][0] <= tid:
+        if queued is not None:
             # We have needed data in the queue
-            for _tid, L in invq:
-                if _tid <= tid:
-                    break
-                oids.update(L)
-            latest_tid = invq[0][0]
+            latest_tid, oids = queued
+        elif logged is not None:
+            # We have needed data in the invalidation log
+            latest_tid, L = logged
+            oids.update(L)
         elif (self.invalidation_age and
               (self.invalidation_age >
                (time.time()-ZODB.TimeStamp.TimeStamp(tid).timeTime())
@@ -1149,7 +1285,8 @@ class StorageServer:
         elif not invq:
             log("invq empty")
         else:
-            log("tid to old for invq %s < %s" % (u64(tid), u64(invq[-1][0])))
+            log("tid to old for invq %s < %s"
+                % (u64(tid), u64(invq.first_tid)))
 
         return latest_tid, list(oids)
 
@@ -1196,6 +1333,9 @@ class StorageServer:
             logger.info("closing storage %r", name)
             storage.close()
 
+        for invalidation_log in self.invalidation_logs.values():
+            invalidation_log.close()
+
         if self.__thread is not None:
             self.__thread.join(join_timeout)
 
@@ -1464,7 +1604,26 @@ class ClientStub:
         #   to write to the socket.  If self.rpc's network thread also
         #   tries to write at the ame time, we can run into problems
         #   because handle_write isn't thread safe.
-        self.rpc.callAsyncNoSend('invalidateTransaction', tid, args)
+        self.rpc.callAsyncMessageNoSend(
+            self._invalidation_message(tid, args))
+
+    # The last invalidateTransaction message encoded by a stub class, as
+    # (tid, args, message).  StorageServer.invalidate passes the same
+    # args to each client, so the message is encoded once per
+    # transaction rather than once per client.
+    _last_invalidation = None, None, None
+
+    def _invalidation_message(self, tid, args):
+        last_tid, last_args, message = self._last_invalidation
+        if args is not last_args or tid != last_tid:
+            message = self.rpc.encode(
+                0, 1, 'invalidateTransaction',
+                (tid, self._invalidation_args(args)))
+            self.__class__._last_invalidation = tid, args, message
+        return message
+
+    def _invalidation_args(self, args):
+        return args
 
     def serialnos(self, arg):
         self.rpc.callAsyncNoPoll('serialnos', arg)
@@ -1489,9 +1648,11 @@ class ClientStub:
 
 class ClientStub308(ClientStub):
 
-    def invalidateTransaction(self, tid, args):
-        ClientStub.invalidateTransaction(
-            self, tid, [(arg, '') for arg in args])
+    # Not ClientStub's, as the messages differ.
+    _last_invalidation = None, None, None
+
+    def _invalidation_args(self, args):
+        return [(arg, '') for arg in args]
 
     def invalidateVerify(self, oid):
         ClientStub.invalidateVerify(self, (oid, ''))
@@ -22,21 +22,28 @@ it to map this richer API onto the simple key-based API of the lower-level
 FileCache.
 """
 from __future__ import print_function
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 
 import BTrees.LLBTree
 import BTrees.LOBTree
+import bisect
 import logging
+import mmap
 import os
 import tempfile
 import threading
 import time
+import zlib
 
 import ZODB.fsIndex
 import zc.lockfile
 from ZODB.utils import p64, u64, z64
 import six
 from ._compat import PYPY
+from . import cachetrace
+from .cacheindex import ArrayIndex
+from .cacheprofile import AccessCounter, read_profile, write_profile
+from .cachememory import MemoryCache
 
 logger = logging.getLogger("ZEO.cache")
 
@@ -79,10 +86,68 @@ logger = logging.getLogger("ZEO.cache")
 # The file begins with a 12-byte header.  The first four bytes are the
 # file's magic number - ZEC3 - indicating zeo cache version 4.  The
 # next eight bytes are the last transaction id.
+#
+# Version 5 files, with magic number ZEC4, are the same except that
+# they can have compressed records.  A file's magic number is changed
+# to ZEC4 just before the first compressed record is written to it, so
+# that older versions of ZEO, which only read ZEC3 files, won't read
+# compressed records they don't understand.  Files without compressed
+# records stay ZEC3.
 
 magic = b"ZEC3"
+compressed_magic = b"ZEC4"
 ZEC_HEADER_SIZE = 12
 
+# A persistent cache may have an index file, path + '.index', holding a
+# snapshot of the in-memory index so that the cache file needn't be
+# scanned when it's reopened.  The index file starts with a header:
+#
+#     4 byte magic number (ZCI1)
+#     8 byte last transaction id
+#     8 byte cache size, >Q format
+#     8 byte currentofs, >Q format
+#     8 byte modification time of the cache file, >d format
+#     8 byte number of current entries, >Q format
+#     8 byte number of non-current entries, >Q format
+#
+# It is followed by the current entries, as 8-byte oids and >Q offsets,
+# and then by the non-current entries, as >QQQ (oid, start_tid, offset)
+# triples.  The snapshot is only used if the header matches the cache
+# file.  The index file is removed before the first change made to the
+# cache file after the snapshot was written, so a snapshot left behind by
+# a crash is never stale.
+index_magic = b"ZCI1"
+index_header_format = ">4s8sQQdQQ"
+index_header_size = 52
+
+# If journaling is enabled, the index file isn't removed when the cache
+# file changes.  Instead, changes are recorded in a journal file,
+# path + '.journal', so that after a crash, the index can be brought up
+# to date without scanning the whole cache file.  The journal starts
+# with the 4-byte magic number ZCJ1, followed by the header of the index
+# file it applies to.  It's followed by 17-byte entries, >cQII format,
+# each written before the change it describes is made:
+#
+#     b'r', offset, size, data size
+#           The region of the ring of `size` bytes at `offset` is about to
+#           be filled with records holding `data size` bytes, and a free
+#           block.  currentofs is then offset + data size.
+#
+#     b'b', offset, 0, 0
+#           The block at `offset`, outside the ring, is about to be freed
+#           or have its end tid set.
+#
+# Recovery drops the index entries for the blocks in the journaled
+# regions and blocks, and reads those blocks again.  Whenever the index
+# file is written, the journal is started over.
+journal_magic = b"ZCJ1"
+journal_entry_format = ">cQII"
+journal_entry_size = 17
+
+# Checkpoint, writing the index file, when the last tid is set, if the
+# journal has more entries than this, to bound recovery time.
+max_journal_entries = 1 << 20
+
 # Maximum block size. Note that while we are doing a store, we may
 # need to write a free block that is almost twice as big.  If we die
 # in the middle of a store, then we need to split the large free records
@@ -115,12 +180,25 @@ max_block_size = (1<<31) - 1
 #     8 byte oid
 #     8 byte start_tid
 #     8 byte end_tid
-#     2 byte version length must be 0
+#     2 byte flags, >H format (this was the version length, which
+#       was always 0, in version 4 files)
 #     4 byte data size
 #     data
 #     8 byte redundant oid for error detection.
+#
+# The data size is the size of the data as stored, so the record
+# size is allocated_record_overhead plus the data size, whether the
+# data is compressed or not.
 allocated_record_overhead = 43
 
+# Record flags
+record_compressed = 1 # The data is compressed with zlib.
+
+# The format of an allocated block header, up to the start of the data,
+# for decoding with unpack_from.
+allocated_header_format = ">cI8s8s8sHI"
+allocated_header_size = 35
+
 # The cache's currentofs goes around the file, circularly, forever.
 # It's always the starting offset of some block.
 #
@@ -156,12 +234,31 @@ class ClientCache(object):
     # default of 20MB.  The default here is misleading, though, since
     # ClientStorage is the only user of ClientCache, and it always passes an
     # explicit size of its own choosing.
-    def __init__(self, path=None, size=200*1024**2, rearrange=.8):
+    def __init__(self, path=None, size=200*1024**2, rearrange=.8,
+                 index_save_interval=300, use_mmap=False,
+                 concurrent_reads=False, compact_index=False,
+                 admission=None, compress=False, compress_level=1,
+                 compress_min_size=256, memory_size=0,
+                 background_scan=False, write_behind_size=0,
+                 noncurrent_fraction=None, profile_size=0,
+                 journal=False, fallocate=False):
 
         # - `path`:  filepath for the cache file, or None (in which case
         #   a temp file will be created)
         self.path = path
 
+        # - `noncurrent_fraction`: if not None, non-current records
+        #   aren't kept in the cache file, where they compete for space
+        #   with current ones, but in a separate ClientCache of this
+        #   fraction of `size`, with its own file and eviction, or not
+        #   at all if it's 0.  The cache file gets the rest of `size`.
+        #   Current records that are invalidated are moved there.
+        self.noncurrent_fraction = noncurrent_fraction
+        self._noncurrent_cache = None
+        if noncurrent_fraction:
+            noncurrent_size = int(size * noncurrent_fraction)
+            size -= noncurrent_size
+
         # - `maxsize`:  total size of the cache file
         #               We set to the minimum size of less than the minimum.
         size = max(size, ZEC_HEADER_SIZE)
@@ -175,8 +272,45 @@ class ClientCache(object):
         # The number of records in the cache.
         self._len = 0
 
+        # - `compact_index`: if true, use an ArrayIndex for the current
+        #   index.  It needs much less memory than the dict used by
+        #   default on PyPy, but no less than an fsIndex on CPython.
+        if compact_index:
+            self._current_index_type = lambda: ArrayIndex(self.maxsize)
+        else:
+            self._current_index_type = _current_index_type
+
         # {oid -> pos}
-        self.current = _current_index_type()
+        self.current = self._current_index_type()
+
+        # - `admission`: an admission policy (see ZEO.cacheadmission)
+        #   that is told about loads and decides whether objects passed
+        #   to store() are written to the cache, or None to store
+        #   everything that fits.
+        self.admission = admission
+
+        # - `compress`: if true, the data of objects at least
+        #   `compress_min_size` bytes long is compressed with zlib, at
+        #   `compress_level`, when it's written to the cache, if that
+        #   makes it smaller.  Compressed records are flagged, so they're
+        #   decompressed when loaded whether or not `compress` is set
+        #   when the file is reopened.
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+
+        # - `fallocate`: if true, and the platform has it, disk space for
+        #   the cache file is allocated with posix_fallocate when the file
+        #   is created or grown, rather than by writing its last byte.
+        self.fallocate = fallocate
+
+        # - `memory_size`: if not 0, the maximum number of bytes of data
+        #   of current objects, read from the cache file, to keep in
+        #   memory, least recently used first out.
+        if memory_size:
+            self._memory = MemoryCache(memory_size)
+        else:
+            self._memory = None
 
         # {oid -> {tid->pos}}
         # Note that caches in the wild seem to have very little non-current
@@ -193,6 +327,88 @@ class ClientCache(object):
         # currentofs.
         self.currentofs = ZEC_HEADER_SIZE
 
+        # - `index_save_interval`: minimum number of seconds between
+        #   saves of the index file of a persistent cache, made when the
+        #   last tid is updated.  The index is also saved on close.  If
+        #   0 or None, the index is only saved on close.
+        self.index_save_interval = index_save_interval
+        self._index_saved_at = time.time()
+
+        # True if the index file matches the cache file.
+        self._index_saved = False
+
+        # - `journal`: if true, and the cache is persistent, changes made
+        #   to the cache file after the index file is saved are recorded
+        #   in a journal file, rather than removing the index file, so
+        #   that after a crash, the index file can be brought up to date
+        #   from the journal, rather than scanning the cache file.  The
+        #   index file is written after the cache file has to be scanned.
+        self.journal = journal and bool(path)
+        self._journal_file = None
+        self._journal_entries = 0
+
+        # - `use_mmap`: if true, the cache file is memory mapped and
+        #   load() and loadBefore() decode records directly from the map,
+        #   rather than seeking and reading the file.  Writes still go
+        #   through the file object and are flushed, so they're visible
+        #   through the map.
+        self.use_mmap = use_mmap
+        self._map = None
+
+        # - `concurrent_reads`: if true, cache hits are served without
+        #   acquiring the cache lock, using the memory map or positional
+        #   reads (os.pread).  Changes are still serialized by the lock.
+        #   Each change increments _generation before and after it
+        #   touches the index or the file, so a reader that saw an odd
+        #   generation, or a different generation after reading, may have
+        #   seen inconsistent data and retries with the lock held.
+        if concurrent_reads and not hasattr(os, 'pread'):
+            self.use_mmap = use_mmap = True
+        self.concurrent_reads = concurrent_reads
+        self._generation = 0
+
+        # Writes must be flushed if the file is read other than through
+        # self.f.
+        self._flush_writes = use_mmap or concurrent_reads
+
+        # - `background_scan`: if true, and a persistent cache file has
+        #   to be scanned to build the index, the scan is done in a
+        #   separate thread.  Until it's done, loads miss, stores are
+        #   ignored, and invalidations are saved and applied once the
+        #   index is complete.
+        self.background_scan = background_scan
+        self._scanning = False
+        self._scan_thread = None
+
+        # - `write_behind_size`: if not 0, store() doesn't write records
+        #   to the file, but queues them, up to this many bytes of data,
+        #   for a writer thread that writes whatever has accumulated in a
+        #   single batch.  Queued records can be loaded, and are updated
+        #   by invalidations, so they never hold stale data.  If the queue
+        #   is full, it's written by the caller.
+        self.write_behind_size = write_behind_size
+        self._writer_thread = None
+        # {oid -> {start_tid -> [end_tid, data]}}
+        self._queued = {}
+        self._queued_bytes = self._queued_count = 0
+        self._queue_condition = threading.Condition(threading.Lock())
+        self._writer_closing = False
+
+        # - `profile_size`: if not 0, and the cache is persistent, loads
+        #   are counted by oid, and the oids of up to this many of the
+        #   most often loaded objects are saved to a profile file (see
+        #   ZEO.cacheprofile) on close.  `profile` is the list of oids
+        #   saved by the last cache to use the file, which can be passed
+        #   to warm() on startup.
+        self.profile = []
+        self._access_counter = None
+        if profile_size and path:
+            self.profile = read_profile(path + '.profile')
+            self._access_counter = AccessCounter(profile_size)
+            for oid in self.profile:
+                # So that a short run doesn't lose the profile.
+                self._access_counter.record(oid)
+
         # self.f is the open file object.
         # When we're not reusing an existing file, self.f is left None
         # here -- the scan() method must be called then to open the file
@@ -222,6 +438,7 @@ class ClientCache(object):
             self.f.close()
             if not path:
                 raise # unrecoverable temp file error :(
+            self._remove_index()
             badpath = path+'.bad'
             if os.path.exists(badpath):
                 logger.critical(
@@ -236,15 +453,38 @@ class ClientCache(object):
             self.f.write(magic+z64)
             self._initfile(ZEC_HEADER_SIZE)
 
+        if self.journal and not (self._index_saved or self._scanning):
+            self._save_index()
+
+        if use_mmap and not self._scanning:
+            self._setup_map()
+
         # Statistics:  _n_adds, _n_added_bytes,
         #              _n_evicts, _n_evicted_bytes,
-        #              _n_accesses
+        #              _n_accesses,
+        #              _n_rejects, _n_rejected_bytes
         self.clearStats()
 
         self._setup_trace(path)
 
         self._lock = threading.RLock()
 
+        if self._scanning:
+            self._start_scan(fsize)
+
+        if noncurrent_fraction:
+            self._noncurrent_cache = ClientCache(
+                path and path + '.noncurrent', noncurrent_size,
+                index_save_interval=index_save_interval, use_mmap=use_mmap,
+                concurrent_reads=concurrent_reads, compress=compress,
+                compress_level=compress_level,
+                compress_min_size=compress_min_size,
+                background_scan=background_scan, journal=journal,
+                fallocate=fallocate)
+
+        if write_behind_size:
+            self._start_writer()
+
     # Backward compatibility. Client code used to have to use the fc
     # attr to get to the file cache to get cache stats.
     @property
@@ -252,34 +492,96 @@ class ClientCache(object):
         return self
 
     def clear(self):
-        self.f.seek(ZEC_HEADER_SIZE)
-        self.f.truncate()
-        self._initfile(ZEC_HEADER_SIZE)
+        self._wait_for_scan()
+        self._clear()
+        if self._noncurrent_cache is not None:
+            self._noncurrent_cache.clear()
+
+    @locked
+    def _clear(self):
+        with self._queue_condition:
+            self._queued = {}
+            self._queued_bytes = self._queued_count = 0
+        self._drop_journal()
+        self._generation += 1
+        try:
+            if self._memory is not None:
+                self._memory.clear()
+            self._close_map()
+            self.f.seek(ZEC_HEADER_SIZE)
+            self.f.truncate()
+            self._initfile(ZEC_HEADER_SIZE)
+            if self.journal:
+                self._save_index()
+            if self.use_mmap:
+                self._setup_map()
+        finally:
+            self._generation += 1
 
     ##
-    # Scan the current contents of the cache file, calling `install`
-    # for each object found in the cache.  This method should only
-    # be called once to initialize the cache from disk.
+    # Memory map the cache file for reading.  If that fails, for example
+    # because there isn't enough address space for a large cache, the
+    # file is read normally.
+    def _setup_map(self):
+        self.f.flush()
+        try:
+            self._map = mmap.mmap(self.f.fileno(), 0)
+        except (EnvironmentError, ValueError, OverflowError):
+            logger.warning("Couldn't memory map cache file, reading it "
+                           "instead.", exc_info=1)
+            self._map = None
+
+    def _close_map(self):
+        m = self._map
+        if m is not None:
+            self._map = None
+            m.close()
+
+    ##
+    # Check the header of the cache file and build the index, from the
+    # index file if there's a usable one, or else by scanning the cache
+    # file.  This method should only be called once to initialize the
+    # cache from disk.
     def _initfile(self, fsize):
-        maxsize = self.maxsize
         f = self.f
         read = f.read
         seek = f.seek
-        write = f.write
         seek(0)
-        if read(4) != magic:
+        file_magic = read(4)
+        if file_magic != magic and file_magic != compressed_magic:
             seek(0)
             raise ValueError("unexpected magic number: %r" % read(4))
+        self._file_magic = file_magic
         self.tid = read(8)
         if len(self.tid) != 8:
             raise ValueError("cache file too small -- no tid at start")
 
+        if fsize == self.maxsize and self._load_index():
+            return
+
+        if self.background_scan and self.path and fsize > ZEC_HEADER_SIZE:
+            # __init__ starts the scan, once the cache is set up.
+            self._scanning = True
+            return
+
+        self._scan(f, fsize)
+
+    ##
+    # Scan the blocks of the cache file, using the file object `f`, to
+    # build the index.  If `stop`, an event, is set, stop and return
+    # False.  Otherwise return True.
+    def _scan(self, f, fsize, stop=None):
+        maxsize = self.maxsize
+        read = f.read
+        seek = f.seek
+        write = f.write
+
         # Populate .filemap and .key2entry to reflect what's currently in the
         # file, and tell our parent about it too (via the `install` callback).
         # Remember the location of the largest free block.  That seems a
         # decent place to start currentofs.
 
-        self.current = _current_index_type()
+        self.current = self._current_index_type()
         self.noncurrent = _noncurrent_index_type()
         l = 0
         last = ofs = ZEC_HEADER_SIZE
@@ -287,10 +589,12 @@ class ClientCache(object):
         current = self.current
         status = b' '
         while ofs < fsize:
+            if stop is not None and stop.is_set():
+                return False
             seek(ofs)
             status = read(1)
             if status == b'a':
-                size, oid, start_tid, end_tid, lver = unpack(
+                size, oid, start_tid, end_tid, flags = unpack(
                     ">I8s8s8sH", read(30))
                 if ofs+size <= maxsize:
                     if end_tid == z64:
@@ -299,7 +603,7 @@ class ClientCache(object):
                     else:
                         assert start_tid < end_tid, (ofs, f.tell())
                         self._set_noncurrent(oid, start_tid, ofs)
-                    assert lver == 0, "Versions aren't supported"
+                    assert not flags & ~record_compressed, (ofs, flags)
                     l += 1
             else:
                 # free block
@@ -343,8 +647,7 @@ class ClientCache(object):
         if fsize < maxsize:
             assert ofs==fsize
             # Make sure the OS really saves enough bytes for the file.
-            seek(self.maxsize - 1)
-            write(b'x')
+            preallocate(f, maxsize, self.fallocate)
 
             # add as many free blocks as are needed to fill the space
             seek(ofs)
@@ -353,7 +656,7 @@ class ClientCache(object):
                 block_size = min(max_block_size, nfree-i)
                 write(b'f' + pack(">I", block_size))
                 seek(block_size-5, 1)
-            sync(self.f)
+            sync(f)
 
             # There is always data to read and
             assert last and (status in b' f1234')
@@ -368,6 +671,567 @@ class ClientCache(object):
         # place where we last wrote.
         self.currentofs = first_free_offset or ZEC_HEADER_SIZE
         self._len = l
+        return True
+
+    def _start_scan(self, fsize):
+        logger.info("scanning persistent cache file %r in the background",
+                    self.path)
+        self._pending_invalidations = []
+        self._stop_scan = threading.Event()
+        thread = threading.Thread(target=self._background_scan,
+                                  args=(fsize,),
+                                  name="scan cache %s" % self.path)
+        thread.setDaemon(True)
+        self._scan_thread = thread
+        thread.start()
+
+    def _background_scan(self, fsize):
+        # The scan uses its own file object, because self.f is used to
+        # update the last tid meanwhile.  Nothing else touches the file,
+        # or the index, until _scanning is cleared.
+        try:
+            with open(self.path, 'rb+') as f:
+                if not self._scan(f, fsize, self._stop_scan):
+                    return
+        except Exception:
+            logger.critical("Couldn't scan cache file %r, clearing it.",
+                            self.path, exc_info=1)
+            failed = True
+        else:
+            failed = False
+
+        with self._lock:
+            self._generation += 1
+            try:
+                # Seeking to the end drops anything self.f read ahead
+                # before the scan changed the file.
+                self.f.seek(0, 2)
+                if failed:
+                    self.f.seek(ZEC_HEADER_SIZE)
+                    self.f.truncate()
+                    self._scan(self.f, ZEC_HEADER_SIZE)
+                self._scanning = False
+                for oid, tid in self._pending_invalidations:
+                    self._invalidate_oid(oid, tid)
+                self._pending_invalidations = None
+                if self.use_mmap:
+                    self._setup_map()
+            finally:
+                self._generation += 1
+            if self.journal:
+                # Save the index, starting the journal, so a crash
+                # doesn't need another scan.
+                self._save_index()
+        logger.info("finished scanning persistent cache file %r", self.path)
+
+    ##
+    # Wait for a background scan, if any, to finish.  This mustn't be
+    # called with the lock held.
+    def _wait_for_scan(self):
+        thread = self._scan_thread
+        if thread is not None:
+            thread.join()
+
+    ##
+    # Write-behind queue, used if write_behind_size is set.  The queue
+    # lock is acquired after the cache lock, never before it.  Records
+    # are taken off the queue and written with the cache lock held, so
+    # an invalidation either finds a record in the queue or in the file.
+    def _start_writer(self):
+        thread = threading.Thread(target=self._write_behind,
+                                  name="write cache %s" % self.path)
+        thread.setDaemon(True)
+        self._writer_thread = thread
+        thread.start()
+
+    def _write_behind(self):
+        condition = self._queue_condition
+        while True:
+            with condition:
+                while not (self._queued or self._writer_closing):
+                    condition.wait()
+                if self._writer_closing:
+                    # close() writes whatever is left.
+                    return
+            try:
+                self._flush_queue()
+            except Exception:
+                logger.exception("Couldn't write queued cache records")
+
+    def _stop_writer(self):
+        with self._queue_condition:
+            self._writer_closing = True
+            self._queue_condition.notify()
+        self._writer_thread.join()
+        self._writer_thread = None
+
+    def _queue_store(self, oid, start_tid, end_tid, data):
+        # Queue a record for the writer thread.  Return False if the
+        # queue is full.
+        with self._queue_condition:
+            revisions = self._queued.get(oid)
+            if revisions:
+                if start_tid in revisions:
+                    return True
+                if end_tid is None and any(
+                        entry[0] is None for entry in revisions.values()):
+                    raise ValueError("already have current data for oid")
+            if self._queued_bytes + len(data) > self.write_behind_size:
+                return False
+            self._queued.setdefault(oid, {})[start_tid] = [end_tid, data]
+            self._queued_bytes += len(data)
+            self._queued_count += 1
+            self._queue_condition.notify()
+            return True
+
+    @locked
+    def _flush_queue(self):
+        # Write the queued records to the file.
+        with self._queue_condition:
+            queued = self._queued
+            if not queued:
+                return
+            self._queued = {}
+            self._queued_bytes = self._queued_count = 0
+        items = [(oid, start_tid, end_tid, data)
+                 for oid, revisions in six.iteritems(queued)
+                 for start_tid, (end_tid, data) in six.iteritems(revisions)]
+        try:
+            self.store_many(items)
+        except ValueError:
+            # The file has conflicting current data for some oid, so
+            # store the records one by one, skipping that one.
+            for item in items:
+                try:
+                    self._store_now(*item)
+                except ValueError:
+                    logger.warning("Not writing queued record for %r, "
+                                   "as the cache has other current data",
+                                   item[0])
+
+    def _load_queued(self, oid, before_tid):
+        # Return (data, start_tid, end_tid) for the queued revision of
+        # oid that was current before before_tid, if there is one.
+        with self._queue_condition:
+            revisions = self._queued.get(oid)
+            if not revisions:
+                return None
+            for start_tid, (end_tid, data) in six.iteritems(revisions):
+                if not before_tid:
+                    if end_tid is None:
+                        break
+                elif start_tid < before_tid and (
+                        end_tid is None or before_tid <= end_tid):
+                    break
+            else:
+                return None
+        self._n_accesses += 1
+        if end_tid is None:
+            self._trace(0x22, oid, start_tid, z64, len(data))
+        else:
+            self._trace(0x26, oid, b"", start_tid)
+        return data, start_tid, end_tid
+
+    def _invalidate_queued(self, oid, tid):
+        # Apply an invalidation to the queued revisions of oid, as
+        # _invalidate does to records in the file.
+        with self._queue_condition:
+            revisions = self._queued.get(oid)
+            if not revisions:
+                return
+            if tid is None:
+                del self._queued[oid]
+                self._queued_count -= len(revisions)
+                for end_tid, data in six.itervalues(revisions):
+                    self._queued_bytes -= len(data)
+                return
+            for start_tid, entry in six.iteritems(revisions):
+                if entry[0] is None and start_tid != tid:
+                    entry[0] = tid
+
+    ##
+    # Load the index file written by _save_index, if there is one and it
+    # matches the cache file, and return True.  Otherwise, remove the
+    # index file, if any, and return False so that the cache file gets
+    # scanned.
+    def _load_index(self):
+        if not self.path:
+            return False
+        path = self.path + '.index'
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            header = data[:index_header_size]
+            entries = self._read_journal(header)
+            if entries and not self.journal:
+                raise ValueError("cache file was changed after index was "
+                                 "saved")
+            if entries:
+                changes = self._journal_changes(entries)
+                self._read_index(data, False, changes[-1])
+                self._replay_journal(*changes[:-1])
+            else:
+                self._read_index(data, entries is None or not self.journal)
+        except Exception:
+            logger.warning("Ignoring bad cache index file %r.", path,
+                           exc_info=1)
+            self.current = self._current_index_type()
+            self.noncurrent = _noncurrent_index_type()
+            self.currentofs = ZEC_HEADER_SIZE
+            self._remove_index()
+            return False
+
+        if entries:
+            logger.info("recovered index for persistent cache file %r "
+                        "from %d journal entries", self.path, len(entries))
+            self._save_index()
+        else:
+            logger.info("loaded index for persistent cache file %r",
+                        self.path)
+            self._index_saved = True
+            if self.journal:
+                self._reset_journal(header)
+        return True
+
+    ##
+    # Read the index file's data.  Unless `check_file` is false, it must
+    # match the cache file.  If `changed` is given, entries for offsets
+    # for which it returns true are skipped.
+    def _read_index(self, data, check_file=True, changed=None):
+        if len(data) < index_header_size:
+            raise ValueError("index file too small")
+        (imagic, tid, maxsize, currentofs, mtime, ncurrent, nnoncurrent
+         ) = unpack(index_header_format, data[:index_header_size])
+        if imagic != index_magic:
+            raise ValueError("unexpected magic number: %r" % imagic)
+        # If the index is brought up to date from the journal, the cache
+        # file may have changed since it was saved.
+        if check_file and tid != self.tid:
+            raise ValueError("index tid doesn't match cache file")
+        if maxsize != self.maxsize:
+            raise ValueError("index size doesn't match cache file")
+        if check_file and mtime != os.fstat(self.f.fileno()).st_mtime:
+            raise ValueError("cache file was changed after index was saved")
+        if len(data) != index_header_size + ncurrent*16 + nnoncurrent*24:
+            raise ValueError("index file has the wrong size")
+        if not ZEC_HEADER_SIZE <= currentofs < maxsize:
+            raise ValueError("bad currentofs in index file")
+
+        current = self.current
+        pos = index_header_size
+        for pos in range(pos, pos + ncurrent*16, 16):
+            oid, ofs = unpack_from(">8sQ", data, pos)
+            if not ZEC_HEADER_SIZE <= ofs < maxsize:
+                raise ValueError("bad offset in index file")
+            if changed is not None and changed(ofs):
+                continue
+            current[oid] = ofs
+
+        noncurrent = self.noncurrent
+        pos = index_header_size + ncurrent*16
+        for pos in range(pos, pos + nnoncurrent*24, 24):
+            oid, tid, ofs = unpack_from(">QQQ", data, pos)
+            if not ZEC_HEADER_SIZE <= ofs < maxsize:
+                raise ValueError("bad offset in index file")
+            if changed is not None and changed(ofs):
+                continue
+            noncurrent_for_oid = noncurrent.get(oid)
+            if noncurrent_for_oid is None:
+                noncurrent_for_oid = _noncurrent_bucket_type()
+                noncurrent[oid] = noncurrent_for_oid
+            noncurrent_for_oid[tid] = ofs
+
+        self.currentofs = currentofs
+        self._len = ncurrent + nnoncurrent
+
+    ##
+    # Write a snapshot of the index to the index file, so that the next
+    # open of the cache file can skip the scan.  The cache file is synced
+    # first, so the snapshot never describes data that isn't on disk.
+    def _save_index(self):
+        if not self.path or self._index_saved or self._scanning:
+            return
+        path = self.path + '.index'
+        tmp = path + '.tmp'
+        f = self.f
+        try:
+            sync(f)
+            data = [None]
+            for oid, ofs in six.iteritems(self.current):
+                data.append(pack(">8sQ", oid, ofs))
+            nnoncurrent = 0
+            for oid, noncurrent_for_oid in six.iteritems(self.noncurrent):
+                for tid, ofs in six.iteritems(noncurrent_for_oid):
+                    data.append(pack(">QQQ", oid, tid, ofs))
+                    nnoncurrent += 1
+            data[0] = pack(index_header_format, index_magic, self.tid,
+                           self.maxsize, self.currentofs,
+                           os.fstat(f.fileno()).st_mtime,
+                           len(data) - 1 - nnoncurrent, nnoncurrent)
+            with open(tmp, 'wb') as index_file:
+                index_file.write(b''.join(data))
+                sync(index_file)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            logger.warning("Couldn't save cache index file %r", path,
+                           exc_info=1)
+            return
+
+        self._index_saved = True
+        self._index_saved_at = time.time()
+        if self.journal:
+            self._reset_journal(data[0])
+
+    ##
+    # Called before changing the cache file.  If the index file matches
+    # the cache file, remove it, because it's about to become stale,
+    # unless the change will be journaled.
+    def _discard_index(self):
+        if self._index_saved:
+            self._index_saved = False
+            if self._journal_file is None:
+                self._remove_index()
+
+    def _remove_index(self):
+        path = self.path + '.index'
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning("Couldn't remove cache index file %r", path,
+                               exc_info=1)
+
+    ##
+    # Start the journal over, for the index file with the given header.
+    # If that fails, changes aren't journaled, and the index file is
+    # removed before the next one.
+    def _reset_journal(self, header):
+        self._close_journal()
+        path = self.path + '.journal'
+        try:
+            f = open(path, 'wb', 0)
+            try:
+                f.write(journal_magic + header)
+            except Exception:
+                f.close()
+                raise
+        except (IOError, OSError):
+            logger.warning("Couldn't write cache journal file %r", path,
+                           exc_info=1)
+            return
+        self._journal_file = f
+        self._journal_entries = 0
+
+    def _close_journal(self):
+        f = self._journal_file
+        if f is not None:
+            self._journal_file = None
+            self._journal_entries = 0
+            f.close()
+
+    ##
+    # Record a change about to be made to the cache file.  The journal
+    # isn't buffered, so the entry gets to the operating system before
+    # the change does.
+    def _journal(self, kind, ofs, size=0, nbytes=0):
+        f = self._journal_file
+        if f is None:
+            return
+        try:
+            f.write(pack(journal_entry_format, kind, ofs, size, nbytes))
+        except (IOError, OSError):
+            logger.warning("Couldn't write cache journal file %r, "
+                           "removing the index file", self.path + '.journal',
+                           exc_info=1)
+            self._close_journal()
+            self._remove_index()
+            return
+        self._journal_entries += 1
+
+    ##
+    # Stop journaling before a change, such as a resize, that isn't
+    # journaled.  The index file is saved again afterwards.
+    def _drop_journal(self):
+        self._discard_index()
+        if self._journal_file is not None:
+            self._close_journal()
+            self._remove_index()
+
+    ##
+    # Return the entries of the journal for the index file with the given
+    # header, or None if there isn't one.
+    def _read_journal(self, header):
+        path = self.path + '.journal'
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        pos = len(journal_magic) + index_header_size
+        if data[:pos] != journal_magic + header:
+            return None
+        # A partial entry at the end was being written when we crashed,
+        # before the change it describes was made, so it's ignored.
+        return [unpack_from(journal_entry_format, data, pos)
+                for pos in range(pos, len(data) - journal_entry_size + 1,
+                                 journal_entry_size)]
+
+    ##
+    # Return the ring regions, as sorted (start, end) pairs, and the
+    # blocks outside of them, changed according to the journal, the
+    # offsets that currentofs was set to, and a function that tells
+    # whether an offset is in one of the regions or blocks.
+    def _journal_changes(self, entries):
+        maxsize = self.maxsize
+        regions = []
+        pointers = []
+        blocks = []
+        for kind, ofs, size, nbytes in entries:
+            if kind == b'r':
+                if not (ZEC_HEADER_SIZE <= ofs and nbytes < size and
+                        ofs + size <= maxsize):
+                    raise ValueError("bad region in journal")
+                regions.append((ofs, ofs + size))
+                pointers.append(ofs)
+                pointers.append(ofs + nbytes)
+            elif kind == b'b':
+                if not ZEC_HEADER_SIZE <= ofs < maxsize:
+                    raise ValueError("bad block in journal")
+                blocks.append(ofs)
+            else:
+                raise ValueError("bad journal entry %r" % kind)
+
+        # Merge the regions, which the ring may have gone over more than
+        # once.  Blocks in regions are read with them.
+        merged = []
+        for start, end in sorted(regions):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = merged[-1][0], end
+            else:
+                merged.append((start, end))
+        starts = [start for (start, end) in merged]
+        def in_region(ofs):
+            i = bisect.bisect_right(starts, ofs) - 1
+            return i >= 0 and ofs < merged[i][1]
+        blocks = set(ofs for ofs in blocks if not in_region(ofs))
+        def changed(ofs):
+            return ofs in blocks or in_region(ofs)
+        return merged, blocks, pointers, changed
+
+    ##
+    # Bring the index, read from the index file without the entries for
+    # changed blocks, up to date by reading the blocks changed according
+    # to the journal.  Regions are read block by block, and if a write
+    # to one was cut short, leaving something that isn't a block, the
+    # rest of the region is freed.
+    def _replay_journal(self, merged, blocks, pointers):
+        maxsize = self.maxsize
+        boundaries = set()
+        for start, end in merged:
+            ofs = start
+            while ofs < end:
+                boundaries.add(ofs)
+                size = self._recover_block(ofs, end)
+                if size is None:
+                    logger.warning("Freeing %d bytes at %d in cache file %r "
+                                   "after an incomplete write",
+                                   end - ofs, ofs, self.path)
+                    self._write_free(ofs, end - ofs)
+                    break
+                ofs += size
+        for ofs in sorted(blocks):
+            if self._recover_block(ofs, maxsize) is None:
+                raise ValueError("bad block at %d in cache file" % ofs)
+        sync(self.f)
+
+        # currentofs must be at the start of a block.  It's where the
+        # last store left it, unless the last stores weren't written.
+        if pointers:
+            for ofs in reversed(pointers):
+                if ofs in boundaries:
+                    self.currentofs = ofs
+                    break
+            else:
+                self.currentofs = ZEC_HEADER_SIZE
+        self._len = len(self.current) + sum(
+            len(noncurrent_for_oid)
+            for noncurrent_for_oid in six.itervalues(self.noncurrent))
+
+    # Read the block at `ofs`, adding it to the index if it's a record,
+    # and return its size, or None if it isn't a block ending by `end`.
+    def _recover_block(self, ofs, end):
+        seek = self.f.seek
+        read = self.f.read
+        seek(ofs)
+        status = read(1)
+        if status == b'a':
+            size, oid, start_tid, end_tid, flags, ldata = unpack(
+                ">I8s8s8sHI", read(34))
+            if (size != allocated_record_overhead + ldata or
+                ofs + size > end or flags & ~record_compressed or
+                (end_tid != z64 and start_tid >= end_tid)):
+                return None
+            seek(ofs + size - 8)
+            if read(8) != oid:
+                return None
+            self._recover_record(oid, start_tid, end_tid, ofs)
+        elif status == b'f':
+            size, = unpack(">I", read(4))
+            if size < 5 or ofs + size > end:
+                return None
+        elif status and status in b'1234':
+            size = int(status)
+            if ofs + size > end:
+                return None
+        else:
+            return None
+        return size
+
+    def _recover_record(self, oid, start_tid, end_tid, ofs):
+        if end_tid == z64:
+            other = self.current.get(oid)
+            if other is not None:
+                # There can only be one current record, so one of them
+                # should have been invalidated.  Keep the newer one.
+                self.f.seek(other + 13)
+                if self.f.read(8) > start_tid:
+                    self._free_block(ofs)
+                    return
+                self._free_block(other)
+            self.current[oid] = ofs
+        else:
+            noncurrent_for_oid = self.noncurrent.get(u64(oid))
+            if noncurrent_for_oid is not None:
+                other = noncurrent_for_oid.get(u64(start_tid))
+                if other is not None:
+                    self._free_block(other)
+            self._set_noncurrent(oid, start_tid, ofs)
+
+    def _free_block(self, ofs):
+        self.f.seek(ofs + 1)
+        size, = unpack(">I", self.f.read(4))
+        self._write_free(ofs, size)
+
+    # Write free blocks filling `size` bytes at `ofs`.
+    def _write_free(self, ofs, size):
+        seek = self.f.seek
+        write = self.f.write
+        for i in range(0, size, max_block_size):
+            block_size = min(max_block_size, size - i)
+            seek(ofs + i)
+            if block_size > 4:
+                write(b'f' + pack(">I", block_size))
+            else:
+                write("01234"[block_size].encode())
+
+    def _save_profile(self):
+        if self._access_counter is not None:
+            write_profile(self.path + '.profile',
+                          self._access_counter.hottest())
 
     def _set_noncurrent(self, oid, tid, ofs):
         noncurrent_for_oid = self.noncurrent.get(u64(oid))
@@ -390,32 +1254,69 @@ class ClientCache(object):
         self._n_adds = self._n_added_bytes = 0
         self._n_evicts = self._n_evicted_bytes = 0
         self._n_accesses = 0
+        self._n_rejects = self._n_rejected_bytes = 0
+        if self._memory is not None:
+            self._memory.clearStats()
+        if self._noncurrent_cache is not None:
+            self._noncurrent_cache.clearStats()
 
     def getStats(self):
-        return (self._n_adds, self._n_added_bytes,
-                self._n_evicts, self._n_evicted_bytes,
-                self._n_accesses
-               )
+        memory = self._memory
+        stats = (self._n_adds, self._n_added_bytes,
+                 self._n_evicts, self._n_evicted_bytes,
+                 self._n_accesses,
+                 self._n_rejects, self._n_rejected_bytes,
+                 memory.hits if memory is not None else 0,
+                 memory.misses if memory is not None else 0,
+                )
+        if self._noncurrent_cache is not None:
+            stats = tuple(map(sum, zip(stats,
+                                       self._noncurrent_cache.getStats())))
+        return stats
 
     ##
-    # The number of objects currently in the cache.
+    # The number of objects currently in the cache, including queued
+    # ones.  While the cache file is being scanned, that's unknown, and 0.
     def __len__(self):
-        return self._len
+        n = self._len + self._queued_count
+        if self._noncurrent_cache is not None:
+            n += len(self._noncurrent_cache)
+        return n
+
+    # A cache that's being scanned may not be empty.
+    def __bool__(self):
+        return self._scanning or len(self) > 0
+
+    __nonzero__ = __bool__
 
     ##
     # Close the underlying file.  No methods accessing the cache should be
     # used after this.
     def close(self):
-        self._unsetup_trace()
+        if self._scan_thread is not None:
+            self._stop_scan.set()
+            self._scan_thread.join()
+        if self._writer_thread is not None:
+            self._stop_writer()
         f = self.f
-        self.f = None
         if f is not None:
+            self._flush_queue()
+        self._unsetup_trace()
+        if f is not None:
+            self._close_map()
+            self._save_index()
+            self._close_journal()
+            self._save_profile()
+            self.f = None
             sync(f)
             f.close()
 
         if hasattr(self,'_lock_file'):
             self._lock_file.close()
 
+        if self._noncurrent_cache is not None:
+            self._noncurrent_cache.close()
+
     ##
     # Evict objects as necessary to free up at least nbytes bytes,
     # starting at currentofs.  If currentofs is closer than nbytes to
@@ -445,6 +1346,8 @@ class ClientCache(object):
                 self._n_evicted_bytes += size
                 if end_tid == z64:
                     del current[oid]
+                    if self._memory is not None:
+                        self._memory.discard(oid)
                 else:
                     self._del_noncurrent(oid, start_tid)
                 self._len -= 1
@@ -474,10 +1377,16 @@ class ClientCache(object):
                              "previous one (%s)"
                              % (u64(tid), u64(self.tid)))
         assert isinstance(tid, bytes) and len(tid) == 8, tid
+        self._discard_index()
         self.tid = tid
         self.f.seek(len(magic))
         self.f.write(tid)
         self.f.flush()
+        if ((self.index_save_interval and
+             time.time() - self._index_saved_at > self.index_save_interval)
+            or self._journal_entries > max_journal_entries):
+            self._save_index()
+            self._save_profile()
 
     ##
     # Return the last transaction seen by the cache.
@@ -493,34 +1402,77 @@ class ClientCache(object):
     #         in the cache
     # @defreturn 3-tuple: (string, string, string)
 
-    @locked
     def load(self, oid, before_tid=None):
+        if self.admission is not None:
+            self.admission.record(oid)
+        if self._access_counter is not None:
+            self._access_counter.record(oid)
+        if self._scanning:
+            self._trace(0x20, oid)
+            return None
+        if self._queued:
+            result = self._load_queued(oid, before_tid)
+            if result is not None and result[2] is None:
+                return result[:2]
+        if self._memory is not None:
+            result = self._load_memory(oid, before_tid)
+            if result is not None:
+                return result
+        if self.concurrent_reads:
+            result = self._load_unlocked(oid, before_tid)
+            if result is not None:
+                return result
+        return self._load(oid, before_tid)
+
+    @locked
+    def _load(self, oid, before_tid=None):
         ofs = self.current.get(oid)
         if ofs is None:
             self._trace(0x20, oid)
             return None
-        self.f.seek(ofs)
-        read = self.f.read
-        status = read(1)
+        m = self._map
+        if m is None:
+            self.f.seek(ofs)
+            read = self.f.read
+            status = read(1)
+            size, saved_oid, tid, end_tid, flags, ldata = unpack(
+                ">I8s8s8sHI", read(34))
+        else:
+            status, size, saved_oid, tid, end_tid, flags, ldata = unpack_from(
+                allocated_header_format, m, ofs)
         assert status == b'a', (ofs, self.f.tell(), oid)
-        size, saved_oid, tid, end_tid, lver, ldata = unpack(
-            ">I8s8s8sHI", read(34))
         assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
         assert end_tid == z64, (ofs, self.f.tell(), oid, tid, end_tid)
-        assert lver == 0, "Versions aren't supported"
+        assert not flags & ~record_compressed, (ofs, oid, flags)
 
         if before_tid and tid >= before_tid:
             return None
 
-        data = read(ldata)
-        assert len(data) == ldata, (ofs, self.f.tell(), oid, len(data), ldata)
+        if m is None:
+            data = read(ldata)
+            assert len(data) == ldata, (
+                ofs, self.f.tell(), oid, len(data), ldata)
 
-        # WARNING: The following assert changes the file position.
-        # We must not depend on this below or we'll fail in optimized mode.
-        assert read(8) == oid, (ofs, self.f.tell(), oid)
+            # WARNING: The following assert changes the file position.
+            # We must not depend on this below or we'll fail in optimized
+            # mode.
+            assert read(8) == oid, (ofs, self.f.tell(), oid)
+        else:
+            # The data is sliced directly from the map.
+            dofs = ofs + allocated_header_size
+            data = m[dofs:dofs+ldata]
+            assert len(data) == ldata, (ofs, oid, len(data), ldata)
+            assert m[dofs+ldata:dofs+ldata+8] == oid, (ofs, oid)
 
         self._n_accesses += 1
-        self._trace(0x22, oid, tid, end_tid, ldata)
+        stored = data
+        if flags & record_compressed:
+            data = zlib.decompress(stored)
+            self._trace(0x22, oid, tid, end_tid, len(data), ldata)
+        else:
+            self._trace(0x22, oid, tid, end_tid, ldata)
+        if self._memory is not None:
+            self._memory.put(oid, data, tid)
 
         ofsofs = self.currentofs - ofs
         if ofsofs < 0:
@@ -533,12 +1485,18 @@ class ClientCache(object):
             # valuable, so move it forward.
 
             # Remove fromn old loc:
-            del self.current[oid]
-            self.f.seek(ofs)
-            self.f.write(b'f'+pack(">I", size))
+            self._discard_index()
+            self._generation += 1
+            try:
+                del self.current[oid]
+                self._journal(b'b', ofs)
+                self.f.seek(ofs)
+                self.f.write(b'f'+pack(">I", size))
 
-            # Write to new location:
-            self._store(oid, tid, None, data, size)
+                # Write to new location:
+                self._store(oid, tid, None, stored, size, flags)
+            finally:
+                self._generation += 1
 
         return data, tid
 
@@ -549,11 +1507,38 @@ class ClientCache(object):
     # @return data record, serial number, start tid, and end tid
     # @defreturn 4-tuple: (string, string, string, string)
 
-    @locked
     def loadBefore(self, oid, before_tid):
+        if self.admission is not None:
+            self.admission.record(oid)
+        if self._access_counter is not None:
+            self._access_counter.record(oid)
+        if self._scanning:
+            self._trace(0x24, oid, b"", before_tid)
+            return None
+        if self._queued:
+            result = self._load_queued(oid, before_tid)
+            if result is not None:
+                return result
+        if self._memory is not None:
+            # Current data written before before_tid is the revision
+            # that was current then.
+            result = self._load_memory(oid, before_tid)
+            if result is not None:
+                return result[0], result[1], None
+        if self.concurrent_reads:
+            result = self._loadBefore_unlocked(oid, before_tid)
+            if result is not None:
+                return result
+        result = self._loadBefore(oid, before_tid)
+        if result is None and self._noncurrent_cache is not None:
+            result = self._noncurrent_cache.loadBefore(oid, before_tid)
+        return result
+
+    @locked
+    def _loadBefore(self, oid, before_tid):
         noncurrent_for_oid = self.noncurrent.get(u64(oid))
         if noncurrent_for_oid is None:
-            result = self.load(oid, before_tid)
+            result = self._load(oid, before_tid)
             if result:
                 return result[0], result[1], None
             else:
@@ -562,7 +1547,7 @@ class ClientCache(object):
 
         items = noncurrent_for_oid.items(None, u64(before_tid)-1)
         if not items:
-            result = self.load(oid, before_tid)
+            result = self._load(oid, before_tid)
             if result:
                 return result[0], result[1], None
             else:
@@ -571,35 +1556,186 @@ class ClientCache(object):
 
         tid, ofs = items[-1]
 
-        self.f.seek(ofs)
-        read = self.f.read
-        status = read(1)
+        m = self._map
+        if m is None:
+            self.f.seek(ofs)
+            read = self.f.read
+            status = read(1)
+            size, saved_oid, saved_tid, end_tid, flags, ldata = unpack(
+                ">I8s8s8sHI", read(34))
+        else:
+            (status, size, saved_oid, saved_tid, end_tid, flags, ldata
+             ) = unpack_from(allocated_header_format, m, ofs)
         assert status == b'a', (ofs, self.f.tell(), oid, before_tid)
-        size, saved_oid, saved_tid, end_tid, lver, ldata = unpack(
-            ">I8s8s8sHI", read(34))
         assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
         assert saved_tid == p64(tid), (ofs, self.f.tell(), oid, saved_tid, tid)
         assert end_tid != z64, (ofs, self.f.tell(), oid)
-        assert lver == 0, "Versions aren't supported"
-        data = read(ldata)
-        assert len(data) == ldata, (ofs, self.f.tell())
-
-        # WARNING: The following assert changes the file position.
-        # We must not depend on this below or we'll fail in optimized mode.
-        assert read(8) == oid, (ofs, self.f.tell(), oid)
+        assert not flags & ~record_compressed, (ofs, oid, flags)
+        if m is None:
+            data = read(ldata)
+            assert len(data) == ldata, (ofs, self.f.tell())
+
+            # WARNING: The following assert changes the file position.
+            # We must not depend on this below or we'll fail in optimized
+            # mode.
+            assert read(8) == oid, (ofs, self.f.tell(), oid)
+        else:
+            dofs = ofs + allocated_header_size
+            data = m[dofs:dofs+ldata]
+            assert len(data) == ldata, (ofs, oid)
+            assert m[dofs+ldata:dofs+ldata+8] == oid, (ofs, oid)
 
         if end_tid < before_tid:
-            result = self.load(oid, before_tid)
+            result = self._load(oid, before_tid)
             if result:
                 return result[0], result[1], None
             else:
                 self._trace(0x24, oid, b"", before_tid)
                 return result
 
+        self._n_accesses += 1
+        self._trace(0x26, oid, b"", saved_tid)
+        if flags & record_compressed:
+            data = zlib.decompress(data)
+        return data, saved_tid, end_tid
+
+    ##
+    # Lock-free versions of load and loadBefore, used if concurrent_reads
+    # is set.  They only handle cache hits that don't need the record to
+    # be moved forward.  In all other cases, including when a change was
+    # made while reading, they return None and the caller falls back to
+    # the locked implementation.
+    def _load_unlocked(self, oid, before_tid=None):
+        generation = self._generation
+        if generation & 1:
+            return None
+        try:
+            ofs = self.current.get(oid)
+            if ofs is None:
+                return None
+            tid, end_tid, data = self._read_unlocked(oid, ofs)
+        except Exception:
+            return None
+        if (end_tid != z64 or (before_tid and tid >= before_tid) or
+            self._generation != generation):
+            return None
+
+        ofsofs = self.currentofs - ofs
+        if ofsofs < 0:
+            ofsofs += self.maxsize
+        if ofsofs > self.rearrange and self.maxsize > 10*len(data):
+            return None
+
+        memory = self._memory
+        if memory is not None:
+            # Changes bump the generation before they discard objects
+            # from memory, so if it hasn't changed, the data is current.
+            with memory.lock:
+                if self._generation == generation:
+                    memory.put(oid, data, tid)
+
+        self._n_accesses += 1
+        self._trace(0x22, oid, tid, end_tid, len(data))
+        return data, tid
+
+    def _load_memory(self, oid, before_tid):
+        result = self._memory.get(oid, before_tid)
+        if result is not None:
+            self._n_accesses += 1
+            self._trace(0x22, oid, result[1], z64, len(result[0]))
+        return result
+
+    def _loadBefore_unlocked(self, oid, before_tid):
+        generation = self._generation
+        if generation & 1:
+            return None
+        try:
+            noncurrent_for_oid = self.noncurrent.get(u64(oid))
+            if noncurrent_for_oid is not None:
+                items = noncurrent_for_oid.items(None, u64(before_tid)-1)
+            else:
+                items = None
+            if not items:
+                result = self._load_unlocked(oid, before_tid)
+                if result is None:
+                    return None
+                return result[0], result[1], None
+
+            tid, ofs = items[-1]
+            saved_tid, end_tid, data = self._read_unlocked(oid, ofs)
+        except Exception:
+            return None
+        if (saved_tid != p64(tid) or end_tid == z64 or
+            self._generation != generation):
+            return None
+        if end_tid < before_tid:
+            result = self._load_unlocked(oid, before_tid)
+            if result is None:
+                return None
+            return result[0], result[1], None
+
         self._n_accesses += 1
         self._trace(0x26, oid, b"", saved_tid)
         return data, saved_tid, end_tid
 
+    # Read the record for `oid` at `ofs` without using the file position,
+    # returning start tid, end tid and data.  A ValueError is raised if
+    # the record doesn't look right, which can happen if it's being
+    # overwritten.
+    def _read_unlocked(self, oid, ofs):
+        m = self._map
+        if m is not None:
+            header = m[ofs:ofs+allocated_header_size]
+        else:
+            header = os.pread(self.f.fileno(), allocated_header_size, ofs)
+        status, size, saved_oid, tid, end_tid, flags, ldata = unpack(
+            allocated_header_format, header)
+        if (status != b'a' or saved_oid != oid or
+            size != allocated_record_overhead + ldata):
+            raise ValueError("Record changed while reading")
+        dofs = ofs + allocated_header_size
+        if m is not None:
+            data = m[dofs:dofs+ldata]
+            saved_oid = m[dofs+ldata:dofs+ldata+8]
+        else:
+            data = os.pread(self.f.fileno(), ldata+8, dofs)
+            data, saved_oid = data[:ldata], data[ldata:]
+        if saved_oid != oid or len(data) != ldata:
+            raise ValueError("Record changed while reading")
+        if flags & record_compressed:
+            data = zlib.decompress(data)
+        return tid, end_tid, data
+
+    ##
+    # Read the records of the given objects that are in the cache file,
+    # in file order, so that they're in the operating system's page cache
+    # when they're loaded.  Return the oids of those that aren't cached.
+    def warm(self, oids):
+        self._wait_for_scan()
+        missing = []
+        found = []
+        with self._lock:
+            current = self.current
+            for oid in oids:
+                ofs = current.get(oid)
+                if ofs is not None:
+                    found.append((ofs, oid))
+                elif oid not in self._queued:
+                    missing.append(oid)
+        found.sort()
+        for ofs, oid in found:
+            self._read_record(oid, ofs)
+        return missing
+
+    @locked
+    def _read_record(self, oid, ofs):
+        # The record may have been moved since warm() looked it up.
+        if self.current.get(oid) != ofs or self.f is None:
+            return
+        self.f.seek(ofs)
+        size, = unpack(">I", self.f.read(5)[1:])
+        self.f.read(size - 5)
+
     ##
     # Store a new data record in the cache.
     # @param oid object id
@@ -609,13 +1745,60 @@ class ClientCache(object):
     #                current.
     # @param data the actual data
 
-    @locked
     def store(self, oid, start_tid, end_tid, data):
-        seek = self.f.seek
+        if self._scanning:
+            return
+        # A current record for an object with current data in the file
+        # isn't queued, so that a conflicting revision raises ValueError.
+        if self.write_behind_size and not (
+                end_tid is None and self.current.get(oid)):
+            if self._queue_store(oid, start_tid, end_tid, data):
+                return
+            # The queue is full, so write it, and this record, now.
+            self._flush_queue()
+        self._store_now(oid, start_tid, end_tid, data)
+
+    @locked
+    def _store_now(self, oid, start_tid, end_tid, data):
+        if self._scanning:
+            return
+        if end_tid is not None and self.noncurrent_fraction is not None:
+            if self._noncurrent_cache is not None:
+                self._noncurrent_cache.store(oid, start_tid, end_tid, data)
+            return
+        record = self._check_store(oid, start_tid, end_tid, data)
+        if record is None:
+            return
+        stored, size, flags = record
+
+        self._discard_index()
+        self._n_adds += 1
+        self._n_added_bytes += size
+        self._len += 1
+
+        self._generation += 1
+        try:
+            self._store(oid, start_tid, end_tid, stored, size, flags)
+        finally:
+            self._generation += 1
+
+        self._trace_store(oid, start_tid, end_tid, len(data), stored, flags)
+
+    def _trace_store(self, oid, start_tid, end_tid, dlen, stored, flags):
+        clen = len(stored) if flags & record_compressed else None
+        if end_tid:
+            self._trace(0x54, oid, start_tid, end_tid, dlen, clen)
+        else:
+            self._trace(0x52, oid, start_tid, dlen=dlen, clen=clen)
+
+    def _check_store(self, oid, start_tid, end_tid, data):
+        # Decide whether a record should be stored.  Return the data to
+        # write, which may be compressed, the size of the record and
+        # its flags, or None if it shouldn't be written.
         if end_tid is None:
             ofs = self.current.get(oid)
             if ofs:
-                seek(ofs)
+                self.f.seek(ofs)
                 read = self.f.read
                 status = read(1)
                 assert status == b'a', (ofs, self.f.tell(), oid)
@@ -624,13 +1807,29 @@ class ClientCache(object):
                 assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
                 assert end_tid == z64, (ofs, self.f.tell(), oid)
                 if saved_tid == start_tid:
-                    return
+                    return None
                 raise ValueError("already have current data for oid")
         else:
             noncurrent_for_oid = self.noncurrent.get(u64(oid))
             if noncurrent_for_oid and (u64(start_tid) in noncurrent_for_oid):
-                return
+                return None
+
+        # Admission is decided on the size of the data, before it's
+        # compressed, so rejected objects aren't compressed for nothing.
+        dlen = len(data)
+        if self.admission is not None and not self.admission.admit(oid, dlen):
+            self._n_rejects += 1
+            self._n_rejected_bytes += allocated_record_overhead + dlen
+            # 0x56 = store (rejected by admission policy)
+            self._trace(0x56, oid, start_tid, end_tid, dlen)
+            return None
 
+        flags = 0
+        if self.compress and dlen >= self.compress_min_size:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < dlen:
+                data = compressed
+                flags = record_compressed
         size = allocated_record_overhead + len(data)
 
         # A number of cache simulation experiments all concluded that the
@@ -638,32 +1837,131 @@ class ClientCache(object):
         # objects simply weren't cached.  For now, we ignore the request
         # only if the entire cache file is too small to hold the object.
         if size >= min(max_block_size, self.maxsize - ZEC_HEADER_SIZE):
+            return None
+
+        return data, size, flags
+
+    ##
+    # Store several object revisions at once.
+    #
+    # This is equivalent to calling store() for each item, but the
+    # lock is acquired once and records are written to the file
+    # together, so that adding the objects written by a transaction
+    # takes a few large writes rather than several small ones per
+    # object.
+    #
+    # @param items an iterable of (oid, start_tid, end_tid, data)
+    #              tuples, as passed to store()
+
+    @locked
+    def store_many(self, items):
+        if self._scanning:
             return
+        if self.noncurrent_fraction is not None:
+            items = self._store_many_noncurrent(items)
+        records = []
+        dlens = []
+        batch_current = {}
+        batch_noncurrent = set()
+        for oid, start_tid, end_tid, data in items:
+            # Check against earlier items in the batch first, as they
+            # aren't in the indexes yet.
+            if end_tid is None:
+                batch_tid = batch_current.get(oid)
+                if batch_tid is not None:
+                    if batch_tid == start_tid:
+                        continue
+                    raise ValueError("already have current data for oid")
+            elif (oid, start_tid) in batch_noncurrent:
+                continue
+
+            record = self._check_store(oid, start_tid, end_tid, data)
+            if record is None:
+                continue
 
-        self._n_adds += 1
-        self._n_added_bytes += size
-        self._len += 1
+            if end_tid is None:
+                batch_current[oid] = start_tid
+            else:
+                batch_noncurrent.add((oid, start_tid))
+            stored, size, flags = record
+            records.append((oid, start_tid, end_tid, stored, size, flags))
+            dlens.append(len(data))
 
-        self._store(oid, start_tid, end_tid, data, size)
+        if not records:
+            return
 
-        if end_tid:
-            self._trace(0x54, oid, start_tid, end_tid, dlen=len(data))
-        else:
-            self._trace(0x52, oid, start_tid, dlen=len(data))
+        self._discard_index()
+        self._generation += 1
+        try:
+            self._write_records(records)
+        finally:
+            self._generation += 1
+
+        for (oid, start_tid, end_tid, stored, size, flags), dlen in zip(
+                records, dlens):
+            self._n_adds += 1
+            self._n_added_bytes += size
+            self._len += 1
+            self._trace_store(oid, start_tid, end_tid, dlen, stored, flags)
+
+    def _store_many_noncurrent(self, items):
+        # Store the non-current items in the non-current cache, if
+        # there is one, and return the others.
+        current = []
+        noncurrent = []
+        for item in items:
+            (current if item[2] is None else noncurrent).append(item)
+        if noncurrent and self._noncurrent_cache is not None:
+            self._noncurrent_cache.store_many(noncurrent)
+        return current
+
+    def _write_records(self, records):
+        # Write (oid, start_tid, end_tid, data, size, flags) records at
+        # currentofs, in groups that fit in a single block and don't
+        # need to wrap around the end of the file.
+        limit = min(max_block_size, self.maxsize - ZEC_HEADER_SIZE)
+        group = []
+        nbytes = 0
+        for record in records:
+            size = record[4]
+            if group and (nbytes + size + 1 > limit or
+                          self.currentofs + nbytes + size + 1 >
+                          self.maxsize):
+                self._store_many(group, nbytes)
+                group = []
+                nbytes = 0
+            group.append(record)
+            nbytes += size
+        if group:
+            self._store_many(group, nbytes)
+
+    def _upgrade_magic(self):
+        # Mark the file as version 5 before writing the first
+        # compressed record to it.
+        self.f.seek(0)
+        self.f.write(compressed_magic)
+        self.f.flush()
+        self._file_magic = compressed_magic
 
-    def _store(self, oid, start_tid, end_tid, data, size):
+    def _store(self, oid, start_tid, end_tid, data, size, flags=0):
         # Low-level store used by store and load
+        self._store_many([(oid, start_tid, end_tid, data, size, flags)], size)
+
+    def _store_many(self, records, nbytes):
+        # Low-level store of (oid, start_tid, end_tid, data, size, flags)
+        # records, with sizes adding up to nbytes, at currentofs.
 
         # In the next line, we ask for an extra to make sure we always
-        # have a free block after the new alocated block.  This free
+        # have a free block after the new alocated blocks.  This free
         # block acts as a ring pointer, so that on restart, we start
         # where we left off.
-        nfreebytes = self._makeroom(size+1)
+        nfreebytes = self._makeroom(nbytes+1)
+        self._journal(b'r', self.currentofs, nfreebytes, nbytes)
 
-        assert size <= nfreebytes, (size, nfreebytes)
-        excess = nfreebytes - size
+        assert nbytes <= nfreebytes, (nbytes, nfreebytes)
+        excess = nfreebytes - nbytes
         # If there's any excess (which is likely), we need to record a
-        # free block following the end of the data record.  That isn't
+        # free block following the end of the data records.  That isn't
         # expensive -- it's all a contiguous write.
         if excess == 0:
             extra = b''
@@ -672,34 +1970,202 @@ class ClientCache(object):
         else:
             extra = b'f' + pack(">I", excess)
 
+        if self._file_magic != compressed_magic and any(
+            record[5] & record_compressed for record in records):
+            self._upgrade_magic()
+
         ofs = self.currentofs
         seek = self.f.seek
         seek(ofs)
         write = self.f.write
 
-        # Before writing data, we'll write a free block for the space freed.
-        # We'll come back with a last atomic write to rewrite the start of the
-        # allocated-block header.
-        write(b'f'+pack(">I", nfreebytes))
-
-        # Now write the rest of the allocation block header and object data.
-        write(pack(">8s8s8sHI", oid, start_tid, end_tid or z64, 0, len(data)))
-        write(data)
-        write(oid)
-        write(extra)
+        # Before writing data, we'll write a free block for the space
+        # freed, in place of the first allocated-block header.  The
+        # other records are hidden in this free block until we come
+        # back with a last atomic write to rewrite the start of the
+        # first allocated-block header.
+        buf = [b'f'+pack(">I", nfreebytes)]
+        offsets = []
+        pos = ofs
+        for oid, start_tid, end_tid, data, size, flags in records:
+            if offsets:
+                buf.append(b'a'+pack(">I", size))
+            buf.append(pack(">8s8s8sHI",
+                            oid, start_tid, end_tid or z64, flags, len(data)))
+            buf.append(data)
+            buf.append(oid)
+            offsets.append(pos)
+            pos += size
+        buf.append(extra)
+        write(b''.join(buf))
 
         # Now, we'll go back and rewrite the beginning of the
-        # allocated block header.
+        # first allocated block header.
         seek(ofs)
-        write(b'a'+pack(">I", size))
+        write(b'a'+pack(">I", records[0][4]))
 
-        if end_tid:
-            self._set_noncurrent(oid, start_tid, ofs)
-        else:
-            self.current[oid] = ofs
+        if self._flush_writes:
+            self.f.flush()
 
-        self.currentofs += size
+        for record, ofs in zip(records, offsets):
+            oid, start_tid, end_tid = record[:3]
+            if end_tid:
+                self._set_noncurrent(oid, start_tid, ofs)
+            else:
+                self.current[oid] = ofs
 
+        self.currentofs += nbytes
+
+    ##
+    # Change the size of the cache file while the cache is in use.
+    #
+    # If the cache grows, the new space is added to the end of the file
+    # as free blocks, which are filled when currentofs gets to them.
+    # If it shrinks, the records past the new end of the file are
+    # removed.  Those among the most recently written records that fit in
+    # the new size are written again at currentofs, evicting older
+    # records as store() would, so the warm part of the cache is kept.
+    #
+    # @param size the new size of the cache, divided between the cache
+    #        file and the non-current cache as in __init__
+
+    def resize(self, size):
+        self._wait_for_scan()
+        if self._noncurrent_cache is not None:
+            noncurrent_size = int(size * self.noncurrent_fraction)
+            self._noncurrent_cache.resize(noncurrent_size)
+            size -= noncurrent_size
+        self._resize(size)
+
+    @locked
+    def _resize(self, size):
+        size = max(size, ZEC_HEADER_SIZE)
+        if size == self.maxsize:
+            return
+        logger.info("resizing cache file %r from %s to %s bytes",
+                    self.path, self.maxsize, size)
+        self._drop_journal()
+        self._generation += 1
+        try:
+            self._close_map()
+            self.rearrange = self.rearrange * size / self.maxsize
+            if size > self.maxsize:
+                self._grow(size)
+            else:
+                self._shrink(size)
+            sync(self.f)
+            if self.journal:
+                self._save_index()
+            if self.use_mmap:
+                self._setup_map()
+        finally:
+            self._generation += 1
+
+    def _grow(self, size):
+        f = self.f
+        preallocate(f, size, self.fallocate)
+        f.seek(self.maxsize)
+        nfree = size - self.maxsize
+        for i in range(0, nfree, max_block_size):
+            block_size = min(max_block_size, nfree-i)
+            if block_size > 4:
+                f.write(b'f' + pack(">I", block_size))
+                f.seek(block_size-5, 1)
+            else:
+                f.write("01234"[block_size].encode())
+                f.seek(block_size-1, 1)
+
+        if (isinstance(self.current, ArrayIndex) and
+            self.maxsize < (1<<32) <= size):
+            # Offsets no longer fit in the index's 32-bit array.
+            self.maxsize = size
+            current = self._current_index_type()
+            for oid, ofs in sorted(six.iteritems(self.current)):
+                current[oid] = ofs
+            self.current = current
+
+        self.maxsize = size
+
+    def _shrink(self, size):
+        maxsize = self.maxsize
+
+        # Start at the last record that begins before the new end of the
+        # file, rather than scanning the whole file.
+        start = ZEC_HEADER_SIZE
+        for oid, ofs in six.iteritems(self.current):
+            if start < ofs < size:
+                start = ofs
+        for noncurrent_for_oid in six.itervalues(self.noncurrent):
+            for ofs in noncurrent_for_oid.values():
+                if start < ofs < size:
+                    start = ofs
+
+        # Remove the records past the new end of the file, remembering
+        # how long ago they were written, and find the block, if any,
+        # that crosses it.
+        records = []
+        last = size
+        ofs = start
+        seek = self.f.seek
+        read = self.f.read
+        while ofs < maxsize:
+            seek(ofs)
+            status = read(1)
+            if status == b'a':
+                (block_size, oid, start_tid, end_tid, flags, ldata
+                 ) = unpack(">I8s8s8sHI", read(34))
+                if ofs + block_size > size:
+                    data = read(ldata)
+                    if end_tid == z64:
+                        del self.current[oid]
+                        if self._memory is not None:
+                            self._memory.discard(oid)
+                        end_tid = None
+                    else:
+                        self._del_noncurrent(oid, start_tid)
+                    self._len -= 1
+                    age = (self.currentofs - ofs) % maxsize
+                    records.append((age, (oid, start_tid, end_tid, data,
+                                          block_size, flags)))
+            elif status == b'f':
+                block_size, = unpack(">I", read(4))
+            else:
+                assert status in b'1234'
+                block_size = int(status)
+            if ofs < size < ofs + block_size:
+                last = ofs
+            ofs += block_size
+
+        # Replace the block that crosses the new end with a free block
+        # and cut off the rest.
+        nfree = size - last
+        if nfree:
+            seek(last)
+            if nfree > 4:
+                self.f.write(b'f'+pack(">I", nfree))
+            else:
+                self.f.write("01234"[nfree].encode())
+        seek(size)
+        self.f.truncate()
+        self.maxsize = size
+        if self.currentofs >= last:
+            self.currentofs = ZEC_HEADER_SIZE
+
+        # A ring of the new size would only hold records written less
+        # than its size ago.  Write those again, oldest first, so they
+        # end up in the same order.
+        capacity = size - ZEC_HEADER_SIZE
+        limit = min(max_block_size, capacity)
+        records.sort(key=lambda item: item[0], reverse=True)
+        keep = []
+        for age, record in records:
+            if age < capacity and record[4] < limit:
+                keep.append(record)
+            else:
+                self._n_evicts += 1
+                self._n_evicted_bytes += record[4]
+        self._len += len(keep)
+        self._write_records(keep)
 
     ##
     # If `tid` is None,
@@ -717,6 +2183,33 @@ class ClientCache(object):
     #        or None to forget all cached info about oid.
     @locked
     def invalidate(self, oid, tid):
+        if self._queued:
+            self._invalidate_queued(oid, tid)
+        if self._scanning:
+            self._pending_invalidations.append((oid, tid))
+            return
+        self._invalidate_oid(oid, tid)
+
+    ##
+    # Invalidate several objects at once, as if by calling invalidate()
+    # for each of them, but acquiring the lock only once.
+    #
+    # @param oids an iterable of object ids
+    # @param tid the id of the transaction that wrote new revisions of
+    #        the objects, or None
+
+    @locked
+    def invalidate_many(self, oids, tid):
+        if self._queued:
+            for oid in oids:
+                self._invalidate_queued(oid, tid)
+        if self._scanning:
+            self._pending_invalidations.extend((oid, tid) for oid in oids)
+            return
+        for oid in oids:
+            self._invalidate_oid(oid, tid)
+
+    def _invalidate_oid(self, oid, tid):
         ofs = self.current.get(oid)
         if ofs is None:
             # 0x10 == invalidate (miss)
@@ -730,10 +2223,23 @@ class ClientCache(object):
         size, saved_oid, saved_tid, end_tid = unpack(">I8s8s8s", read(28))
         assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
         assert end_tid == z64, (ofs, self.f.tell(), oid)
+        self._discard_index()
+        self._generation += 1
+        try:
+            self._invalidate(oid, tid, ofs, size, saved_tid)
+        finally:
+            self._generation += 1
+
+    def _invalidate(self, oid, tid, ofs, size, saved_tid):
+        self._journal(b'b', ofs)
         del self.current[oid]
+        if self._memory is not None:
+            self._memory.discard(oid)
         if tid is None:
             self.f.seek(ofs)
             self.f.write(b'f'+pack(">I", size))
+            if self._flush_writes:
+                self.f.flush()
             # 0x1E = invalidate (hit, discarding current or non-current)
             self._trace(0x1E, oid, tid)
             self._len -= 1
@@ -741,18 +2247,50 @@ class ClientCache(object):
             if tid == saved_tid:
                 logger.warning("Ignoring invalidation with same tid as current")
                 return
+            if self.noncurrent_fraction is not None:
+                self._move_noncurrent(oid, tid, ofs, size, saved_tid)
+                return
             self.f.seek(ofs+21)
             self.f.write(tid)
+            if self._flush_writes:
+                self.f.flush()
             self._set_noncurrent(oid, saved_tid, ofs)
             # 0x1C = invalidate (hit, saving non-current)
             self._trace(0x1C, oid, tid)
 
+    def _move_noncurrent(self, oid, tid, ofs, size, saved_tid):
+        # Free the record of a current revision that's no longer
+        # current, after reading it to store it in the non-current
+        # cache, if there is one.
+        noncurrent_cache = self._noncurrent_cache
+        if noncurrent_cache is not None:
+            self.f.seek(ofs+29)
+            read = self.f.read
+            flags, ldata = unpack(">HI", read(6))
+            data = read(ldata)
+            if flags & record_compressed:
+                data = zlib.decompress(data)
+        self.f.seek(ofs)
+        self.f.write(b'f'+pack(">I", size))
+        if self._flush_writes:
+            self.f.flush()
+        self._len -= 1
+        if noncurrent_cache is not None:
+            noncurrent_cache.store(oid, saved_tid, tid, data)
+            # 0x1C = invalidate (hit, saving non-current)
+            self._trace(0x1C, oid, tid)
+        else:
+            # 0x1E = invalidate (hit, discarding current or non-current)
+            self._trace(0x1E, oid, tid)
+
     ##
     # Generates (oid, serial) oairs for all objects in the
     # cache.  This generator is used by cache verification.
     def contents(self):
         # May need to materialize list instead of iterating;
         # depends on whether the caller may change the cache.
+        self._wait_for_scan()
+        self._flush_queue()
         seek = self.f.seek
         read = self.f.read
         for oid, ofs in six.iteritems(self.current):
@@ -797,7 +2335,8 @@ class ClientCache(object):
 
     def _setup_trace(self, path):
         _tracefile = None
-        if path and os.environ.get("ZEO_CACHE_TRACE"):
+        trace = os.environ.get("ZEO_CACHE_TRACE")
+        if path and trace:
             tfn = path + ".trace"
             try:
                 _tracefile = open(tfn, "ab")
@@ -809,10 +2348,24 @@ class ClientCache(object):
         if _tracefile is None:
             return
 
+        if trace == "2":
+            self._setup_trace_v2(_tracefile)
+            return
+
+        writer = cachetrace.TraceWriter(_tracefile)
+        if os.fstat(_tracefile.fileno()).st_size:
+            # The trace may end with version 2 records.
+            writer.write(cachetrace.v1_marker)
+        # writer.write(), inlined:
+        buffer = writer.buffer
+        append = buffer.append
+        buffer_size = writer.buffer_size
         now = time.time
-        def _trace(code, oid=b"", tid=z64, end_tid=z64, dlen=0):
+        def _trace(code, oid=b"", tid=z64, end_tid=z64, dlen=0, clen=None):
             # The code argument is two hex digits; bits 0 and 7 must be zero.
             # The first hex digit shows the operation, the second the outcome.
+            # If the record is compressed, clen is its compressed data
+            # length, which is written after the oid, and bit 0 is set.
             # This method has been carefully tuned to be as fast as possible.
             # Note: when tracing is disabled, this method is hidden by a dummy.
             encoded = (dlen << 8) + code
@@ -820,25 +2373,119 @@ class ClientCache(object):
                 tid = z64
             if end_tid is None:
                 end_tid = z64
-            try:
-                _tracefile.write(
-                    pack(">iiH8s8s",
-                         int(now()), encoded, len(oid), tid, end_tid) + oid,
-                    )
-            except:
-                print(repr(tid), repr(end_tid))
-                raise
+            if clen is not None:
+                encoded |= 1
+                oid_and_clen = oid + pack(">I", clen)
+            else:
+                oid_and_clen = oid
+            append(pack(">iiH8s8s", int(now()), encoded, len(oid), tid, end_tid)
+                   + oid_and_clen)
+            if len(buffer) >= buffer_size:
+                writer.full()
 
         self._trace = _trace
-        self._tracefile = _tracefile
+        self._tracefile = writer
         _trace(0x00)
 
+    ##
+    # Trace with version 2 records (see ZEO.cachetrace), which have
+    # nanosecond timestamps, the thread id and the latency of the
+    # operation.  The public methods that trace are wrapped to note
+    # when each operation started, in a thread local.
+    def _setup_trace_v2(self, tracefile):
+        writer = cachetrace.TraceWriter(tracefile)
+        clock = cachetrace.clock
+        writer.write(cachetrace.v2_marker +
+                     pack(cachetrace.v2_header_format,
+                          int(time.time() * 1e9), clock()))
+        buffer = writer.buffer
+        append = buffer.append
+        buffer_size = writer.buffer_size
+        get_ident = cachetrace.get_ident
+        max_latency = cachetrace.max_latency
+        local = threading.local()
+
+        def _trace(code, oid=b"", tid=z64, end_tid=z64, dlen=0, clen=None):
+            # See the version 1 _trace in _setup_trace.
+            encoded = (dlen << 8) + code
+            if tid is None:
+                tid = z64
+            if end_tid is None:
+                end_tid = z64
+            if clen is not None:
+                encoded |= 1
+                oid_and_clen = oid + pack(">I", clen)
+            else:
+                oid_and_clen = oid
+            record = clock(), encoded, len(oid), tid, end_tid, oid_and_clen
+            pending = getattr(local, 'pending', None)
+            if pending is None:
+                # Not made by a timed method.
+                write(record, 0)
+            else:
+                # Written, with the latency, when the method returns.
+                pending.append(record)
+
+        def write(record, latency):
+            now, encoded, oidlen, tid, end_tid, oid_and_clen = record
+            append(pack(">QiIQH8s8s", now, encoded, min(latency, max_latency),
+                        get_ident(), oidlen, tid, end_tid)
+                   + oid_and_clen)
+            if len(buffer) >= buffer_size:
+                writer.full()
+
+        def timed(method):
+            def timed_method(*args, **kw):
+                if getattr(local, 'pending', None) is not None:
+                    # Called by another timed method.
+                    return method(*args, **kw)
+                local.pending = pending = []
+                started = clock()
+                try:
+                    return method(*args, **kw)
+                finally:
+                    latency = clock() - started
+                    local.pending = None
+                    for record in pending:
+                        write(record, latency)
+            return timed_method
+
+        for name in self._timed_methods:
+            setattr(self, name, timed(getattr(self, name)))
+
+        self._trace = _trace
+        self._tracefile = writer
+        _trace(0x00)
+
+    _timed_methods = ('load', 'loadBefore', 'store', 'store_many',
+                      'invalidate', 'invalidate_many')
+
     def _unsetup_trace(self):
         if self._tracefile is not None:
             del self._trace
+            for name in self._timed_methods:
+                self.__dict__.pop(name, None)
             self._tracefile.close()
             del self._tracefile
 
+##
+# Extend the file `f` to `size` bytes.  If `fallocate` is true and the
+# platform has it, the disk space is allocated with posix_fallocate,
+# which is quick on file systems that support it and tends to give the
+# file few, large extents.  Otherwise, the last byte is written, which
+# may leave a sparse file.
+def preallocate(f, size, fallocate=False):
+    f.flush()
+    if fallocate and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except EnvironmentError:
+            logger.debug("Couldn't preallocate %s bytes for cache file",
+                         size, exc_info=1)
+    f.seek(size - 1)
+    f.write(b'x')
+
 def sync(f):
     f.flush()
 
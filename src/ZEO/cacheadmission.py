@@ -0,0 +1,124 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Admission policies for the client cache.
+
+An admission policy decides whether an object passed to
+ClientCache.store() is worth writing to the cache, where it would push
+other objects out.  A policy provides two methods:
+
+record(oid)
+    Called for every load from the cache, hit or miss.
+
+admit(oid, size)
+    Called before storing an object whose data is `size` bytes long.
+    Returns a true value if the object should be stored.
+
+The same policies are used by cache_simul to estimate their effect on
+the hit rate of a traced workload.
+"""
+from array import array
+import struct
+
+_unpack_oid = struct.Struct(">Q").unpack
+
+class SizeAdmission(object):
+    """Admit objects no larger than `max_size` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+    def record(self, oid):
+        pass
+
+    def admit(self, oid, size):
+        return size <= self.max_size
+
+# Odd multipliers used to hash oids for the rows of the sketch.
+_seeds = (
+    0x9E3779B97F4A7C15,
+    0xC2B2AE3D27D4EB4F,
+    0x165667B19E3779F9,
+    0xD6E8FEB86659FD93,
+    0xFF51AFD7ED558CCD,
+    0xC4CEB9FE1A85EC53,
+    0x94D049BB133111EB,
+    0xBF58476D1CE4E5B9,
+    )
+
+class TinyLFUAdmission(object):
+    """Admit objects that have been loaded often enough recently.
+
+    Load frequencies are estimated with a count-min sketch: `depth` rows
+    of `width` small counters, with each oid hashed to one counter per
+    row.  The estimated frequency of an oid is the smallest of its
+    counters.  After `sample_size` loads, all counters are halved, so
+    that the estimates favor recent loads.
+
+    Objects no larger than `small_size` bytes are always admitted.
+    Objects larger than `max_size` bytes, if given, are never admitted.
+    Other objects are admitted if their estimated frequency is at least
+    `min_frequency`.  Because a load miss is recorded before the missed
+    object is stored, the default `min_frequency` of 2 admits objects on
+    their second load.
+    """
+
+    def __init__(self, min_frequency=2, small_size=0, max_size=None,
+                 width=1<<16, depth=4, sample_size=None):
+        if width & (width - 1):
+            raise ValueError("width must be a power of 2")
+        if not 0 < depth <= len(_seeds):
+            raise ValueError("depth must be between 1 and %d" % len(_seeds))
+        self.min_frequency = min_frequency
+        self.small_size = small_size
+        self.max_size = max_size
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size or width * 10
+        self._shift = 64 - width.bit_length() + 1
+        self._seeds = _seeds[:depth]
+        self._counters = array('B', [0]) * (width * depth)
+        self._samples = 0
+
+    def _positions(self, oid):
+        key = _unpack_oid(oid)[0]
+        shift = self._shift
+        width = self.width
+        return [row * width +
+                (((key * seed) & 0xFFFFFFFFFFFFFFFF) >> shift)
+                for row, seed in enumerate(self._seeds)]
+
+    def frequency(self, oid):
+        counters = self._counters
+        return min([counters[i] for i in self._positions(oid)])
+
+    def record(self, oid):
+        counters = self._counters
+        for i in self._positions(oid):
+            if counters[i] < 255:
+                counters[i] += 1
+        self._samples += 1
+        if self._samples >= self.sample_size:
+            self._age()
+
+    def _age(self):
+        self._counters = array('B', [c >> 1 for c in self._counters])
+        self._samples //= 2
+
+    def admit(self, oid, size):
+        if size <= self.small_size:
+            return True
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return self.frequency(oid) >= self.min_frequency
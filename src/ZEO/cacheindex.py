@@ -0,0 +1,250 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compact index of current objects for the client cache.
+
+ArrayIndex maps 8-byte oids to file offsets, like the fsIndex used by
+default, but keeps its entries in a pair of sorted parallel arrays:
+64-bit oids and, for caches smaller than 4GB, 32-bit offsets.  Changing
+the offset of an oid in the arrays, or deleting it, which leaves a
+marker, is done in place.  New oids are inserted in a second, smaller,
+pair of sorted arrays, the delta, that is merged into the first when it
+gets large relative to them.  No objects are kept per entry.
+
+On CPython, an fsIndex is about as compact and faster to search, so
+ArrayIndex is mainly useful on PyPy, where the default index is a dict,
+which takes several times as much memory.
+"""
+from array import array
+from bisect import bisect_left
+import struct
+
+import six
+
+from ZODB.utils import p64
+
+_unpack_oid = struct.Struct(">Q").unpack
+
+# Python 2 arrays don't support 'Q', but 'L' is 64 bits on most 64-bit
+# platforms.
+if 'Q' in getattr(array, 'typecodes', ''):
+    typecode = 'Q'
+elif array('L').itemsize == 8:
+    typecode = 'L'
+else:
+    typecode = None
+
+# Type code for offsets in files smaller than 4GB
+if array('I').itemsize == 4:
+    small_typecode = 'I'
+else:
+    small_typecode = typecode
+
+class ArrayIndex(object):
+    """Map 8-byte oids to offsets, using sorted arrays plus a delta.
+    """
+
+    # The delta is merged when it has more than this many entries and
+    # more than the square root of the number in the arrays, which
+    # bounds both the cost of inserting into the delta and the cost of
+    # merging per entry.
+    merge_min = 1000
+
+    def __init__(self, max_offset=None):
+        if typecode is None:
+            raise TypeError("ArrayIndex needs 64-bit array support")
+        # - `max_offset`: if given and less than 2**32, offsets are
+        #   stored in 32 bits.
+        self.max_offset = max_offset
+        if max_offset is not None and max_offset < (1<<32):
+            self._offset_typecode = small_typecode
+        else:
+            self._offset_typecode = typecode
+        # The offset of deleted entries in the arrays, which is too
+        # large to be a real one.
+        self._deleted = (1 << (array(self._offset_typecode).itemsize * 8)) - 1
+        self._oids = array(typecode)
+        self._offsets = array(self._offset_typecode)
+        self._delta_oids = array(typecode)
+        self._delta_offsets = array(self._offset_typecode)
+        self._len = 0
+        self._ndeleted = 0
+
+    def __len__(self):
+        return self._len
+
+    def get(self, oid, default=None):
+        key = _unpack_oid(oid)[0]
+        oids = self._oids
+        i = bisect_left(oids, key)
+        if i != len(oids) and oids[i] == key:
+            ofs = self._offsets[i]
+            if ofs == self._deleted:
+                return default
+            return ofs
+        oids = self._delta_oids
+        if oids:
+            i = bisect_left(oids, key)
+            if i != len(oids) and oids[i] == key:
+                return self._delta_offsets[i]
+        return default
+
+    def __getitem__(self, oid):
+        ofs = self.get(oid)
+        if ofs is None:
+            raise KeyError(oid)
+        return ofs
+
+    def __contains__(self, oid):
+        return self.get(oid) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, oid, ofs):
+        key = _unpack_oid(oid)[0]
+        oids = self._oids
+        i = bisect_left(oids, key)
+        if i != len(oids) and oids[i] == key:
+            if self._offsets[i] == self._deleted:
+                self._ndeleted -= 1
+                self._len += 1
+            self._offsets[i] = ofs
+            return
+        delta_oids = self._delta_oids
+        if i == len(oids) and not delta_oids:
+            # Adding entries in order, as when loading a saved index,
+            # doesn't need the delta.
+            oids.append(key)
+            self._offsets.append(ofs)
+            self._len += 1
+            return
+        i = bisect_left(delta_oids, key)
+        if i != len(delta_oids) and delta_oids[i] == key:
+            self._delta_offsets[i] = ofs
+            return
+        delta_oids.insert(i, key)
+        self._delta_offsets.insert(i, ofs)
+        self._len += 1
+        n = len(delta_oids)
+        if n > self.merge_min and n * n > len(oids):
+            self._merge()
+
+    def __delitem__(self, oid):
+        key = _unpack_oid(oid)[0]
+        oids = self._oids
+        i = bisect_left(oids, key)
+        if i != len(oids) and oids[i] == key:
+            if self._offsets[i] == self._deleted:
+                raise KeyError(oid)
+            self._offsets[i] = self._deleted
+            self._ndeleted += 1
+            self._len -= 1
+            if self._ndeleted * 2 > len(oids):
+                self._merge()
+            return
+        delta_oids = self._delta_oids
+        i = bisect_left(delta_oids, key)
+        if i == len(delta_oids) or delta_oids[i] != key:
+            raise KeyError(oid)
+        del delta_oids[i]
+        del self._delta_offsets[i]
+        self._len -= 1
+
+    def clear(self):
+        self.__init__(self.max_offset)
+
+    ##
+    # Drop the deleted entries from the arrays and merge the delta into
+    # them.  New arrays are built, so that iterators over the old ones
+    # aren't disturbed.  Runs of entries between delta entries are
+    # copied with slices.
+    def _merge(self):
+        oids = self._oids
+        offsets = self._offsets
+        if self._ndeleted:
+            deleted = self._deleted
+            live = [i for i, ofs in enumerate(offsets) if ofs != deleted]
+            oids = array(typecode, [oids[i] for i in live])
+            offsets = array(self._offset_typecode, [offsets[i] for i in live])
+        delta_oids = self._delta_oids
+        if delta_oids:
+            delta_offsets = self._delta_offsets
+            old_oids = oids
+            old_offsets = offsets
+            oids = array(typecode)
+            offsets = array(self._offset_typecode)
+            start = 0
+            for j, key in enumerate(delta_oids):
+                i = bisect_left(old_oids, key, start)
+                oids.extend(old_oids[start:i])
+                offsets.extend(old_offsets[start:i])
+                oids.append(key)
+                offsets.append(delta_offsets[j])
+                start = i
+            oids.extend(old_oids[start:])
+            offsets.extend(old_offsets[start:])
+        self._oids = oids
+        self._offsets = offsets
+        self._delta_oids = array(typecode)
+        self._delta_offsets = array(self._offset_typecode)
+        self._ndeleted = 0
+
+    def iteritems(self):
+        """Generate (oid, offset) pairs in oid order.
+
+        The index may be changed while iterating; changes made after
+        iteration started may or may not be reflected.
+        """
+        oids = self._oids
+        offsets = self._offsets
+        deleted = self._deleted
+        delta_oids = self._delta_oids[:]
+        delta_offsets = self._delta_offsets[:]
+        n = len(oids)
+        i = 0
+        for j, key in enumerate(delta_oids):
+            while i < n and oids[i] < key:
+                ofs = offsets[i]
+                if ofs != deleted:
+                    yield p64(oids[i]), ofs
+                i += 1
+            yield p64(key), delta_offsets[j]
+        while i < n:
+            ofs = offsets[i]
+            if ofs != deleted:
+                yield p64(oids[i]), ofs
+            i += 1
+
+    def iterkeys(self):
+        for oid, ofs in self.iteritems():
+            yield oid
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for oid, ofs in self.iteritems():
+            yield ofs
+
+    if six.PY3:
+        items = iteritems
+        keys = iterkeys
+        values = itervalues
+    else:
+        def items(self):
+            return list(self.iteritems())
+
+        def keys(self):
+            return list(self.iterkeys())
+
+        def values(self):
+            return list(self.itervalues())
@@ -0,0 +1,83 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""In-memory tier of the client cache.
+
+MemoryCache holds the data and tid of current object revisions in
+memory, so that the hottest objects can be loaded without reading the
+cache file.  It's bounded by the total size of the data it holds and
+evicts the least recently used objects first.
+
+ClientCache keeps it coherent: it only holds objects that are current
+in the cache file, and it's told about every invalidation and eviction.
+"""
+from collections import OrderedDict
+import threading
+
+class MemoryCache(object):
+    """LRU map of oids to (data, tid), holding at most `max_size` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        # Public, so callers can make a check and a change atomically.
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, oid, before_tid=None):
+        """Return (data, tid) for `oid` if it was written before `before_tid`.
+        """
+        with self.lock:
+            result = self._data.pop(oid, None)
+            if result is None:
+                self.misses += 1
+                return None
+            # Move it to the most recently used end:
+            self._data[oid] = result
+            if before_tid and result[1] >= before_tid:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return result
+
+    def put(self, oid, data, tid):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            old = self._data.pop(oid, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._data[oid] = data, tid
+            self.size += len(data)
+            while self.size > self.max_size:
+                evicted_oid, (evicted, _) = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, oid):
+        with self.lock:
+            old = self._data.pop(oid, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+            self.size = 0
+
+    def clearStats(self):
+        self.hits = self.misses = 0
@@ -0,0 +1,102 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Access profiles of the client cache.
+
+A persistent ClientCache with a `profile_size` counts the loads of each
+object and, when it's closed, saves the oids of the most often loaded
+objects to a profile file, named after the cache file with ".profile"
+appended.  When the cache is reopened, the saved oids are its `profile`,
+which a ClientStorage uses to warm the cache up: objects in the cache
+file are read, so they're in the operating system's page cache, and the
+others are loaded from the server.
+
+The profile file is the 4-byte magic number, ZCP1, followed by the
+8-byte oids, most often loaded first.  Profiles can also be made from
+cache traces with the cache_stats script.
+"""
+import heapq
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+profile_magic = b"ZCP1"
+
+class AccessCounter(object):
+    """Count loads by oid, to find the `size` most often loaded objects.
+
+    After `sample_size` loads, which defaults to 10 times `size`, the
+    counts are halved, and oids with a count of 0 are dropped, so that
+    recent loads count more and memory use is bounded.
+    """
+
+    def __init__(self, size, sample_size=None):
+        self.size = size
+        self.sample_size = sample_size or size * 10
+        self._counts = {}
+        self._samples = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def record(self, oid):
+        # This is called without a lock, so counts are approximate.
+        counts = self._counts
+        counts[oid] = counts.get(oid, 0) + 1
+        self._samples += 1
+        if self._samples >= self.sample_size:
+            self._age()
+
+    def _age(self):
+        self._samples = 0
+        self._counts = dict((oid, count >> 1)
+                            for oid, count in list(self._counts.items())
+                            if count > 1)
+
+    def hottest(self, n=None):
+        """Return the oids of the `n`, or `size`, most often loaded objects.
+        """
+        counts = list(self._counts.items())
+        return [oid for oid, count in heapq.nlargest(
+            n or self.size, counts, key=lambda item: item[1])]
+
+def read_profile(path):
+    """Return the oids in a profile file, or an empty list.
+    """
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] != profile_magic or len(data) % 8 != 4:
+            raise ValueError("Bad cache profile file")
+    except Exception:
+        logger.warning("Ignoring bad cache profile file %r.", path,
+                       exc_info=1)
+        return []
+    return [data[i:i+8] for i in range(4, len(data), 8)]
+
+def write_profile(path, oids):
+    """Write a profile file, replacing any existing one.
+    """
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(profile_magic + b''.join(oids))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        logger.warning("Couldn't save cache profile file %r", path,
+                       exc_info=1)
@@ -0,0 +1,203 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Client cache trace files.
+
+If the ZEO_CACHE_TRACE environment variable is set, a persistent
+ClientCache writes a record of each cache operation to a trace file,
+named after the cache file with ".trace" appended.  The trace can be
+analyzed with the cache_stats and cache_simul scripts.
+
+There are two record formats.  Version 1 records, written unless
+ZEO_CACHE_TRACE is "2", have a timestamp in whole seconds (see
+ZEO/scripts/cache_stats.py).  Version 2 records are::
+
+    Offset  Size  Contents
+
+    0       8     timestamp, in nanoseconds, from a monotonic clock
+    8       4     data size and code, as in version 1
+    12      4     latency, in nanoseconds, of the operation that made
+                  the record, at most 2**32-1
+    16      8     thread id
+    24      2     object id length
+    26      8     start tid
+    34      8     end tid
+    42  variable  object id
+
+followed, as in version 1, by the compressed data size if bit 0 of the
+code is set.  Each time a cache starts writing version 2 records, it
+writes the 8-byte `v2_marker`, followed by the wall clock time and the
+monotonic time, both in nanoseconds, so that timestamps can be
+converted to wall clock time.  When version 1 records are appended to a
+non-empty trace, they're preceded by `v1_marker`.  Both markers start
+with 4 zero bytes, which readers that don't know about version 2 skip
+as a misaligned record.
+
+Records are written to a buffer that a writer thread flushes to the
+file, so that tracing doesn't make cache operations wait for file
+writes.
+"""
+import collections
+import struct
+import threading
+import time
+
+from six.moves import _thread
+
+v1_format = ">iiH8s8s"
+v1_size = struct.calcsize(v1_format)
+v2_format = ">QiIQH8s8s"
+v2_size = struct.calcsize(v2_format)
+v1_marker = b'\0\0\0\0ZT1\n'
+v2_marker = b'\0\0\0\0ZT2\n'
+v2_header_format = ">QQ"
+v2_header_size = struct.calcsize(v2_header_format)
+
+max_latency = (1 << 32) - 1
+
+if hasattr(time, 'monotonic_ns'):
+    clock = time.monotonic_ns
+elif hasattr(time, 'monotonic'):
+    def clock():
+        return int(time.monotonic() * 1e9)
+else:
+    def clock():
+        return int(time.time() * 1e9)
+
+get_ident = _thread.get_ident
+
+class TraceWriter(object):
+    """Write trace records to a file from a writer thread.
+
+    Records are appended to a deque, which needs no lock, until the
+    writer thread, which wakes up every `flush_interval` seconds, or
+    when `buffer_size` records are buffered, writes them.  If twice as
+    many are buffered, because the writer can't keep up, the thread
+    adding a record writes them.
+    """
+
+    def __init__(self, f, buffer_size=1<<14, flush_interval=1.0):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque()
+        self._closing = False
+        self._condition = threading.Condition(threading.Lock())
+        # Held while writing, so that records are written in order.
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name="cache trace writer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def write(self, record):
+        # ClientCache inlines this.
+        buffer = self.buffer
+        buffer.append(record)
+        if len(buffer) >= self.buffer_size:
+            self.full()
+
+    def full(self):
+        if len(self.buffer) < 2 * self.buffer_size:
+            with self._condition:
+                self._condition.notify()
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            popleft = self.buffer.popleft
+            records = [popleft() for i in range(len(self.buffer))]
+            if records:
+                self.f.write(b''.join(records))
+                self.f.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if (not self._closing and
+                    len(self.buffer) < self.buffer_size):
+                    self._condition.wait(self.flush_interval)
+                closing = self._closing
+            if closing:
+                # close() writes whatever is left.
+                return
+            self.flush()
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+        self.f.close()
+
+def read_trace(f, skipped=None):
+    """Generate the records in a trace file of either format.
+
+    Records are (ts, code, oid, start_tid, end_tid, clen, thread,
+    latency) tuples.  `ts` is the time in seconds since the epoch, an
+    int for version 1 records and a float for version 2 records.  `code`
+    is the 4-byte code and data size, as written.  `clen` is the
+    compressed data size, or None.  `thread` and `latency`, in
+    nanoseconds, are None for version 1 records.
+
+    If a record looks misaligned, because of a crash while writing the
+    trace, 8 bytes are skipped, and `skipped` is called with the offset
+    of the record, if given.
+    """
+    read = f.read
+    unpack = struct.unpack
+    v2 = False
+    wall = mono = 0
+    # Bytes read that are part of the next record.
+    pending = b''
+    while 1:
+        size = v2_size if v2 else v1_size
+        r = pending + read(size - len(pending))
+        pending = b''
+        if len(r) < size:
+            break
+        if r[:8] == v2_marker:
+            wall, mono = struct.unpack_from(v2_header_format, r, 8)
+            pending = r[8+v2_header_size:]
+            v2 = True
+            continue
+        if r[:8] == v1_marker:
+            pending = r[8:]
+            v2 = False
+            continue
+        if v2:
+            ts, code, latency, thread, oidlen, start_tid, end_tid = unpack(
+                v2_format, r)
+            ts = (wall + ts - mono) / 1e9
+        else:
+            ts, code, oidlen, start_tid, end_tid = unpack(v1_format, r)
+            thread = latency = None
+            if ts == 0:
+                # Must be a misaligned record caused by a crash.
+                # Why skip 8 bytes?  Lost in the mist of history.
+                if skipped is not None:
+                    skipped(f.tell() - size)
+                pending = r[8:]
+                continue
+        oid = read(oidlen)
+        if len(oid) < oidlen:
+            break
+        clen = None
+        if code & 0x01:
+            r = read(4)
+            if len(r) < 4:
+                break
+            clen, = unpack(">I", r)
+        yield ts, code, oid, start_tid, end_tid, clen, thread, latency
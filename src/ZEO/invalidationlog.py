@@ -0,0 +1,262 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""On-disk logs of the invalidations of a served storage.
+
+A StorageServer with an `invalidation_log_dir` appends the oids
+modified by each transaction of a storage to a log file in that
+directory, so that clients can do quick verification even if they were
+disconnected for longer than the in-memory invalidation queue covers,
+or across server restarts.
+
+The log file is the 4-byte magic number, ZIL1, followed by the base
+tid, the log being complete for the transactions after it, and then a
+record for each transaction: the 8-byte tid, the 4-byte number of oids
+and the 8-byte oids.  The tids and offsets of the records are kept in
+memory, so the records for the transactions after a tid are found with
+a binary search.  Records older than the retention limits, by size or
+by age, are dropped by rewriting the file once they make up half of it.
+
+The storage commits a transaction before it's logged, so if the server
+stops in between, the log misses the last transactions.  When the log
+is opened, missing transactions are read from the storage's iterator.
+If they can't be, or if the log is ahead of the storage, as when a
+storage is restored from a backup, the log is started over.
+"""
+import bisect
+import logging
+import os
+import struct
+import threading
+import time
+
+import ZODB.TimeStamp
+from ZODB.utils import p64, u64, z64
+
+logger = logging.getLogger(__name__)
+
+log_magic = b"ZIL1"
+header_size = 12
+record_header_size = 12
+
+class InvalidationLog(object):
+    """An append-only, tid-indexed log of a storage's invalidations.
+
+    Records are kept up to `max_size` bytes, if it isn't None, and, if
+    `max_age` is given, for `max_age` seconds.
+    """
+
+    def __init__(self, path, max_size=10 << 20, max_age=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._tids = []
+        self._offsets = []
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            try:
+                self._read()
+            except ValueError:
+                logger.warning("Starting over bad invalidation log %r",
+                               path, exc_info=True)
+                self._start(z64)
+        else:
+            self._file = open(path, 'w+b')
+            self._start(z64)
+
+    def _read(self):
+        f = self._file
+        f.seek(0)
+        header = f.read(header_size)
+        if len(header) < header_size or header[:4] != log_magic:
+            raise ValueError("Bad invalidation log header")
+        self._base = header[4:]
+        size = os.fstat(f.fileno()).st_size
+        offset = header_size
+        last_tid = self._base
+        while offset + record_header_size <= size:
+            tid, n = struct.unpack(">8sI", f.read(record_header_size))
+            end = offset + record_header_size + n * 8
+            if end > size:
+                break
+            if tid <= last_tid:
+                raise ValueError("Out of order tid in invalidation log")
+            last_tid = tid
+            self._tids.append(tid)
+            self._offsets.append(offset)
+            f.seek(end)
+            offset = end
+        if offset < size:
+            # The server stopped while a record was being written.
+            logger.warning("Truncating incomplete record at %d in %r",
+                           offset, self.path)
+            f.truncate(offset)
+        self._end = offset
+
+    def _start(self, base):
+        # Start the log over, complete for the transactions after base.
+        f = self._file
+        f.seek(0)
+        f.write(log_magic + base)
+        f.truncate(header_size)
+        f.flush()
+        self._base = base
+        self._tids = []
+        self._offsets = []
+        self._end = header_size
+
+    @property
+    def last_tid(self):
+        tids = self._tids
+        return tids[-1] if tids else self._base
+
+    def catch_up(self, storage):
+        """Log the storage's transactions that aren't in the log yet.
+
+        If the log is ahead of the storage, or the transactions can't be
+        read, the log is started over at the storage's last transaction.
+        """
+        storage_tid = storage.lastTransaction() or z64
+        with self._lock:
+            last_tid = self.last_tid
+            if last_tid == storage_tid:
+                return
+            if last_tid < storage_tid and last_tid != z64:
+                try:
+                    n = 0
+                    for t in storage.iterator(p64(u64(last_tid) + 1)):
+                        self._append(t.tid, set(r.oid for r in t))
+                        n += 1
+                except Exception:
+                    logger.warning("Couldn't catch up invalidation log %r",
+                                   self.path, exc_info=True)
+                else:
+                    if self.last_tid == storage_tid:
+                        logger.info("Caught up %d transactions in "
+                                    "invalidation log %r", n, self.path)
+                        self._file.flush()
+                        return
+            logger.info("Starting over invalidation log %r", self.path)
+            self._start(storage_tid)
+
+    def clear(self, tid):
+        """Start the log over, at the given last transaction id.
+        """
+        with self._lock:
+            self._start(tid)
+
+    def append(self, tid, oids):
+        """Log the oids invalidated by a transaction.
+        """
+        with self._lock:
+            if tid <= self.last_tid:
+                return
+            self._append(tid, oids)
+            self._file.flush()
+            self._check_retention()
+
+    def _append(self, tid, oids):
+        f = self._file
+        f.seek(self._end)
+        f.write(struct.pack(">8sI", tid, len(oids)) + b''.join(oids))
+        self._tids.append(tid)
+        self._offsets.append(self._end)
+        self._end = f.tell()
+
+    def _cutoff(self):
+        # Return the index of the first record to keep.
+        i = 0
+        if self.max_size:
+            i = bisect.bisect_left(self._offsets, self._end - self.max_size)
+        if self.max_age:
+            t = time.gmtime(time.time() - self.max_age)
+            cutoff_tid = ZODB.TimeStamp.TimeStamp(*t[:6]).raw()
+            i = max(i, bisect.bisect_left(self._tids, cutoff_tid))
+        return i
+
+    def _check_retention(self):
+        # Drop the records before the cutoff when they're at least half
+        # of the file, so each byte is copied a bounded number of times.
+        i = self._cutoff()
+        if not i:
+            return
+        start = (self._offsets[i] if i < len(self._offsets)
+                 else self._end)
+        if (start - header_size) * 2 < self._end - header_size:
+            return
+        self._compact(i, start)
+
+    def _compact(self, i, start):
+        f = self._file
+        f.seek(start)
+        data = f.read(self._end - start)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as new:
+                new.write(log_magic + self._tids[i-1] + data)
+            # The file has to be closed and removed first on Windows.
+            f.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            logger.warning("Couldn't compact invalidation log %r",
+                           self.path, exc_info=1)
+            if f.closed:
+                self._reopen()
+            return
+        self._file = open(self.path, 'r+b')
+        self._base = self._tids[i-1]
+        shift = start - header_size
+        self._tids = self._tids[i:]
+        self._offsets = [offset - shift for offset in self._offsets[i:]]
+        self._end -= shift
+
+    def _reopen(self):
+        # Reopen the log after a failed compaction.  If the file was
+        # removed, the log is started over.
+        if os.path.exists(self.path):
+            self._file = open(self.path, 'r+b')
+        else:
+            self._file = open(self.path, 'w+b')
+            self._start(self.last_tid)
+
+    def since(self, tid):
+        """Return the last tid and the oids invalidated after a tid.
+
+        None is returned if the log isn't complete for the transactions
+        after the tid.
+        """
+        with self._lock:
+            if tid < self._base:
+                return None
+            i = bisect.bisect_right(self._tids, tid)
+            if i == len(self._tids):
+                return self.last_tid, []
+            f = self._file
+            f.seek(self._offsets[i])
+            data = f.read(self._end - self._offsets[i])
+            last_tid = self._tids[-1]
+        oids = set()
+        offset = 0
+        while offset < len(data):
+            n = struct.unpack(">I", data[offset+8:offset+12])[0]
+            offset += record_header_size
+            oids.update(data[j:j+8] for j in range(offset, offset + n*8, 8))
+            offset += n * 8
+        return last_tid, list(oids)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -104,6 +104,10 @@ class ZEOOptionsMixin:
         self.add("invalidation_queue_size", "zeo.invalidation_queue_size",
                  default=100)
         self.add("invalidation_age", "zeo.invalidation_age")
+        self.add("invalidation_log_dir", "zeo.invalidation_log_dir")
+        self.add("invalidation_log_size", "zeo.invalidation_log_size",
+                 default=10 << 20)
+        self.add("invalidation_log_age", "zeo.invalidation_log_age")
         self.add("transaction_timeout", "zeo.transaction_timeout",
                  "t:", "timeout=", float)
         self.add("monitor_address", "zeo.monitor_address.address",
@@ -350,6 +354,9 @@ def create_server(storages, options):
         read_only = options.read_only,
         invalidation_queue_size = options.invalidation_queue_size,
         invalidation_age = options.invalidation_age,
+        invalidation_log_dir = options.invalidation_log_dir,
+        invalidation_log_size = options.invalidation_log_size,
+        invalidation_log_age = options.invalidation_log_age,
         transaction_timeout = options.transaction_timeout,
         monitor_address = options.monitor_address,
         auth_protocol = options.auth_protocol,
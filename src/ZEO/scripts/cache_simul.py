@@ -22,14 +22,22 @@ Note:
 
 - The simulation will be far off if the trace file
   was created starting with a non-empty cache
+
+- Stores rejected by the traced cache's admission policy are simulated
+  like other stores.  Use --admission to simulate an admission policy.
+
+- Objects are simulated at their uncompressed sizes.  If the traced
+  cache compressed records, --compressed simulates them at their
+  compressed sizes instead, to estimate the effect of compression.
 """
 from __future__ import print_function, absolute_import
 
 import bisect
-import struct
 import re
 import sys
 import ZEO.cache
+import ZEO.cacheadmission
+import ZEO.cachetrace
 import argparse
 
 from ZODB.utils import z64
@@ -56,6 +64,25 @@ def main(args=None):
     parser.add_argument("--rearrange", "-r",
                         default=0.8, type=float,
                         help="rearrange factor")
+    parser.add_argument("--admission", "-a",
+                        choices=("size", "tinylfu"),
+                        help="simulate an admission policy"
+                        " (see ZEO.cacheadmission)")
+    parser.add_argument("--max-object-size",
+                        type=int, default=None,
+                        help="size, in bytes, of the largest object admitted")
+    parser.add_argument("--small-object-size",
+                        type=int, default=0,
+                        help="size, in bytes, of objects always admitted"
+                        " by the tinylfu policy")
+    parser.add_argument("--min-frequency",
+                        type=int, default=2,
+                        help="recent loads needed for the tinylfu policy"
+                        " to admit an object")
+    parser.add_argument("--compressed", "-c",
+                        default=False, action="store_true",
+                        help="use compressed object sizes recorded in the"
+                        " trace")
     add_tracefile_argument(parser)
 
     simclass = CircularCacheSimulation
@@ -65,39 +92,37 @@ def main(args=None):
     f = options.tracefile
     interval_step = options.interval
 
+    def admission():
+        if options.admission == 'size':
+            if options.max_object_size is None:
+                parser.error("--max-object-size is required for"
+                             " the size policy")
+            return ZEO.cacheadmission.SizeAdmission(options.max_object_size)
+        elif options.admission == 'tinylfu':
+            return ZEO.cacheadmission.TinyLFUAdmission(
+                min_frequency=options.min_frequency,
+                small_size=options.small_object_size,
+                max_size=options.max_object_size)
+
     # Create simulation object.
-    sim = simclass(options.cachelimit, options.rearrange)
-    interval_sim = simclass(options.cachelimit, options.rearrange)
+    sim = simclass(options.cachelimit, options.rearrange, admission())
+    interval_sim = simclass(options.cachelimit, options.rearrange,
+                            admission())
 
     # Print output header.
     sim.printheader()
 
     # Read trace file, simulating cache behavior.
-    f_read = f.read
-    unpack = struct.unpack
-    FMT = ">iiH8s8s"
-    FMT_SIZE = struct.calcsize(FMT)
-    assert FMT_SIZE == 26
-
     last_interval = None
-    while 1:
-        # Read a record and decode it.
-        r = f_read(FMT_SIZE)
-        if len(r) < FMT_SIZE:
-            break
-        ts, code, oidlen, start_tid, end_tid = unpack(FMT, r)
-        if ts == 0:
-            # Must be a misaligned record caused by a crash; skip 8 bytes
-            # and try again.  Why 8?  Lost in the mist of history.
-            f.seek(f.tell() - FMT_SIZE + 8)
-            continue
-        oid = f_read(oidlen)
-        if len(oid) < oidlen:
-            break
+    for (ts, code, oid, start_tid, end_tid, clen, thread, latency
+         ) in ZEO.cachetrace.read_trace(f):
         # Decode the code.
-        dlen, version, code = ((code & 0x7fffff00) >> 8,
-                               code & 0x80,
-                               code & 0x7e)
+        dlen, version, compressed, code = ((code & 0x7fffff00) >> 8,
+                                           code & 0x80,
+                                           code & 0x01,
+                                           code & 0x7e)
+        if compressed and options.compressed:
+            dlen = clen
         # And pass it to the simulation.
         this_interval = int(ts) // interval_step
         if this_interval != last_interval:
@@ -125,9 +150,10 @@ class Simulation(object):
     finish() method also calls report().
     """
 
-    def __init__(self, cachelimit, rearrange):
+    def __init__(self, cachelimit, rearrange, admission=None):
         self.cachelimit = cachelimit
         self.rearrange = rearrange
+        self.admission = admission
         # Initialize global statistics.
         self.epoch = None
         self.warm = False
@@ -135,8 +161,11 @@ class Simulation(object):
         self.total_hits = 0       # subclass must increment
         self.total_invals = 0     # subclass must increment
         self.total_writes = 0
+        self.total_rejects = 0
         if not hasattr(self, "extras"):
             self.extras = (self.extraname,)
+        if admission is not None:
+            self.extras += ("rejects",)
         self.format = self.format + " %7s" * len(self.extras)
         # Reset per-run statistics and set up simulation data.
         self.restart()
@@ -147,6 +176,7 @@ class Simulation(object):
         self.hits = 0       # subclass must increment
         self.invals = 0     # subclass must increment
         self.writes = 0
+        self.rejects = 0
         self.ts0 = None
 
     def event(self, ts, dlen, _version, code, oid,
@@ -169,12 +199,19 @@ class Simulation(object):
             # Load.
             self.loads += 1
             self.total_loads += 1
+            if self.admission is not None:
+                self.admission.record(oid)
             # Asserting that dlen is 0 iff it's a load miss.
             # assert (dlen == 0) == (code in (0x20, 0x24))
             self.load(oid, dlen, start_tid, code)
         elif action & 0x40:
             # Store.
             assert dlen
+            if (self.admission is not None and
+                not self.admission.admit(oid, dlen)):
+                self.rejects += 1
+                self.total_rejects += 1
+                return
             self.write(oid, dlen, start_tid, end_tid)
         elif action & 0x10:
             # Invalidate.
@@ -284,10 +321,10 @@ class CircularCacheSimulation(Simulation):
 
     evicts = 0
 
-    def __init__(self, cachelimit, rearrange):
+    def __init__(self, cachelimit, rearrange, admission=None):
         from ZEO import cache
 
-        Simulation.__init__(self, cachelimit, rearrange)
+        Simulation.__init__(self, cachelimit, rearrange, admission)
         self.total_evicts = 0  # number of cache evictions
 
         # Current offset in file.
@@ -16,6 +16,10 @@ from __future__ import print_function
 
 File format:
 
+This is the format of version 1 trace records.  Traces can also hold
+version 2 records, with nanosecond timestamps, thread ids and latencies
+(see ZEO.cachetrace); both are read.
+
 Each record is 26 bytes, plus a variable number of bytes to store an oid,
 with the following layout.  Numbers are big-endian integers.
 
@@ -35,10 +39,14 @@ Mask    bits  Contents
 
 0x80    1     set if there was a non-empty version string
 0x7e    6     function and outcome code
-0x01    1     current cache file (0 or 1)
+0x01    1     set if the record is compressed
+
+If the record is compressed, the object id is followed by 4 more bytes
+holding the size of the compressed data.  The data size at offset 4 is
+the uncompressed size.
 
-The "current cache file" bit is no longer used; it refers to a 2-file
-cache scheme used before ZODB 3.3.
+Before ZODB 3.3, bit 0x01 was the "current cache file" bit of a 2-file
+cache scheme.
 
 The function and outcome codes are documented in detail at the end of
 this file in the 'explain' dictionary.  Note that the keys there (and
@@ -55,6 +63,9 @@ import gzip
 from time import ctime
 import six
 
+import ZEO.cacheprofile
+import ZEO.cachetrace
+
 def add_interval_argument(parser):
     def _interval(a):
         interval = int(60 * float(a))
@@ -111,6 +122,12 @@ def main(args=None):
                         default=False, action="store_true", dest="heuristic",
                         help=" enable heuristic checking for misaligned records: oids > 2**32"
                         " will be rejected; this requires the tracefile to be seekable")
+    parser.add_argument("--profile", "-p", default=None, metavar="FILE",
+                        help="save the oids of the most often loaded objects"
+                        " to a cache profile file (see ZEO.cacheprofile)")
+    parser.add_argument("--profile-size", default=10000, type=int,
+                        help="number of oids to save to the profile"
+                        " (default 10000)")
     add_interval_argument(parser)
     add_tracefile_argument(parser)
 
@@ -129,6 +146,9 @@ def main(args=None):
     versions = 0    # number of trace records with versions
     datarecords = 0 # number of records with dlen set
     datasize = 0   # sum of dlen across records with dlen set
+    compressed = 0  # number of records with compressed data
+    compressed_dlen = 0  # sum of dlen across compressed records
+    compressed_clen = 0  # sum of compressed data sizes
     oids = {}       # map oid to number of times it was loaded
     bysize = {}     # map data size to number of loads
     bysizew = {}    # map data size to number of writes
@@ -138,29 +158,16 @@ def main(args=None):
     h0 = None       # timestamp at start of current interval
     he = None       # timestamp at end of current interval
     thisinterval = None  # generally te//interval
-    f_read = f.read
-    unpack = struct.unpack
-    FMT = ">iiH8s8s"
-    FMT_SIZE = struct.calcsize(FMT)
-    assert FMT_SIZE == 26
+    latencies = {}  # map code to (count, total latency in ns)
+    def skipped(offset):
+        if not options.quiet:
+            print("Skipping 8 bytes at offset", offset)
     # Read file, gathering statistics, and printing each record if verbose.
     print(' '*16, "%7s %7s %7s %7s" % ('loads', 'hits', 'inv(h)', 'writes'), end=' ')
     print('hitrate')
     try:
-        while 1:
-            r = f_read(FMT_SIZE)
-            if len(r) < FMT_SIZE:
-                break
-            ts, code, oidlen, start_tid, end_tid = unpack(FMT, r)
-            if ts == 0:
-                # Must be a misaligned record caused by a crash.
-                if not options.quiet:
-                    print("Skipping 8 bytes at offset", f.tell() - FMT_SIZE)
-                    f.seek(f.tell() - FMT_SIZE + 8)
-                continue
-            oid = f_read(oidlen)
-            if len(oid) < oidlen:
-                break
+        for (ts, code, oid, start_tid, end_tid, clen, thread, latency
+             ) in ZEO.cachetrace.read_trace(f, skipped):
             records += 1
             if t0 is None:
                 t0 = ts
@@ -178,6 +185,10 @@ def main(args=None):
             if dlen:
                 datarecords += 1
                 datasize += dlen
+            if clen is not None:
+                compressed += 1
+                compressed_dlen += dlen
+                compressed_clen += clen
             if code & 0x80:
                 version = 'V'
                 versions += 1
@@ -186,22 +197,29 @@ def main(args=None):
             code &= 0x7e
             bycode[code] = bycode.get(code, 0) + 1
             byinterval[code] = byinterval.get(code, 0) + 1
+            if latency is not None:
+                n, total = latencies.get(code, (0, 0))
+                latencies[code] = n + 1, total + latency
             if dlen:
                 if code & 0x70 == 0x20: # All loads
                     bysize[dlen] = d = bysize.get(dlen) or {}
                     d[oid] = d.get(oid, 0) + 1
-                elif code & 0x70 == 0x50: # All stores
+                elif code & 0x70 == 0x50 and code != 0x56: # All stores
                     bysizew[dlen] = d = bysizew.get(dlen) or {}
                     d[oid] = d.get(oid, 0) + 1
             if options.verbose:
-                print("%s %02x %s %016x %016x %c%s" % (
+                print("%s %02x %s %016x %016x %c%s%s%s" % (
                     ctime(ts)[4:-5],
                     code,
                     oid_repr(oid),
                     U64(start_tid),
                     U64(end_tid),
                     version,
-                    dlen and (' '+str(dlen)) or ""))
+                    dlen and (' '+str(dlen)) or "",
+                    clen is not None and ('/'+str(clen)) or "",
+                    thread is not None and (
+                        " thread %x %.1fus" % (thread, latency / 1000.0)
+                        ) or ""))
             if code & 0x70 == 0x20:
                 oids[oid] = oids.get(oid, 0) + 1
                 total_loads += 1
@@ -236,11 +254,16 @@ def main(args=None):
         print("Versions:   %s records used a version" % addcommas(versions))
         print("First time: %s" % ctime(t0))
         print("Last time:  %s" % ctime(te))
-        print("Duration:   %s seconds" % addcommas(te-t0))
+        print("Duration:   %s seconds" % addcommas(int(te-t0)))
         print("Data recs:  %s (%.1f%%), average size %d bytes" % (
             addcommas(datarecords),
             100.0 * datarecords / records,
             datasize / datarecords))
+        if compressed:
+            print("Compressed: %s records, %s bytes compressed to %s (%.1f%%)"
+                  % (addcommas(compressed), addcommas(compressed_dlen),
+                     addcommas(compressed_clen),
+                     100.0 * compressed_clen / compressed_dlen))
         print("Hit rate:   %.1f%% (load hits / loads)" % hitrate(bycode))
         print()
         codes = sorted(bycode.keys())
@@ -250,6 +273,20 @@ def main(args=None):
                 addcommas(bycode.get(code, 0)),
                 code,
                 explain.get(code) or "*** unknown code ***"))
+        if latencies:
+            print()
+            print("%13s %4s %s" % ("Count", "Code", "Mean latency"))
+            for code in sorted(latencies):
+                n, total = latencies[code]
+                print("%13s  %02x  %.1fus" % (
+                    addcommas(n), code, total / 1000.0 / n))
+
+    if options.profile:
+        ZEO.cacheprofile.write_profile(
+            options.profile,
+            [oid for oid, count in sorted(six.iteritems(oids),
+                                          key=lambda item: -item[1])
+             if len(oid) == 8][:options.profile_size])
 
     # Print histogram.
     if options.print_histogram:
@@ -301,7 +338,8 @@ def dumpbyinterval(byinterval, h0, he):
             if code in (0x22, 0x26):
                 hits += n
         elif code & 0x40:
-            writes +=  byinterval[code]
+            if code != 0x56:
+                writes +=  byinterval[code]
         elif code & 0x10:
             if code != 0x10:
                 invals += byinterval[code]
@@ -375,6 +413,7 @@ explain = {
     0x50: "store (version)",
     0x52: "store (current, non-version)",
     0x54: "store (non-current)",
+    0x56: "store (rejected by admission policy)",
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Client cache split over several segment files.
+
+SegmentedClientCache provides the ClientCache API, but divides the
+cache among a number of ClientCache segments, each with its own file,
+ring pointer, index and lock.  Objects are assigned to segments by oid,
+so all revisions of an object are in the same segment.
+
+Because segments are independent, they're opened, and their files
+scanned if need be, in parallel, and stores and loads of objects in
+different segments don't wait for each other.  Each segment file is
+1/n of the cache size, so large caches don't need a single large file.
+
+To use a segmented cache with a ClientStorage, set ClientCacheClass in
+a subclass::
+
+    class MyClientStorage(ZEO.ClientStorage.ClientStorage):
+        ClientCacheClass = ZEO.segmentedcache.SegmentedClientCache
+"""
+import sys
+import threading
+
+import six
+from ZODB.utils import u64, z64
+
+from .cache import ClientCache, ZEC_HEADER_SIZE
+
+def segment_path(path, segment, segments):
+    """Return the file name of a segment of a persistent cache.
+
+    The number of segments is part of the name, so that a cache reopened
+    with a different number of segments, which would assign objects to
+    segments differently, doesn't use the old segment files.
+    """
+    return "%s.%d-of-%d" % (path, segment, segments)
+
+class SegmentedClientCache(object):
+    """A client cache made of `segments` ClientCache segments.
+
+    Other keyword arguments are passed to each segment.  If an admission
+    policy is given, it's shared by the segments.  A `memory_size` and
+    a `write_behind_size` are divided among them, like `size`.
+    """
+
+    def __init__(self, path=None, size=200*1024**2, segments=4, **options):
+        self.path = path
+        self.segments = segments
+        segment_size = max(size // segments, ZEC_HEADER_SIZE)
+        self.maxsize = segment_size * segments
+        for option in 'memory_size', 'write_behind_size':
+            if options.get(option):
+                options[option] = max(options[option] // segments, 1)
+
+        if path:
+            paths = [segment_path(path, i, segments)
+                     for i in range(segments)]
+        else:
+            paths = [None] * segments
+        self._segments = self._open(paths, segment_size, options)
+
+        # The last tid is the oldest one saved by a segment.  They differ
+        # only if we crashed while setting it.  Segments that are ahead
+        # have seen invalidations the others have missed, so the cache
+        # as a whole is only known to be up to date as of the oldest one.
+        # Empty segments don't hold anything that could be out of date.
+        self.tid = min([segment.getLastTid() for segment in self._segments
+                        if len(segment)] or
+                       [segment.getLastTid() for segment in self._segments])
+        self._lock = threading.Lock()
+
+    def _open(self, paths, size, options):
+        # Open the segments in parallel, as they may have to be scanned.
+        opened = [None] * len(paths)
+        errors = []
+        def open_segment(i):
+            try:
+                opened[i] = ClientCache(paths[i], size=size, **options)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        if len(paths) == 1:
+            open_segment(0)
+        else:
+            threads = [threading.Thread(target=open_segment, args=(i,),
+                                        name="open cache segment %d" % i)
+                       for i in range(len(paths))]
+            for thread in threads:
+                thread.setDaemon(True)
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            for segment in opened:
+                if segment is not None:
+                    segment.close()
+            six.reraise(*errors[0])
+
+        return opened
+
+    # Backward compatibility, as for ClientCache.
+    @property
+    def fc(self):
+        return self
+
+    def _segment(self, oid):
+        return self._segments[u64(oid) % self.segments]
+
+    def _by_segment(self, items):
+        # Split (oid, ...) items by segment, keeping their order.
+        by_segment = {}
+        for item in items:
+            i = u64(item[0]) % self.segments
+            by_segment.setdefault(i, []).append(item)
+        return sorted(six.iteritems(by_segment))
+
+    def clear(self):
+        for segment in self._segments:
+            segment.clear()
+
+    def clearStats(self):
+        for segment in self._segments:
+            segment.clearStats()
+
+    def getStats(self):
+        return tuple(map(sum, zip(*(segment.getStats()
+                                    for segment in self._segments))))
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments)
+
+    def __bool__(self):
+        return any(self._segments)
+
+    __nonzero__ = __bool__
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+    def resize(self, size):
+        segment_size = max(size // self.segments, ZEC_HEADER_SIZE)
+        for segment in self._segments:
+            segment.resize(segment_size)
+        self.maxsize = segment_size * self.segments
+
+    def setLastTid(self, tid):
+        if (not tid) or (tid == z64):
+            return
+        with self._lock:
+            if (tid <= self.tid) and len(self):
+                if tid == self.tid:
+                    return
+                raise ValueError("new last tid (%s) must be greater than "
+                                 "previous one (%s)"
+                                 % (u64(tid), u64(self.tid)))
+            for segment in self._segments:
+                # Segments may be ahead after a crash.  See __init__.
+                if tid > segment.getLastTid() or not len(segment):
+                    segment.setLastTid(tid)
+            self.tid = tid
+
+    def getLastTid(self):
+        return self.tid
+
+    def load(self, oid, before_tid=None):
+        return self._segment(oid).load(oid, before_tid)
+
+    def loadBefore(self, oid, before_tid):
+        return self._segment(oid).loadBefore(oid, before_tid)
+
+    def store(self, oid, start_tid, end_tid, data):
+        self._segment(oid).store(oid, start_tid, end_tid, data)
+
+    def store_many(self, items):
+        for i, items in self._by_segment(items):
+            self._segments[i].store_many(items)
+
+    def invalidate(self, oid, tid):
+        self._segment(oid).invalidate(oid, tid)
+
+    def invalidate_many(self, oids, tid):
+        for i, oids in self._by_segment([(oid,) for oid in oids]):
+            self._segments[i].invalidate_many([oid for (oid,) in oids], tid)
+
+    @property
+    def profile(self):
+        # Interleave the segments' profiles, which are hottest first.
+        profiles = [segment.profile for segment in self._segments]
+        result = []
+        for i in range(max(map(len, profiles))):
+            for profile in profiles:
+                if i < len(profile):
+                    result.append(profile[i])
+        return result
+
+    def warm(self, oids):
+        missing = []
+        for i, oids in self._by_segment([(oid,) for oid in oids]):
+            missing.extend(self._segments[i].warm([oid for (oid,) in oids]))
+        return missing
+
+    def contents(self):
+        for segment in self._segments:
+            for item in segment.contents():
+                yield item
@@ -0,0 +1,555 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Client cache shared by the processes on a host.
+
+A ClientCache file is locked by the process using it, so each worker
+process on a host has its own cache, holding its own copy of the hot
+objects.  SharedClientCache provides the ClientCache API, for a cache
+file that any number of processes can use at the same time, so that
+objects loaded by one of them are cache hits for the others.
+
+The file is memory mapped by each process and holds all of the cache's
+state: a header, a hash table mapping oids to records, and a ring of
+records, managed like a ClientCache file.  Changes are made with an
+exclusive flock of the file held, and bracketed by increments of a
+generation counter in the header.  Loads don't lock: they read the
+generation, look the oid up and read the record, and try again with the
+lock held if the generation was odd or has changed.  If a process dies
+while changing the cache, the generation is left odd, and the next
+process to change it clears it.
+
+Only current revisions are cached.  Each process still has its own
+last tid, as processes see transactions at different times:
+
+- A record written by a process that has seen more transactions than
+  the loading one, so that it may be newer than what the loading
+  process can see, isn't loaded.
+
+- The header has the greatest tid of the invalidations and last tids
+  any process has given the cache.  A store by a process that hasn't
+  seen as many transactions, and so may not know that the object was
+  invalidated since, is ignored.
+
+Every process applies the invalidations it gets from the server, so an
+invalidation applied by the first process to get it applies to all.
+Invalidations of records written by later transactions are ignored.
+
+To use a shared cache with a ClientStorage, give the storages of the
+processes sharing it the same client name, and set ClientCacheClass in a
+subclass::
+
+    class MyClientStorage(ZEO.ClientStorage.ClientStorage):
+        ClientCacheClass = ZEO.sharedcache.SharedClientCache
+
+This needs flock and mmap, so it's only available on POSIX systems.
+"""
+from struct import pack, pack_into, unpack_from
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+from ZODB.utils import u64, z64
+
+from .cache import locked, max_block_size
+
+logger = logging.getLogger(__name__)
+
+magic = b"ZSC1"
+
+# Header:
+#     4 bytes magic
+#     4 bytes padding
+#     8 bytes generation
+#     8 bytes tid, the greatest tid given to the cache
+#     8 bytes offset of the next record to be written
+#     8 bytes number of records
+#     8 bytes number of hash table slots, a power of 2
+#     8 bytes size of the ring of records
+header_size = 64
+header_format = ">4s4xQ8sQQQQ"
+generation_offset = 8
+tid_offset = 16
+currentofs_offset = 24
+count_offset = 32
+
+# The hash table follows the header.  A slot is an oid and the offset
+# of its record in the file, or 0 if the slot is empty.  Collisions are
+# resolved by linear probing.
+slot_size = 16
+
+# The ring follows the hash table.  It's made of blocks that are
+# records or free blocks, at least `min_block_size` bytes long:
+#
+#     1 byte status, b'a' for records, b'f' for free blocks
+#     4 byte block size
+#
+# followed, for records, by:
+#
+#     8 byte oid
+#     8 byte tid
+#     4 byte data size
+#     data
+record_header_format = ">cI8s8sI"
+record_header_size = 25
+min_block_size = 5
+
+# Stores are ignored if they'd make the hash table fuller than this.
+max_load = .75
+
+def hash_oid(oid):
+    return ((u64(oid) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32
+
+class FileLock(object):
+    """A lock held by one thread of one process at a time.
+
+    Threads of the process are excluded by a thread lock, and other
+    processes by an exclusive flock of the file.  Like RLock, the lock
+    can be acquired again by the thread holding it.
+    """
+
+    def __init__(self, f):
+        import fcntl
+        self._flock = fcntl.flock
+        self._LOCK_EX = fcntl.LOCK_EX
+        self._LOCK_UN = fcntl.LOCK_UN
+        self._fileno = f.fileno()
+        self._lock = threading.RLock()
+        self._count = 0
+
+    def acquire(self):
+        self._lock.acquire()
+        if not self._count:
+            try:
+                self._flock(self._fileno, self._LOCK_EX)
+            except:
+                self._lock.release()
+                raise
+        self._count += 1
+
+    def release(self):
+        self._count -= 1
+        if not self._count:
+            self._flock(self._fileno, self._LOCK_UN)
+        self._lock.release()
+
+class SharedClientCache(object):
+    """A client cache in a file that processes on a host share.
+
+    `size` is the size of the ring of records.  The hash table has a
+    slot for each `slot_bytes` bytes of it, so that it can hold that
+    many records, of that average size, less `max_load`.  If the file
+    exists, the size and slots of the cache in it are used.
+    """
+
+    def __init__(self, path=None, size=200*1024**2, slot_bytes=256):
+        self.path = path
+        if path:
+            self.f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666),
+                               'r+b')
+        else:
+            self.f = tempfile.TemporaryFile()
+        self._lock = FileLock(self.f)
+        self.clearStats()
+
+        self._lock.acquire()
+        try:
+            if not self._valid():
+                self._create(size, slot_bytes)
+            else:
+                logger.info("using shared cache file %r", path)
+            (_, _, tid, _, _, capacity, ringsize) = self._read_header()
+            self._map = mmap.mmap(self.f.fileno(), 0)
+        finally:
+            self._lock.release()
+
+        self._capacity = capacity
+        self._ring_start = header_size + capacity * slot_size
+        self._ring_end = self._ring_start + ringsize
+        self.maxsize = ringsize
+
+        # The last tid of this process.  All the invalidations the
+        # cache got up to the tid in the header have been applied, so
+        # that's where we start.
+        self.tid = tid
+
+    def _read_header(self):
+        self.f.seek(0)
+        return unpack_from(header_format, self.f.read(header_size))
+
+    def _valid(self):
+        self.f.seek(0, 2)
+        fsize = self.f.tell()
+        if fsize < header_size:
+            return False
+        (file_magic, _, _, _, _, capacity, ringsize) = self._read_header()
+        return (file_magic == magic and
+                fsize == header_size + capacity * slot_size + ringsize)
+
+    def _create(self, size, slot_bytes):
+        capacity = 1024
+        while capacity * slot_bytes < size:
+            capacity *= 2
+        f = self.f
+        f.seek(0)
+        f.truncate()
+        ring_start = header_size + capacity * slot_size
+        # The magic is written last, so that the file isn't used if we
+        # don't get that far.
+        f.write(pack(header_format, b'\0' * 4, 0, z64, ring_start, 0,
+                     capacity, size))
+        # The hash table is zeros, which are empty slots.
+        f.truncate(ring_start + size)
+        for ofs, n in _free_blocks(ring_start, ring_start + size):
+            f.seek(ofs)
+            f.write(b'f' + pack(">I", n))
+        f.flush()
+        f.seek(0)
+        f.write(magic)
+        f.flush()
+        logger.info("created shared cache file %r", self.path)
+
+    # Backward compatibility, as for ClientCache.
+    @property
+    def fc(self):
+        return self
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._begin()
+            self._reset()
+            self._end()
+        finally:
+            self._lock.release()
+
+    # Empty the cache.  The tid in the header is kept, as other
+    # processes may still store objects that were loaded before
+    # invalidations they haven't seen.
+    def _reset(self):
+        m = self._map
+        m[header_size:self._ring_start] = b'\0' * (
+            self._ring_start - header_size)
+        for ofs, n in _free_blocks(self._ring_start, self._ring_end):
+            m[ofs:ofs+min_block_size] = b'f' + pack(">I", n)
+        pack_into(">QQ", m, currentofs_offset, self._ring_start, 0)
+
+    def clearStats(self):
+        self._n_adds = self._n_added_bytes = 0
+        self._n_evicts = self._n_evicted_bytes = 0
+        self._n_accesses = 0
+        self._n_rejects = self._n_rejected_bytes = 0
+
+    def getStats(self):
+        return (self._n_adds, self._n_added_bytes,
+                self._n_evicts, self._n_evicted_bytes,
+                self._n_accesses,
+                self._n_rejects, self._n_rejected_bytes,
+                0, 0,
+               )
+
+    def __len__(self):
+        return unpack_from(">Q", self._map, count_offset)[0]
+
+    def close(self):
+        m = self._map
+        if m is not None:
+            self._map = None
+            m.flush()
+            m.close()
+            self.f.close()
+
+    ##
+    # Changes to the file are made with the lock held, between _begin()
+    # and _end(), which make the generation odd while they're made.
+    def _begin(self):
+        m = self._map
+        generation, = unpack_from(">Q", m, generation_offset)
+        if generation & 1:
+            logger.critical("A process died while changing shared cache "
+                            "file %r, clearing it.", self.path)
+            generation += 1
+            pack_into(">Q", m, generation_offset, generation)
+            self._reset()
+        pack_into(">Q", m, generation_offset, generation + 1)
+
+    def _end(self):
+        m = self._map
+        generation, = unpack_from(">Q", m, generation_offset)
+        pack_into(">Q", m, generation_offset, generation + 1)
+
+    def _shared_tid(self):
+        return self._map[tid_offset:tid_offset+8]
+
+    def _update_shared_tid(self, tid):
+        if tid > self._shared_tid():
+            self._map[tid_offset:tid_offset+8] = tid
+
+    @locked
+    def setLastTid(self, tid):
+        if (not tid) or (tid == z64):
+            return
+        if tid > self.tid:
+            self.tid = tid
+        self._update_shared_tid(tid)
+
+    def getLastTid(self):
+        return self.tid
+
+    ##
+    # Hash table
+    def _find(self, oid):
+        # Return the slot of oid, and the offset of its record, or
+        # the slot for it, and 0 if it isn't in the table.
+        m = self._map
+        mask = self._capacity - 1
+        i = hash_oid(oid) & mask
+        for n in range(self._capacity):
+            sofs = header_size + i * slot_size
+            ofs, = unpack_from(">Q", m, sofs + 8)
+            if not ofs or m[sofs:sofs+8] == oid:
+                return i, ofs
+            i = (i + 1) & mask
+        raise ValueError("shared cache hash table is full")
+
+    def _set_slot(self, i, oid, ofs):
+        sofs = header_size + i * slot_size
+        self._map[sofs:sofs+slot_size] = oid + pack(">Q", ofs)
+
+    def _remove_slot(self, i):
+        # Remove the entry in slot i, moving the entries after it that
+        # can't be found otherwise back.
+        m = self._map
+        mask = self._capacity - 1
+        j = i
+        while 1:
+            j = (j + 1) & mask
+            sofs = header_size + j * slot_size
+            ofs, = unpack_from(">Q", m, sofs + 8)
+            if not ofs:
+                break
+            oid = m[sofs:sofs+8]
+            k = hash_oid(oid) & mask
+            # The entry can stay if its home slot, k, is cyclically in
+            # (i, j].
+            if i <= j:
+                if i < k <= j:
+                    continue
+            elif k > i or k <= j:
+                continue
+            self._set_slot(i, oid, ofs)
+            i = j
+        self._set_slot(i, z64, 0)
+
+    def _set_count(self, delta):
+        m = self._map
+        count, = unpack_from(">Q", m, count_offset)
+        pack_into(">Q", m, count_offset, count + delta)
+
+    ##
+    # Loads
+    def load(self, oid, before_tid=None):
+        result = self._read(oid)
+        if result is None:
+            return None
+        data, tid = result
+        if tid > self.tid:
+            # The record is from a transaction this process hasn't
+            # seen, so it might not be what the server would send us.
+            return None
+        if before_tid and tid >= before_tid:
+            return None
+        self._n_accesses += 1
+        return data, tid
+
+    def loadBefore(self, oid, before_tid):
+        result = self.load(oid, before_tid)
+        if result is None:
+            return None
+        return result[0], result[1], None
+
+    def _read(self, oid):
+        m = self._map
+        for attempt in range(3):
+            generation, = unpack_from(">Q", m, generation_offset)
+            if generation & 1:
+                break
+            try:
+                result = self._read_record(oid)
+            except Exception:
+                # We read a change being made.
+                result = None
+            if unpack_from(">Q", m, generation_offset)[0] == generation:
+                return result
+
+        self._lock.acquire()
+        try:
+            if unpack_from(">Q", m, generation_offset)[0] & 1:
+                self._begin()
+                self._end()
+            return self._read_record(oid)
+        finally:
+            self._lock.release()
+
+    def _read_record(self, oid):
+        i, ofs = self._find(oid)
+        if not ofs:
+            return None
+        m = self._map
+        status, size, saved_oid, tid, ldata = unpack_from(
+            record_header_format, m, ofs)
+        if status != b'a' or saved_oid != oid:
+            return None
+        dofs = ofs + record_header_size
+        return m[dofs:dofs+ldata], tid
+
+    ##
+    # Stores
+    def store(self, oid, start_tid, end_tid, data):
+        self.store_many(((oid, start_tid, end_tid, data), ))
+
+    @locked
+    def store_many(self, items):
+        m = self._map
+        started = False
+        try:
+            for oid, start_tid, end_tid, data in items:
+                if end_tid is not None:
+                    # Only current revisions are cached.
+                    continue
+                size = record_header_size + len(data)
+                if (size >= min(max_block_size, self.maxsize) or
+                    max(self.tid, start_tid) < self._shared_tid() or
+                    len(self) + 1 > max_load * self._capacity):
+                    # Too big, or the object may have been invalidated
+                    # by a transaction we haven't seen, or no room in
+                    # the hash table.
+                    self._n_rejects += 1
+                    self._n_rejected_bytes += size
+                    continue
+                if self._find(oid)[1]:
+                    continue
+                if not started:
+                    self._begin()
+                    started = True
+                ofs, size = self._makeroom(size)
+                m[ofs:ofs+record_header_size] = pack(
+                    record_header_format, b'a', size, oid, start_tid,
+                    len(data))
+                dofs = ofs + record_header_size
+                m[dofs:dofs+len(data)] = data
+                self._set_slot(self._find(oid)[0], oid, ofs)
+                self._set_count(1)
+                self._n_adds += 1
+                self._n_added_bytes += size
+        finally:
+            if started:
+                self._end()
+
+    # Evict the blocks at the next offset, wrapping around the end of
+    # the ring if need be, until there are at least nbytes.  Return the
+    # offset and size of the block for the new record, which is nbytes,
+    # plus any bytes left over that are too few for a free block.
+    def _makeroom(self, nbytes):
+        m = self._map
+        ofs, = unpack_from(">Q", m, currentofs_offset)
+        if ofs + nbytes > self._ring_end:
+            end = ofs
+            while end < self._ring_end:
+                end += self._evict(end)
+            for free_ofs, n in _free_blocks(ofs, end):
+                m[free_ofs:free_ofs+min_block_size] = b'f' + pack(">I", n)
+            ofs = self._ring_start
+        end = ofs
+        while end - ofs < nbytes:
+            end += self._evict(end)
+        left = end - ofs - nbytes
+        if left >= min_block_size:
+            m[ofs+nbytes:ofs+nbytes+min_block_size] = b'f' + pack(">I", left)
+        else:
+            nbytes += left
+        pack_into(">Q", m, currentofs_offset, ofs + nbytes)
+        return ofs, nbytes
+
+    def _evict(self, ofs):
+        # Evict the block at ofs, if it's a record, and return its size.
+        m = self._map
+        status, size = unpack_from(">cI", m, ofs)
+        if status == b'a':
+            oid = m[ofs+5:ofs+13]
+            i, record_ofs = self._find(oid)
+            if record_ofs == ofs:
+                self._remove_slot(i)
+                self._set_count(-1)
+            self._n_evicts += 1
+            self._n_evicted_bytes += size
+        else:
+            assert status == b'f', (ofs, status)
+        return size
+
+    ##
+    # Invalidations
+    def invalidate(self, oid, tid):
+        self.invalidate_many((oid, ), tid)
+
+    @locked
+    def invalidate_many(self, oids, tid):
+        if tid is not None:
+            self._update_shared_tid(tid)
+        m = self._map
+        started = False
+        try:
+            for oid in oids:
+                i, ofs = self._find(oid)
+                if not ofs:
+                    continue
+                if tid is not None and m[ofs+13:ofs+21] >= tid:
+                    # Another process already stored the new revision.
+                    continue
+                if not started:
+                    self._begin()
+                    started = True
+                m[ofs:ofs+1] = b'f'
+                self._remove_slot(i)
+                self._set_count(-1)
+        finally:
+            if started:
+                self._end()
+
+    ##
+    # Generate (oid, tid) pairs for the objects in the cache.
+    def contents(self):
+        self._lock.acquire()
+        try:
+            m = self._map
+            items = []
+            for i in range(self._capacity):
+                sofs = header_size + i * slot_size
+                ofs, = unpack_from(">Q", m, sofs + 8)
+                if ofs:
+                    items.append((m[sofs:sofs+8], m[ofs+13:ofs+21]))
+        finally:
+            self._lock.release()
+        return iter(items)
+
+def _free_blocks(start, end):
+    # Generate (offset, size) of free blocks to cover start to end, none
+    # of them smaller than min_block_size or bigger than max_block_size.
+    while start < end:
+        n = min(end - start, max_block_size)
+        if 0 < end - start - n < min_block_size:
+            n -= min_block_size
+        yield start, n
+        start += n
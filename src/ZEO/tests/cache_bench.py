@@ -0,0 +1,255 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Client cache benchmarks
+
+Usage: python -m ZEO.tests.cache_bench BENCHMARK [options]
+
+Benchmarks:
+
+    hits       Cache hit throughput as the number of reading threads
+               grows, for the locked, memory-mapped and concurrent read
+               modes of ClientCache.
+
+    index      Memory use and lookup speed of the indexes that can be
+               used for current objects: fsIndex, ArrayIndex and dict.
+               Each index is built in a separate process, both in oid
+               order, as when a saved index file is loaded, and in
+               random order, as when the cache file is scanned.
+
+    create     Time to create new persistent caches of various sizes,
+               with the file space allocated by posix_fallocate and by
+               writing the last byte of the file, and to fill them.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import random2 as random
+from ZODB.utils import p64
+import ZODB.fsIndex
+
+import ZEO.cache
+import ZEO.cacheindex
+
+def populate(cache, count, size):
+    data = b'x' * size
+    tid = p64(1)
+    for i in range(count):
+        cache.store(p64(i), tid, None, data)
+
+def hits(args):
+    parser = argparse.ArgumentParser(prog="cache_bench hits")
+    parser.add_argument('--objects', '-n', type=int, default=10000,
+                        help="number of objects in the cache")
+    parser.add_argument('--object-size', '-s', type=int, default=500,
+                        help="size of object records")
+    parser.add_argument('--threads', '-t', default='1,2,4,8,16',
+                        help="comma-separated numbers of reading threads")
+    parser.add_argument('--duration', '-d', type=float, default=2.0,
+                        help="seconds to run each measurement")
+    options = parser.parse_args(args)
+    thread_counts = [int(t) for t in options.threads.split(',')]
+    cache_size = options.objects * (options.object_size + 100) + (1 << 20)
+
+    modes = (
+        ('locked', {}),
+        ('mmap', dict(use_mmap=True)),
+        ('concurrent', dict(concurrent_reads=True)),
+        ('concurrent+mmap', dict(concurrent_reads=True, use_mmap=True)),
+        )
+
+    print("%-16s" % 'threads', end='')
+    for nthreads in thread_counts:
+        print("%12d" % nthreads, end='')
+    print("  (hits/second)")
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for name, kw in modes:
+            path = os.path.join(tmp, name)
+            cache = ZEO.cache.ClientCache(path, cache_size, **kw)
+            populate(cache, options.objects, options.object_size)
+            print("%-16s" % name, end='')
+            for nthreads in thread_counts:
+                rate = measure_hits(cache, options.objects, nthreads,
+                                    options.duration)
+                print("%12d" % rate, end='')
+                sys.stdout.flush()
+            print()
+            cache.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def measure_hits(cache, count, nthreads, duration):
+    stop = []
+    counts = []
+
+    def read(seed):
+        randint = random.Random(seed).randint
+        load = cache.load
+        n = 0
+        while not stop:
+            for i in range(100):
+                load(p64(randint(0, count-1)))
+            n += 100
+        counts.append(n)
+
+    threads = [threading.Thread(target=read, args=(i,))
+               for i in range(nthreads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.append(1)
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.time() - start)
+
+index_types = dict(
+    fsIndex=ZODB.fsIndex.fsIndex,
+    ArrayIndex=ZEO.cacheindex.ArrayIndex,
+    dict=dict,
+    )
+
+def index(args):
+    parser = argparse.ArgumentParser(prog="cache_bench index")
+    parser.add_argument('--objects', '-n', type=int, default=1000000,
+                        help="number of index entries")
+    parser.add_argument('--types', '-t', default='fsIndex,ArrayIndex,dict',
+                        help="comma-separated index types")
+    options = parser.parse_args(args)
+
+    print("%d entries" % options.objects)
+    print("%-12s %-8s %12s %12s %12s" % (
+        'index', 'order', 'bytes/entry', 'build secs', 'lookups/sec'))
+    for name in options.types.split(','):
+        for order in 'sorted', 'random':
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'ZEO.tests.cache_bench',
+                 'index-child', name, order, str(options.objects)])
+            size, build, lookups = output.split()
+            print("%-12s %-8s %12.1f %12.2f %12d" % (
+                name, order, float(size) / options.objects, float(build),
+                float(lookups)))
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def index_child(args):
+    name, order, count = args
+    count = int(count)
+    rand = random.Random(0)
+    # Oids of cached objects are scattered over a larger range.
+    oids = [p64(oid) for oid in rand.sample(range(count*4), count)]
+    if order == 'sorted':
+        oids.sort()
+    probes = [rand.choice(oids) for i in range(100000)]
+    start_rss = rss()
+    start = time.time()
+    if name == 'ArrayIndex':
+        index = ZEO.cacheindex.ArrayIndex(1<<30)
+    else:
+        index = index_types[name]()
+    ofs = ZEO.cache.ZEC_HEADER_SIZE
+    for oid in oids:
+        index[oid] = ofs
+        ofs += 100
+    build = time.time() - start
+    size = rss() - start_rss
+
+    get = index.get
+    start = time.time()
+    for oid in probes:
+        get(oid)
+    lookups = len(probes) / (time.time() - start)
+    print(size, build, lookups)
+
+def parse_size(size):
+    size = size.upper()
+    for suffix, multiplier in (('K', 1<<10), ('M', 1<<20), ('G', 1<<30)):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * multiplier)
+    return int(size)
+
+def create(args):
+    parser = argparse.ArgumentParser(prog="cache_bench create")
+    parser.add_argument('--sizes', '-s', default='100M,1G,10G',
+                        help="comma-separated cache sizes")
+    parser.add_argument('--fill', '-f', type=int, default=1000,
+                        help="number of 1MB objects to store after creating"
+                        " each cache, or 0")
+    parser.add_argument('--dir', '-d', default=None,
+                        help="directory to create the caches in")
+    options = parser.parse_args(args)
+
+    print("%-8s %-10s %12s %12s" % ('size', 'allocation', 'create secs',
+                                    'fill secs'))
+    tmp = tempfile.mkdtemp(dir=options.dir)
+    data = b'x' * (1<<20)
+    tid = p64(1)
+    try:
+        for size in options.sizes.split(','):
+            nbytes = parse_size(size)
+            for name, fallocate in (('fallocate', True), ('last byte', False)):
+                if fallocate and not hasattr(os, 'posix_fallocate'):
+                    continue
+                path = os.path.join(tmp, 'cache')
+                start = time.time()
+                cache = ZEO.cache.ClientCache(path, nbytes,
+                                              fallocate=fallocate)
+                created = time.time() - start
+                start = time.time()
+                for i in range(min(options.fill, nbytes >> 20)):
+                    cache.store(p64(i), tid, None, data)
+                ZEO.cache.sync(cache.f)
+                filled = time.time() - start
+                cache.close()
+                for suffix in ('', '.index', '.lock'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                print("%-8s %-10s %12.3f %12.3f" % (size, name, created,
+                                                    filled))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp)
+
+benchmarks = {
+    'create': create,
+    'hits': hits,
+    'index': index,
+    'index-child': index_child,
+    }
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if not args or args[0] not in benchmarks:
+        print(__doc__)
+        return 2
+    return benchmarks[args[0]](args[1:])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -42,6 +42,9 @@ class ZEOConfig:
         self.read_only = None
         self.invalidation_queue_size = None
         self.invalidation_age = None
+        self.invalidation_log_dir = None
+        self.invalidation_log_size = None
+        self.invalidation_log_age = None
         self.monitor_address = None
         self.transaction_timeout = None
         self.authentication_protocol = None
@@ -58,6 +61,12 @@ class ZEOConfig:
             print("invalidation-queue-size", self.invalidation_queue_size, file=f)
         if self.invalidation_age is not None:
             print("invalidation-age", self.invalidation_age, file=f)
+        if self.invalidation_log_dir is not None:
+            print("invalidation-log-dir", self.invalidation_log_dir, file=f)
+        if self.invalidation_log_size is not None:
+            print("invalidation-log-size", self.invalidation_log_size, file=f)
+        if self.invalidation_log_age is not None:
+            print("invalidation-log-age", self.invalidation_log_age, file=f)
         if self.monitor_address is not None:
             print("monitor-address %s:%s" % self.monitor_address, file=f)
         if self.transaction_timeout is not None:
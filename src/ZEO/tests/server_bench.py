@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2016 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Storage server benchmarks
+
+Usage: python -m ZEO.tests.server_bench BENCHMARK [options]
+
+Benchmarks:
+
+    invalidations
+               Time to queue a transaction's invalidations to each
+               client as the number of clients grows, with the message
+               encoded for each client, as ZEO used to, and encoded
+               once and shared by the clients.  With --hmac, the time
+               each connection takes to frame the queued messages,
+               with a MAC, when they're written, is included.
+"""
+from __future__ import print_function
+
+import argparse
+import hmac
+import struct
+import sys
+import time
+
+from ZODB.utils import p64
+
+import ZEO.hash
+import ZEO.StorageServer
+import ZEO.zrpc.marshal
+
+class Connection:
+    """A server connection that queues messages instead of sending them.
+    """
+
+    closed = False
+
+    def __init__(self, key=None):
+        self.encode = ZEO.zrpc.marshal.encode
+        self.output = []
+        if key:
+            self.hmac = hmac.HMAC(key, digestmod=ZEO.hash)
+        else:
+            self.hmac = None
+
+    def callAsyncNoSend(self, method, *args):
+        self.message_output(self.encode(0, 1, method, args))
+
+    def callAsyncMessageNoSend(self, message):
+        self.message_output(message)
+
+    def message_output(self, message):
+        self.output.append(message)
+
+    def call_from_thread(self):
+        pass
+
+    def write(self):
+        # Frame the queued messages, as smac does when writing them.
+        for message in self.output:
+            if self.hmac is not None:
+                struct.pack(">I", len(message) | 0x80000000)
+                self.hmac.update(message)
+                self.hmac.digest()
+            else:
+                struct.pack(">I", len(message))
+        del self.output[:]
+
+def invalidations(args):
+    parser = argparse.ArgumentParser(prog="server_bench invalidations")
+    parser.add_argument('--oids', '-n', type=int, default=1000,
+                        help="number of oids invalidated by a transaction")
+    parser.add_argument('--clients', '-c', default='1,10,100,300',
+                        help="comma-separated numbers of clients")
+    parser.add_argument('--transactions', '-t', type=int, default=20,
+                        help="number of transactions to time")
+    parser.add_argument('--hmac', action='store_true',
+                        help="frame messages with a MAC")
+    options = parser.parse_args(args)
+    client_counts = [int(c) for c in options.clients.split(',')]
+    oids = [p64(i) for i in range(options.oids)]
+    key = b'x' * 20 if options.hmac else None
+
+    def per_client(stubs, tid):
+        for stub in stubs:
+            stub.rpc.callAsyncNoSend('invalidateTransaction', tid, oids)
+
+    def encode_once(stubs, tid):
+        for stub in stubs:
+            stub.invalidateTransaction(tid, oids)
+
+    print("%-12s %14s %14s  (ms/transaction)"
+          % ('clients', 'per-client', 'encode-once'))
+    for nclients in client_counts:
+        print("%-12d" % nclients, end='')
+        for send in (per_client, encode_once):
+            stubs = [ZEO.StorageServer.ClientStub(Connection(key))
+                     for i in range(nclients)]
+            start = time.time()
+            for i in range(options.transactions):
+                send(stubs, p64(i + 1))
+                for stub in stubs:
+                    stub.rpc.write()
+            elapsed = time.time() - start
+            print(" %14.3f" % (elapsed * 1000 / options.transactions),
+                  end='')
+            sys.stdout.flush()
+        print()
+
+benchmarks = {
+    'invalidations': invalidations,
+    }
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if not args or args[0] not in benchmarks:
+        print(__doc__)
+        return 2
+    return benchmarks[args[0]](args[1:])
+
+if __name__ == '__main__':
+    sys.exit(main())
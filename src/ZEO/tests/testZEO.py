@@ -1401,6 +1401,329 @@ You can specify the client label via a configuration file as well:
 
     """
 
+def cache_warm_up_from_profile():
+    """
+A client with a persistent cache can save a profile of the objects it
+loads most often, so that its cache can be warmed up when it restarts.
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> conn = db.open()
+    >>> for i in range(5):
+    ...     conn.root()[i] = MinPO(i)
+    >>> transaction.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(5)]
+    >>> db.close()
+
+    >>> client = ClientStorage(addr, client='warm', cache_profile_size=3)
+    >>> for oid in oids[1:] + oids[2:] + oids[2:3]:
+    ...     _ = client.load(oid)
+    >>> client.close()
+
+    >>> import ZEO.cacheprofile
+    >>> profile = ZEO.cacheprofile.read_profile('warm-1.zec.profile')
+    >>> profile[0] == oids[2], sorted(profile) == oids[2:]
+    (True, True)
+
+Even if the cache file is lost, the profiled objects are loaded from the
+server when the client is restarted:
+
+    >>> os.remove('warm-1.zec')
+    >>> client = ClientStorage(addr, client='warm', cache_profile_size=3)
+    >>> wait_until("warmed up",
+    ...            lambda: not client._warm_cache_thread.is_alive())
+    >>> sorted(oid for (oid, tid) in client._cache.contents()) == oids[2:]
+    True
+    >>> client.close()
+
+Closing the client stops the warm-up, even if the closed connection
+is still used to load a batch:
+
+    >>> os.remove('warm-1.zec')
+    >>> loading = threading.Event()
+    >>> class DisconnectingClientStorage(ClientStorage):
+    ...     def loadBeforeMany(self, oid_tids):
+    ...         loading.set()
+    ...         while self._rpc_mgr is not None:
+    ...             time.sleep(.01)
+    ...         raise DisconnectedError()
+    >>> client = DisconnectingClientStorage(
+    ...     addr, client='warm', cache_profile_size=3)
+    >>> loading.wait(30)
+    True
+    >>> thread = threading.Thread(target=client.close)
+    >>> thread.setDaemon(True)
+    >>> thread.start()
+    >>> thread.join(30)
+    >>> thread.is_alive(), client._warm_cache_thread.is_alive()
+    (False, False)
+    """
+
+def client_cache_options():
+    """
+ClientStorage passes cache options to the cache:
+
+    >>> addr, _ = start_server()
+    >>> client = ClientStorage(addr, cache_background_scan=True)
+    >>> client._cache.background_scan
+    True
+    >>> client.close()
+
+    >>> client = ClientStorage(
+    ...     addr, cache_size=100000, cache_write_behind_size=1000,
+    ...     cache_memory_size=2000, cache_noncurrent_fraction=.2)
+    >>> cache = client._cache
+    >>> cache.write_behind_size, cache._memory.max_size
+    (1000, 2000)
+    >>> cache.noncurrent_fraction, cache._noncurrent_cache.maxsize
+    (0.2, 20000)
+    >>> client.close()
+    """
+
+def resize_client_cache():
+    """
+A client's cache can be resized while it's in use:
+
+    >>> addr, _ = start_server()
+    >>> client = ClientStorage(addr, cache_size=100000)
+    >>> client._cache.maxsize
+    100000
+    >>> client.resizeCache(200000)
+    >>> client._cache.maxsize
+    200000
+    >>> client.close()
+
+The cache of a closed storage can't be resized:
+
+    >>> client.resizeCache(100000)
+    Traceback (most recent call last):
+    ...
+    ClientStorageError: The storage is closed
+
+A shared cache can't be resized:
+
+    >>> import ZEO.sharedcache
+    >>> class SharedClientStorage(ClientStorage):
+    ...     ClientCacheClass = ZEO.sharedcache.SharedClientCache
+    >>> client = SharedClientStorage(addr, cache_size=100000)
+    >>> client.resizeCache(200000)
+    Traceback (most recent call last):
+    ...
+    Unsupported: A SharedClientCache can't be resized
+    >>> client._cache.maxsize
+    100000
+    >>> client.close()
+    """
+
+def concurrent_loads_share_server_requests():
+    """
+Cache misses for different objects are loaded from the server
+concurrently, and concurrent misses for the same object share a
+server request.
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> conn = db.open()
+    >>> for i in range(2):
+    ...     conn.root()[i] = MinPO(i)
+    >>> transaction.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(2)]
+    >>> db.close()
+
+We'll make server loads wait until we let them finish, and keep track
+of the threads waiting for another thread's load:
+
+    >>> import ZEO.ClientStorage
+    >>> Load_wait = ZEO.ClientStorage._Load.__dict__['wait']
+    >>> waits = []
+    >>> def wait(load):
+    ...     waits.append(load)
+    ...     return Load_wait(load)
+    >>> ZEO.ClientStorage._Load.wait = wait
+
+    >>> client = ClientStorage(addr)
+    >>> server_loadBefore = client._server.loadBefore
+    >>> requests = []
+    >>> finish = threading.Event()
+    >>> def loadBefore(oid, tid):
+    ...     requests.append(oid)
+    ...     finish.wait(30)
+    ...     return server_loadBefore(oid, tid)
+    >>> client._server.loadBefore = loadBefore
+
+    >>> results = []
+    >>> def load(oid):
+    ...     results.append(client.load(oid))
+    >>> threads = [threading.Thread(target=load, args=(oid,))
+    ...            for oid in oids + oids[:1]]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> wait_until("loads in progress",
+    ...            lambda: len(requests) == 2 and len(waits) == 1)
+    >>> sorted(requests) == oids
+    True
+
+    >>> finish.set()
+    >>> for thread in threads:
+    ...     thread.join(30)
+    >>> len(results), client._loads
+    (3, {})
+    >>> sorted(oid for (oid, tid) in client._cache.contents()) == oids
+    True
+
+Objects invalidated while they're being loaded aren't cached:
+
+    >>> client._cache.clear()
+    >>> del requests[:]
+    >>> finish.clear()
+    >>> thread = threading.Thread(target=load, args=(oids[0],))
+    >>> thread.start()
+    >>> wait_until("load in progress", lambda: requests)
+    >>> tid = p64(u64(client.lastTransaction()) + 1)
+    >>> client.invalidateTransaction(tid, oids[:1])
+    >>> finish.set()
+    >>> thread.join(30)
+    >>> list(client._cache.contents())
+    []
+
+If a load fails, each waiting thread raises its own copy of the error:
+
+    >>> del requests[:], waits[:]
+    >>> finish.clear()
+    >>> def loadBefore(oid, tid):
+    ...     requests.append(oid)
+    ...     finish.wait(30)
+    ...     raise ValueError("load failed")
+    >>> client._server.loadBefore = loadBefore
+    >>> errors = []
+    >>> def load(oid):
+    ...     try:
+    ...         client.load(oid)
+    ...     except ValueError:
+    ...         errors.append(sys.exc_info()[1])
+    >>> threads = [threading.Thread(target=load, args=(oids[0],))
+    ...            for i in range(3)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> wait_until("loads in progress",
+    ...            lambda: len(requests) == 1 and len(waits) == 2)
+    >>> finish.set()
+    >>> for thread in threads:
+    ...     thread.join(30)
+    >>> [str(error) for error in errors]
+    ['load failed', 'load failed', 'load failed']
+    >>> len(set(id(error) for error in errors))
+    3
+
+    >>> ZEO.ClientStorage._Load.wait = Load_wait
+    >>> client.close()
+    """
+
+def load_many_objects_in_one_request():
+    """
+loadBeforeMany loads many objects, returning what loadBefore would
+return, or the error it would raise, for each.  Data that aren't cached
+are loaded from the server in one request, and cached.
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = MinPO(i)
+    >>> transaction.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(3)]
+    >>> db.close()
+
+    >>> client = ClientStorage(addr)
+    >>> _ = client.load(oids[0])
+    >>> server_loadBeforeMany = client._server.loadBeforeMany
+    >>> def loadBeforeMany(oid_tids):
+    ...     print(len(oid_tids))
+    ...     return server_loadBeforeMany(oid_tids)
+    >>> client._server.loadBeforeMany = loadBeforeMany
+
+    >>> missing = p64(u64(max(oids)) + 1)
+    >>> results = client.loadBeforeMany(
+    ...     [(oid, ZEO.ClientStorage.m64) for oid in oids + [missing]])
+    3
+    >>> [result[1] == client.load(oid)[1]
+    ...  for oid, result in zip(oids, results)]
+    [True, True, True]
+    >>> results[-1] # doctest: +ELLIPSIS
+    POSKeyError(...)
+    >>> sorted(oid for (oid, tid) in client._cache.contents()) == oids
+    True
+    >>> client.close()
+
+Servers older than protocol Z401 don't have loadBeforeMany, so each
+object is loaded with loadBefore:
+
+    >>> current_protocol = ZEO.zrpc.connection.Connection.current_protocol
+    >>> ZEO.zrpc.connection.Connection.current_protocol = b'Z4'
+    >>> client = ClientStorage(addr)
+    >>> client._connection.peer_protocol_version
+    b'Z4'
+    >>> results = client.loadBeforeMany(
+    ...     [(oid, ZEO.ClientStorage.m64) for oid in oids + [missing]])
+    >>> [result[1] == client.load(oid)[1]
+    ...  for oid, result in zip(oids, results)]
+    [True, True, True]
+    >>> results[-1] # doctest: +ELLIPSIS
+    POSKeyError(...)
+    >>> client.close()
+    >>> ZEO.zrpc.connection.Connection.current_protocol = current_protocol
+    """
+
+def prefetch_objects_in_the_background():
+    """
+prefetch loads objects into the cache without waiting for them:
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = MinPO(i)
+    >>> transaction.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(3)]
+    >>> db.close()
+
+    >>> client = ClientStorage(addr)
+    >>> missing = p64(u64(max(oids)) + 1)
+    >>> client.prefetch(oids + [missing])
+    >>> for i in range(100):
+    ...     if client.getPrefetchStats()[0] == 3:
+    ...         break
+    ...     time.sleep(.01)
+    >>> sorted(oid for (oid, tid) in client._cache.contents()) == oids
+    True
+
+Loads of prefetched objects are counted as prefetch hits, once:
+
+    >>> _ = client.load(oids[0])
+    >>> _ = client.load(oids[0])
+    >>> _ = client.load(oids[1])
+    >>> client.getPrefetchStats()
+    (3, 2)
+
+Prefetched objects that are invalidated before they're loaded aren't
+prefetch hits:
+
+    >>> db = ZEO.DB(addr)
+    >>> conn = db.open()
+    >>> conn.root()[2].value = 42
+    >>> transaction.commit()
+    >>> tid = conn.root()[2]._p_serial
+    >>> db.close()
+    >>> for i in range(100):
+    ...     if client.lastTransaction() == tid:
+    ...         break
+    ...     time.sleep(.01)
+    >>> _ = client.load(oids[2])
+    >>> client.getPrefetchStats()
+    (3, 2)
+    >>> client.close()
+    """
+
 def invalidate_client_cache_entry_on_server_commit_error():
     """
 
@@ -1799,6 +2122,7 @@ def test_suite():
          'last-transaction'),
         (re.compile("ZODB.POSException.ConflictError"), "ConflictError"),
         (re.compile("ZODB.POSException.POSKeyError"), "POSKeyError"),
+        (re.compile("ZODB.POSException.Unsupported"), "Unsupported"),
         (re.compile("ZEO.Exceptions.ClientStorageError"), "ClientStorageError"),
         (re.compile(r"\[Errno \d+\]"), '[Errno N]'),
         (re.compile(r"loads=\d+\.\d+"), 'loads=42.42'),
@@ -1828,7 +2152,7 @@ def test_suite():
             'zeo-fan-out.test', 'zdoptions.test',
             'drop_cache_rather_than_verify.txt', 'client-config.test',
             'protocols.test', 'zeo_blob_cache.test', 'invalidation-age.txt',
-            'dynamic_server_ports.test', 'new_addr.test', '../nagios.rst',
+            'invalidation-log.txt', 'dynamic_server_ports.test', 'new_addr.test', '../nagios.rst',
             setUp=forker.setUp, tearDown=zope.testing.setupstack.tearDown,
             checker=renormalizing.RENormalizing(patterns),
             globs={'print_function': print_function},
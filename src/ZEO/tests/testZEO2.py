@@ -20,8 +20,10 @@ import re
 import sys
 import transaction
 import unittest
+import ZEO.ServerStub
 import ZEO.StorageServer
 import ZEO.tests.servertesting
+import ZEO.zrpc.marshal
 import ZODB.blob
 import ZODB.FileStorage
 import ZODB.tests.util
@@ -482,6 +484,144 @@ ZEOStorage as closed and see if trying to get a lock cleans it up:
     >>> logging.getLogger('ZEO').removeHandler(handler)
     """
 
+def verify_many_objects_in_one_call():
+    r"""
+verifyMany checks many cached objects against the server's storage in
+one call.  It's passed the packed oids and tids of the client's cached
+data, and returns the packed oids of those that aren't current:
+
+    >>> fs = ZODB.FileStorage.FileStorage('t.fs')
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> conn.root.x = conn.root().__class__()
+    >>> transaction.commit()
+    >>> root_tid = conn.root()._p_serial
+    >>> x_oid, x_tid = conn.root.x._p_oid, conn.root.x._p_serial
+    >>> conn.root.x['y'] = 1
+    >>> transaction.commit()
+
+    >>> server = ZEO.tests.servertesting.StorageServer('x', {'1': fs})
+    >>> zs = ZEO.tests.servertesting.client(server, 1)
+    >>> missing = ZODB.utils.p64(42)
+    >>> stale = zs.verifyMany(
+    ...     ZODB.utils.z64 + root_tid +
+    ...     x_oid + x_tid +
+    ...     missing + x_tid)
+    >>> stale == x_oid + missing
+    True
+    >>> zs.verifyMany(ZODB.utils.z64 + root_tid) == b''
+    True
+
+The client's stub decides how to verify from the protocol the server
+speaks, so a stub made before the handshake has finished still makes
+a single verifyMany call:
+
+    >>> class RPC:
+    ...     peer_protocol_version = None
+    ...     def call(self, name, *args):
+    ...         print(name)
+    ...         return b''
+    ...     def callAsync(self, name, *args):
+    ...         print(name)
+    >>> rpc = RPC()
+    >>> ZEO.ServerStub.StorageServer(rpc).verifyMany(
+    ...     missing + x_tid) == b''
+    verifyMany
+    True
+
+Servers older than protocol Z402 get a verify call per object instead:
+
+    >>> rpc.peer_protocol_version = b'Z401'
+    >>> ZEO.ServerStub.stub(None, rpc).verifyMany(
+    ...     ZODB.utils.z64 + root_tid + missing + x_tid) == b''
+    verify
+    verify
+    True
+
+    >>> db.close()
+    """
+
+def invalidation_queue():
+    r"""
+A storage server keeps the invalidations of the last transactions of
+each storage in an InvalidationQueue, which holds at most a given
+number of entries:
+
+    >>> from ZODB.utils import p64
+    >>> invq = ZEO.StorageServer.InvalidationQueue(
+    ...     3, [(p64(1), [p64(1)])])
+    >>> for tid in range(2, 6):
+    ...     invq.append(p64(tid), [p64(tid), p64(tid + 1)])
+    >>> [ZODB.utils.u64(tid) for tid, oids in invq]
+    [5, 4, 3]
+    >>> ZODB.utils.u64(invq.first_tid)
+    3
+
+since returns the last tid and the oids invalidated after a tid, if
+the queue has all of the invalidations after it:
+
+    >>> latest_tid, oids = invq.since(p64(3))
+    >>> ZODB.utils.u64(latest_tid), sorted(map(ZODB.utils.u64, oids))
+    (5, [4, 5, 6])
+    >>> latest_tid, oids = invq.since(p64(5))
+    >>> ZODB.utils.u64(latest_tid), oids
+    (5, set())
+    >>> invq.since(p64(2))
+
+A queue always keeps the last entry, even if its size is 0:
+
+    >>> invq = ZEO.StorageServer.InvalidationQueue(0)
+    >>> invq.append(p64(1), [p64(1)])
+    >>> invq.append(p64(2), [p64(2)])
+    >>> len(invq), ZODB.utils.u64(invq.first_tid)
+    (1, 2)
+    >>> latest_tid, oids = invq.since(p64(2))
+    >>> ZODB.utils.u64(latest_tid), oids
+    (2, set())
+    >>> invq.since(p64(1))
+    """
+
+def invalidations_are_encoded_once():
+    r"""
+When a transaction's invalidations are sent to many clients, the
+message is encoded once, and the same message is queued to each
+client's connection:
+
+    >>> from ZODB.utils import p64
+    >>> class Connection:
+    ...     encodes = 0
+    ...     def __init__(self):
+    ...         self.messages = []
+    ...     def encode(self, *args):
+    ...         Connection.encodes += 1
+    ...         return ZEO.zrpc.marshal.encode(*args)
+    ...     def callAsyncMessageNoSend(self, message):
+    ...         self.messages.append(message)
+
+    >>> stubs = [ZEO.StorageServer.ClientStub(Connection())
+    ...          for i in range(3)]
+    >>> oids = [p64(1), p64(2)]
+    >>> for stub in stubs:
+    ...     stub.invalidateTransaction(p64(42), oids)
+    >>> Connection.encodes
+    1
+    >>> message = stubs[0].rpc.messages[0]
+    >>> all(stub.rpc.messages == [message] for stub in stubs)
+    True
+    >>> ZEO.zrpc.marshal.decode(message) == (
+    ...     0, 1, 'invalidateTransaction', (p64(42), oids))
+    True
+
+Clients using older protocols get messages of their own:
+
+    >>> stub = ZEO.StorageServer.ClientStub308(Connection())
+    >>> stub.invalidateTransaction(p64(42), oids)
+    >>> Connection.encodes
+    2
+    >>> ZEO.zrpc.marshal.decode(stub.rpc.messages[0])[3] == (
+    ...     p64(42), [(p64(1), ''), (p64(2), '')])
+    True
+    """
 
 def test_suite():
     return unittest.TestSuite((
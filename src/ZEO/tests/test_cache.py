@@ -22,7 +22,9 @@ import string
 import struct
 import sys
 import tempfile
+import time
 import unittest
+import zlib
 import ZEO.cache
 import ZODB.tests.util
 import zope.testing.setupstack
@@ -353,6 +355,1179 @@ class CacheTests(ZODB.tests.util.TestCase):
         self.assertEqual(cache.loadBefore(oid, n2), (b'first', n1, n2))
         self.assertEqual(cache.loadBefore(oid, n3), (b'second', n2, None))
 
+    def test_index_file(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.store(n1, n2, None, b'current')
+        cache.store(n1, n1, n2, b'non-current')
+        cache.setLastTid(n2)
+        self.assertFalse(os.path.exists('cache.index'))
+        currentofs = cache.currentofs
+        cache.close()
+        self.assertTrue(os.path.exists('cache.index'))
+
+        # The index is used instead of scanning the cache file:
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.currentofs, currentofs)
+        self.assertEqual(cache.load(n1), (b'current', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'non-current', n1, n2))
+
+        # It's removed as soon as the cache file changes, so it can't
+        # be stale after a crash:
+        cache.store(n3, n2, None, b'more')
+        self.assertFalse(os.path.exists('cache.index'))
+
+        # It's also saved periodically:
+        cache.index_save_interval = 1
+        cache._index_saved_at = 0
+        cache.setLastTid(n3)
+        self.assertTrue(os.path.exists('cache.index'))
+        cache.close()
+
+    def test_stale_index_file_is_ignored(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.store(n1, n2, None, b'current')
+        cache.close()
+        with open('cache.index', 'rb') as f:
+            old_index = f.read()
+
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.setLastTid(n2)
+        cache.invalidate(n1, n3)
+        cache.store(n2, n2, None, b'new')
+        cache.close()
+
+        # Put back the old index, as if the cache file had been
+        # changed by a process that doesn't know about index files.
+        with open('cache.index', 'wb') as f:
+            f.write(old_index)
+
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertFalse(cache._index_saved)
+        self.assertFalse(os.path.exists('cache.index'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n3), (b'current', n2, n3))
+        self.assertEqual(cache.load(n2), (b'new', n2))
+        cache.close()
+
+        # Sizes must match too:
+        cache = ZEO.cache.ClientCache('cache', size=20000)
+        self.assertFalse(cache._index_saved)
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+    def test_store_many(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.store_many([
+            (n1, n1, None, b'one'),       # already current, ignored
+            (n2, n2, None, b'two'),
+            (n2, n2, None, b'two'),       # duplicate in batch, ignored
+            (n3, n1, n2, b'old three'),
+            (n3, n2, None, b'three'),
+            (n4, n1, None, os.urandom(1<<20)), # too big, ignored
+            ])
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.getStats()[:2],
+                         (4, 4 * ZEO.cache.allocated_record_overhead + 20))
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.load(n2), (b'two', n2))
+        self.assertEqual(cache.load(n3), (b'three', n2))
+        self.assertEqual(cache.loadBefore(n3, n2), (b'old three', n1, n2))
+        self.assertEqual(cache.load(n4), None)
+
+        self.assertRaises(ValueError, cache.store_many,
+                          [(n1, n2, None, b'new one')])
+        self.assertRaises(ValueError, cache.store_many,
+                          [(n4, n1, None, b'a'), (n4, n2, None, b'b')])
+
+
+    def test_store_many_wraps(self):
+        data = b'x' * 57  # 100-byte records
+        items = [(p64(i), n1, None, data) for i in range(25)]
+        cache = ZEO.cache.ClientCache(size=1000)
+        for item in items:
+            cache.store(*item)
+        expected = sorted(cache.contents()), cache.currentofs
+        cache.close()
+
+        # Storing the records at once leaves the same records in the
+        # same places:
+        cache = ZEO.cache.ClientCache('cache', size=1000)
+        cache.store_many(items)
+        self.assertEqual((sorted(cache.contents()), cache.currentofs),
+                         expected)
+        self.assertEqual(len(cache), 8)
+
+        # and they're found when the file is scanned:
+        cache.setLastTid(n1)
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', size=1000)
+        self.assertEqual((sorted(cache.contents()), cache.currentofs),
+                         expected)
+        for oid, tid in expected[0]:
+            self.assertEqual(cache.load(oid), (data, n1))
+        cache.close()
+
+    def test_invalidate_many(self):
+        cache = self.cache
+        cache.store_many([(n1, n1, None, b'one'), (n2, n1, None, b'two')])
+        cache.invalidate_many([n1, n2, n3], n2)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.load(n2), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        self.assertEqual(cache.loadBefore(n2, n2), (b'two', n1, n2))
+        cache.store(n1, n2, None, b'new one')
+        cache.invalidate_many([n1], None)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_resize(self):
+        data = b'x' * 57  # 100-byte records
+        cache = ZEO.cache.ClientCache('cache', size=2012)
+        for i in range(30):
+            cache.store(p64(i), n1, None, data)
+        cache.invalidate(p64(29), n2)
+        self.assertEqual(len(cache), 18)
+        self.assertEqual(cache.currentofs, 1112)
+
+        # Growing adds free space at the end of the file.  It's used
+        # once currentofs gets there, after evicting the records
+        # written longest ago:
+        cache.resize(4012)
+        self.assertEqual(os.path.getsize('cache'), 4012)
+        self.assertEqual(len(cache), 18)
+        for i in range(30, 50):
+            cache.store(p64(i), n1, None, data)
+        self.assertEqual(len(cache), 31)
+        self.assertEqual(cache.currentofs, 3112)
+        self.assertEqual(cache.load(p64(11)), None)
+        self.assertEqual(cache.load(p64(20)), (data, n1))
+        self.assertEqual(cache.loadBefore(p64(29), n2), (data, n1, n2))
+
+        # Shrinking keeps the most recently written records that fit,
+        # wherever they were:
+        cache.clearStats()
+        cache.resize(1512)
+        self.assertEqual(os.path.getsize('cache'), 1512)
+        self.assertEqual(len(cache), 14)
+        self.assertEqual(sorted(u64(oid) for oid, tid in cache.contents()),
+                         list(range(36, 50)))
+        self.assertEqual(cache.getStats()[2:4], (17, 1700))
+        self.assertEqual(cache.load(p64(49)), (data, n1))
+
+        # The file is consistent with the index:
+        expected = sorted(cache.contents()), cache.currentofs
+        cache.setLastTid(n2)
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', size=1512)
+        self.assertEqual((sorted(cache.contents()), cache.currentofs),
+                         expected)
+        cache.store(n1, n2, None, b'new')
+        self.assertEqual(cache.load(n1), (b'new', n2))
+        cache.close()
+
+    def test_background_scan(self):
+        import threading
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        cache.store(n3, n1, None, b'three')
+        cache.setLastTid(n1)
+        cache.close()
+        os.remove('cache.index')
+
+        started = threading.Event()
+        release = threading.Event()
+        class Cache(ZEO.cache.ClientCache):
+            def _scan(self, f, fsize, stop=None):
+                if stop is not None:
+                    started.set()
+                    release.wait()
+                return ZEO.cache.ClientCache._scan(self, f, fsize, stop)
+
+        cache = Cache('cache', size=10000, background_scan=True)
+        started.wait()
+
+        # While the file is being scanned, the cache isn't known to be
+        # empty, loads miss, and stores are ignored:
+        self.assertTrue(cache)
+        self.assertEqual(cache.getLastTid(), n1)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n3, n2), None)
+        cache.store(n4, n1, None, b'four')
+
+        # Invalidations are applied when the scan is done:
+        cache.invalidate(n1, n2)
+        cache.invalidate_many([n2], None)
+        cache.setLastTid(n2)
+        release.set()
+        self.assertEqual(sorted(cache.contents()), [(n3, n1)])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        self.assertEqual(cache.load(n2), None)
+        self.assertEqual(cache.load(n3), (b'three', n1))
+        self.assertEqual(cache.load(n4), None)
+        cache.close()
+
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(cache.getLastTid(), n2)
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+    def test_close_during_background_scan(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.store(n1, n1, None, b'one')
+        cache.setLastTid(n1)
+        cache.close()
+        os.remove('cache.index')
+
+        class Cache(ZEO.cache.ClientCache):
+            def _scan(self, f, fsize, stop=None):
+                if stop is not None:
+                    stop.wait()
+                return ZEO.cache.ClientCache._scan(self, f, fsize, stop)
+
+        cache = Cache('cache', size=10000, background_scan=True)
+        cache.close()
+        self.assertFalse(os.path.exists('cache.index'))
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        cache.close()
+
+    def test_preallocate(self):
+        for fallocate in True, False:
+            cache = ZEO.cache.ClientCache('cache', size=10000,
+                                          fallocate=fallocate)
+            self.assertEqual(os.path.getsize('cache'), 10000)
+            cache.resize(20000)
+            self.assertEqual(os.path.getsize('cache'), 20000)
+            cache.store(n1, n1, None, b'x' * 15000)
+            self.assertEqual(cache.load(n1), (b'x' * 15000, n1))
+            cache.close()
+            for suffix in '', '.index':
+                os.remove('cache' + suffix)
+
+    def test_resize_keeps_recent_records_past_the_end(self):
+        data = b'x' * 57  # 100-byte records
+        cache = ZEO.cache.ClientCache('cache', size=2012)
+        for i in range(15):
+            cache.store(p64(i), n1, None, data)
+        # The 5 most recent records are at the end of the file:
+        cache.resize(1012)
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(sorted(u64(oid) for oid, tid in cache.contents()),
+                         list(range(6, 15)))
+        cache.setLastTid(n1)
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', size=1012)
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(cache.load(p64(14)), (data, n1))
+        cache.close()
+
+class MMapCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, use_mmap=True)
+
+    def test_mmap_reads_see_writes(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000, use_mmap=True)
+        self.assertTrue(cache._map is not None)
+        cache.store(n1, n2, None, b'current')
+        self.assertEqual(cache.load(n1), (b'current', n2))
+        cache.invalidate(n1, n3)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n3), (b'current', n2, n3))
+        cache.clear()
+        self.assertTrue(cache._map is not None)
+        self.assertEqual(cache.loadBefore(n1, n3), None)
+        cache.store(n1, n3, None, b'new')
+        self.assertEqual(cache.load(n1), (b'new', n3))
+        cache.close()
+        self.assertTrue(cache._map is None)
+
+        cache = ZEO.cache.ClientCache('cache', size=10000, use_mmap=True)
+        self.assertEqual(cache.load(n1), (b'new', n3))
+        cache.close()
+
+class ConcurrentReadCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, concurrent_reads=True)
+
+    def test_hits_dont_take_lock(self):
+        import threading
+        cache = self.cache
+        cache.store(n1, n2, None, b'current')
+        cache.store(n1, n1, n2, b'non-current')
+        locked = threading.Event()
+        done = threading.Event()
+        timed_out = []
+        def hold_lock():
+            with cache._lock:
+                locked.set()
+                if not done.wait(10):
+                    timed_out.append(True)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait(10)
+        try:
+            self.assertEqual(cache.load(n1), (b'current', n2))
+            self.assertEqual(cache.loadBefore(n1, n2),
+                             (b'non-current', n1, n2))
+            self.assertEqual(cache.loadBefore(n1, n3),
+                             (b'current', n2, None))
+        finally:
+            done.set()
+            thread.join()
+        self.assertFalse(timed_out)
+
+class CompactIndexCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, compact_index=True)
+
+class CompressedCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, compress=True)
+
+    def test_compressed_records(self):
+        data = b'compress me ' * 100
+        cache = ZEO.cache.ClientCache('cache', size=10000, compress=True)
+        cache.store(n1, n2, None, data)
+        cache.store(n1, n1, n2, data[:-1])
+        cache.store(n2, n2, None, b'short')
+        self.assertEqual(cache.load(n1), (data, n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (data[:-1], n1, n2))
+        self.assertEqual(cache.load(n2), (b'short', n2))
+
+        # Records, and the space they take, are compressed if they're
+        # big enough:
+        compressed = zlib.compress(data, 1)
+        ofs = cache.current[n1]
+        cache.f.seek(ofs)
+        self.assertEqual(
+            struct.unpack(ZEO.cache.allocated_header_format,
+                          cache.f.read(ZEO.cache.allocated_header_size)),
+            (b'a', ZEO.cache.allocated_record_overhead + len(compressed),
+             n1, n2, z64, ZEO.cache.record_compressed, len(compressed)))
+        ofs = cache.current[n2]
+        cache.f.seek(ofs)
+        self.assertEqual(
+            struct.unpack(ZEO.cache.allocated_header_format,
+                          cache.f.read(ZEO.cache.allocated_header_size))[5:],
+            (0, 5))
+        self.assertEqual(cache.getStats()[1],
+                         3 * ZEO.cache.allocated_record_overhead +
+                         len(compressed) + len(zlib.compress(data[:-1], 1)) +
+                         5)
+
+        # They can be read without compress set:
+        cache.setLastTid(n2)
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertEqual(cache.load(n1), (data, n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (data[:-1], n1, n2))
+        cache.close()
+
+    def test_admission_is_decided_before_compression(self):
+        import ZEO.cacheadmission
+        data = b'compress me ' * 100
+        cache = ZEO.cache.ClientCache(
+            size=10000, compress=True,
+            admission=ZEO.cacheadmission.SizeAdmission(len(data) - 1))
+        compress = zlib.compress
+        compressed = []
+        def record_compress(*args):
+            compressed.append(args[0])
+            return compress(*args)
+        zlib.compress = record_compress
+        try:
+            cache.store(n1, n1, None, data)
+            cache.store(n2, n1, None, data[:-1])
+        finally:
+            zlib.compress = compress
+        self.assertEqual(compressed, [data[:-1]])
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.load(n2), (data[:-1], n1))
+        self.assertEqual(cache.getStats()[5:7],
+                         (1, ZEO.cache.allocated_record_overhead + len(data)))
+        cache.close()
+
+    def test_files_are_upgraded_when_compressed_records_are_written(self):
+        def file_magic():
+            with open('cache', 'rb') as f:
+                return f.read(4)
+
+        # Files without compressed records keep the old magic number,
+        # so older versions of ZEO can still read them:
+        cache = ZEO.cache.ClientCache('cache', size=10000, compress=True)
+        cache.store(n1, n2, None, b'data')
+        cache.setLastTid(n2)
+        cache.close()
+        self.assertEqual(file_magic(), b'ZEC3')
+        cache = ZEO.cache.ClientCache('cache', size=10000, compress=True)
+        self.assertEqual(cache.load(n1), (b'data', n2))
+        cache.close()
+        self.assertEqual(file_magic(), b'ZEC3')
+
+        # The magic number changes when a compressed record is written:
+        data = b'compress me ' * 100
+        cache = ZEO.cache.ClientCache('cache', size=10000, compress=True)
+        cache.store(n2, n2, None, data)
+        self.assertEqual(file_magic(), b'ZEC4')
+        cache.close()
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        self.assertEqual(cache.load(n1), (b'data', n2))
+        self.assertEqual(cache.load(n2), (data, n2))
+        cache.close()
+        self.assertEqual(file_magic(), b'ZEC4')
+
+class MemoryCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2, memory_size=1000)
+
+    def test_memory(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        self.assertEqual(len(cache._memory), 0)
+
+        # Objects read from the file are kept in memory:
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.loadBefore(n2, n2), (b'two', n1, None))
+        self.assertEqual(len(cache._memory), 2)
+        self.assertEqual(cache.getStats()[4:], (2, 0, 0, 0, 2))
+
+        # and then loaded from memory:
+        cache.f.seek(cache.current[n1] + ZEO.cache.allocated_header_size)
+        cache.f.write(b'ONE')
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, None))
+        self.assertEqual(cache.loadBefore(n1, n1), None)
+        self.assertEqual(cache.getStats()[4:], (4, 0, 0, 2, 3))
+
+        # Invalidations remove them:
+        cache.invalidate(n1, n2)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'ONE', n1, n2))
+        cache.invalidate(n2, None)
+        self.assertEqual(cache.load(n2), None)
+        self.assertEqual(len(cache._memory), 0)
+
+        # So do evictions from the file:
+        cache.store(n3, n1, None, b'three')
+        self.assertEqual(cache.load(n3), (b'three', n1))
+        self.assertEqual(len(cache._memory), 1)
+        for i in range(20):
+            cache.store(p64(100 + i), n1, None, b'x' * 100000)
+        self.assertEqual(cache.current.get(n3), None)
+        self.assertEqual(len(cache._memory), 0)
+        self.assertEqual(cache.load(n3), None)
+
+        cache.store(n3, n2, None, b'three')
+        cache.load(n3)
+        cache.clear()
+        self.assertEqual(len(cache._memory), 0)
+
+    def test_memory_lru(self):
+        import ZEO.cachememory
+        memory = ZEO.cachememory.MemoryCache(10)
+        memory.put(n1, b'1234', n1)
+        memory.put(n2, b'1234', n1)
+        self.assertEqual(memory.get(n1), (b'1234', n1))
+        memory.put(n3, b'1234', n1)
+        self.assertEqual(memory.size, 8)
+        self.assertEqual(memory.get(n2), None)
+        self.assertEqual(memory.get(n1), (b'1234', n1))
+        self.assertEqual(memory.get(n1, n1), None)
+        memory.put(n4, b'12345678901', n1)
+        self.assertEqual(memory.get(n4), None)
+        memory.put(n1, b'12', n2)
+        self.assertEqual(memory.size, 6)
+        memory.discard(n1)
+        self.assertEqual((len(memory), memory.size, memory.hits,
+                          memory.misses), (1, 4, 2, 3))
+
+class WriteBehindTests(ZODB.tests.util.TestCase):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache('cache', size=1024**2,
+                                           write_behind_size=1000)
+        # Hold the cache lock, so the writer can't write the queue
+        # until we let it.
+        self.cache._lock.acquire()
+
+    def tearDown(self):
+        self.cache._lock.release()
+        self.cache.close()
+        ZODB.tests.util.TestCase.tearDown(self)
+
+    def write(self):
+        cache = self.cache
+        cache._lock.release()
+        try:
+            for i in range(1000):
+                if not cache._queued:
+                    break
+                time.sleep(.01)
+        finally:
+            cache._lock.acquire()
+        self.assertEqual(cache._queued, {})
+
+    def test_queued_stores(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, n2, b'old two')
+        cache.store(n2, n2, None, b'two')
+        cache.store(n2, n2, None, b'two')
+        self.assertRaises(ValueError, cache.store, n2, n3, None, b'three')
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache._len, 0)
+        self.assertEqual(cache.current.get(n1), None)
+
+        # Queued records can be loaded:
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.load(n2, n2), None)
+        self.assertEqual(cache.loadBefore(n2, n2), (b'old two', n1, n2))
+        self.assertEqual(cache.loadBefore(n2, n3), (b'two', n2, None))
+
+        # The writer writes them in a batch:
+        self.write()
+        self.assertEqual(cache._len, 3)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.load(n1), (b'one', n1))
+        self.assertEqual(cache.loadBefore(n2, n2), (b'old two', n1, n2))
+        self.assertEqual(cache.loadBefore(n2, n3), (b'two', n2, None))
+
+        # Other current data for an object written to the file is
+        # rejected too:
+        self.assertRaises(ValueError, cache.store, n1, n2, None, b'one')
+        cache.store(n1, n1, None, b'one')
+        self.assertEqual(cache._queued, {})
+        self.assertEqual(cache.load(n1), (b'one', n1))
+
+    def test_invalidations_update_queued_records(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        cache.store(n3, n1, None, b'three')
+        cache.invalidate(n1, n2)
+        cache.invalidate_many([n2, n4], n1)
+        cache.invalidate(n3, None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        self.assertEqual(cache.load(n2), (b'two', n1))
+        self.assertEqual(cache.load(n3), None)
+
+        self.write()
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        self.assertEqual(cache.load(n2), (b'two', n1))
+        self.assertEqual(cache.load(n3), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_full_queue_is_written_by_store(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'x' * 600)
+        cache.store(n2, n1, None, b'x' * 300)
+        self.assertEqual(cache._len, 0)
+        cache.store(n3, n1, None, b'x' * 200)
+        self.assertEqual(cache._queued, {})
+        self.assertEqual(cache._len, 3)
+        self.assertEqual(cache.load(n3), (b'x' * 200, n1))
+
+    def test_contents_and_close_write_the_queue(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        self.assertEqual(list(cache.contents()), [(n1, n1)])
+        cache.store(n2, n1, None, b'two')
+        cache._lock.release()
+        cache.close()
+        cache._lock.acquire()
+        self.cache = ZEO.cache.ClientCache('cache', size=1024**2)
+        self.cache._lock.acquire()
+        self.assertEqual(self.cache.load(n2), (b'two', n1))
+
+    def test_clear_drops_the_queue(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'one')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.load(n1), None)
+
+class NoncurrentCacheTests(CacheTests):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        self.cache = ZEO.cache.ClientCache(size=1024**2,
+                                           noncurrent_fraction=.25)
+
+    def testSerialization(self):
+        # Non-current records are in the non-current cache's file, so
+        # both files are copied.
+        self.cache.store(n1, n2, None, b"data for n1")
+        self.cache.store(n3, n3, n4, b"non-current data for n3")
+        self.cache.store(n3, n4, n5, b"more non-current data for n3")
+
+        path = tempfile.mktemp()
+        for src, dst_path in ((self.cache, path),
+                              (self.cache._noncurrent_cache,
+                               path + '.noncurrent')):
+            with open(dst_path, "wb+") as dst:
+                src.f.seek(0)
+                dst.write(src.f.read(src.maxsize))
+        copy = ZEO.cache.ClientCache(path, size=1024**2,
+                                     noncurrent_fraction=.25)
+
+        eq = self.assertEqual
+        eq(copy.getLastTid(), self.cache.getLastTid())
+        eq(len(copy), len(self.cache))
+        eq(dict(copy.current), dict(self.cache.current))
+        eq(len(self.cache.noncurrent), 0)
+        eq(len(copy.noncurrent), 0)
+        noncurrent = self.cache._noncurrent_cache.noncurrent
+        eq(len(noncurrent), 1)
+        eq(dict([(k, dict(v))
+                 for (k, v) in copy._noncurrent_cache.noncurrent.items()]),
+           dict([(k, dict(v)) for (k, v) in noncurrent.items()]),
+           )
+        copy.close()
+
+    def test_noncurrent_cache(self):
+        cache = self.cache
+        noncurrent = cache._noncurrent_cache
+        self.assertEqual(cache.maxsize, 3 * 1024**2 // 4)
+        self.assertEqual(noncurrent.maxsize, 1024**2 // 4)
+
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, n2, b'old two')
+        self.assertEqual((len(cache), cache._len, len(noncurrent)), (2, 1, 1))
+        self.assertEqual(cache.loadBefore(n2, n2), (b'old two', n1, n2))
+
+        # Invalidated records are moved to the non-current cache:
+        cache.invalidate(n1, n2)
+        self.assertEqual((len(cache), cache._len, len(noncurrent)), (2, 0, 2))
+        self.assertEqual(cache.load(n1), None)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        cache.store(n1, n2, None, b'new one')
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        self.assertEqual(cache.loadBefore(n1, n3), (b'new one', n2, None))
+
+        # Non-current records evict each other, but not current ones:
+        for i in range(100):
+            cache.store(p64(100 + i), n1, n2, b'x' * 10000)
+        self.assertEqual(cache.load(n1), (b'new one', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), None)
+        self.assertEqual(cache.getStats()[2], noncurrent.getStats()[2])
+
+        cache.resize(1024**2 * 2)
+        self.assertEqual(cache.maxsize, 3 * 1024**2 // 2)
+        self.assertEqual(noncurrent.maxsize, 1024**2 // 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_persistent_noncurrent_cache(self):
+        cache = ZEO.cache.ClientCache('cache', size=1024**2,
+                                      noncurrent_fraction=.25)
+        cache.store(n1, n1, None, b'one')
+        cache.invalidate(n1, n2)
+        cache.close()
+        self.assertTrue(os.path.exists('cache.noncurrent'))
+        cache = ZEO.cache.ClientCache('cache', size=1024**2,
+                                      noncurrent_fraction=.25)
+        self.assertEqual(cache.loadBefore(n1, n2), (b'one', n1, n2))
+        cache.close()
+
+    def test_no_noncurrent_data(self):
+        cache = ZEO.cache.ClientCache(size=1024**2, noncurrent_fraction=0)
+        self.assertEqual(cache.maxsize, 1024**2)
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, n2, b'old two')
+        cache.store_many([(n3, n1, n2, b'old three')])
+        cache.invalidate(n1, n2)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.loadBefore(n1, n2), None)
+        self.assertEqual(cache.loadBefore(n2, n2), None)
+        cache.close()
+
+class ArrayIndexTests(unittest.TestCase):
+
+    def test_compare_with_dict(self):
+        import random2 as random
+        import ZEO.cacheindex
+        index = ZEO.cacheindex.ArrayIndex()
+        index.merge_min = 10
+        expected = {}
+        rand = random.Random(0)
+        for i in range(5000):
+            oid = p64(rand.randint(0, 500))
+            if oid in expected and rand.random() < .4:
+                del index[oid]
+                del expected[oid]
+            else:
+                index[oid] = expected[oid] = i
+            if i % 100 == 0:
+                self.assertEqual(len(index), len(expected))
+                self.assertEqual(list(index.items()),
+                                 sorted(expected.items()))
+        for i in range(501):
+            oid = p64(i)
+            self.assertEqual(index.get(oid), expected.get(oid))
+            self.assertEqual(oid in index, oid in expected)
+        self.assertTrue(len(index._oids) > 0)
+        self.assertEqual(dict(index), expected)
+
+    def test_missing_keys(self):
+        import ZEO.cacheindex
+        index = ZEO.cacheindex.ArrayIndex()
+        self.assertEqual(index.get(n1), None)
+        self.assertEqual(index.get(n1, 42), 42)
+        self.assertRaises(KeyError, index.__getitem__, n1)
+        self.assertRaises(KeyError, index.__delitem__, n1)
+        index[n1] = 12
+        index._merge()
+        del index[n1]
+        self.assertRaises(KeyError, index.__delitem__, n1)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(list(index.items()), [])
+
+    def test_changes_in_place(self):
+        import ZEO.cacheindex
+        index = ZEO.cacheindex.ArrayIndex(1<<20)
+        for oid in n1, n3, n4:
+            index[oid] = u64(oid) + 12
+        index[n2] = 14
+        self.assertEqual(list(index._oids), [1, 3, 4])
+        self.assertEqual(list(index._delta_oids), [2])
+
+        # Offsets of entries in the arrays are changed, and entries
+        # deleted and added back, in place:
+        index[n3] = 42
+        del index[n4]
+        index[n4] = 43
+        del index[n1]
+        self.assertEqual(list(index._oids), [1, 3, 4])
+        self.assertEqual(list(index._delta_oids), [2])
+        self.assertEqual(list(index.items()), [(n2, 14), (n3, 42), (n4, 43)])
+
+        # Merging drops deleted entries:
+        index._merge()
+        self.assertEqual(list(index._oids), [2, 3, 4])
+        self.assertEqual(list(index._offsets), [14, 42, 43])
+        self.assertEqual(list(index._delta_oids), [])
+        self.assertEqual(len(index), 3)
+
+class AdmissionTests(unittest.TestCase):
+
+    def test_size(self):
+        import ZEO.cacheadmission
+        admission = ZEO.cacheadmission.SizeAdmission(100)
+        admission.record(n1)
+        self.assertTrue(admission.admit(n1, 100))
+        self.assertFalse(admission.admit(n1, 101))
+
+    def test_tinylfu(self):
+        import ZEO.cacheadmission
+        admission = ZEO.cacheadmission.TinyLFUAdmission(
+            min_frequency=3, small_size=10, max_size=1000,
+            width=1<<8, sample_size=100)
+        self.assertTrue(admission.admit(n1, 10))
+        self.assertFalse(admission.admit(n1, 11))
+        for i in range(3):
+            admission.record(n1)
+        self.assertEqual(admission.frequency(n1), 3)
+        self.assertTrue(admission.admit(n1, 1000))
+        self.assertFalse(admission.admit(n1, 1001))
+        self.assertFalse(admission.admit(n2, 11))
+
+        # Counts are halved after sample_size loads, so old loads count
+        # for less:
+        for i in range(97):
+            admission.record(p64(i + 10))
+        self.assertEqual(admission.frequency(n1), 1)
+        self.assertFalse(admission.admit(n1, 1000))
+
+class JournalTests(ZODB.tests.util.TestCase):
+
+    def crash(self, cache):
+        # Copy the cache's files, as a crash would leave them, to the
+        # "crashed" directory.
+        cache.f.flush()
+        os.mkdir('crashed')
+        for name in 'cache', 'cache.index', 'cache.journal':
+            with open(name, 'rb') as f:
+                data = f.read()
+            with open(os.path.join('crashed', name), 'wb') as f:
+                f.write(data)
+        cache.close()
+        return os.path.join('crashed', 'cache')
+
+    def test_recovery(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000, journal=True)
+        # An index file is written right away, so there's one to recover:
+        self.assertTrue(os.path.exists('cache.index'))
+        cache.setLastTid(n2)
+        for i in range(100):
+            cache.store(p64(100 + i), n2, None, b'x' * 100)
+        cache.store(n1, n2, None, b'current')
+        cache.store(n2, n1, None, b'two')
+        cache.store(n3, n1, None, b'three')
+        cache.store(n1, n1, n2, b'non-current')
+        cache.setLastTid(n3)
+        cache.invalidate(n2, n3)
+        cache.invalidate(n3, None)
+        self.assertTrue(os.path.exists('cache.index'))
+        contents = sorted(cache.contents())
+        currentofs = cache.currentofs
+        length = len(cache)
+        path = self.crash(cache)
+
+        cache = ZEO.cache.ClientCache(path, size=10000, journal=True)
+        self.assertEqual(sorted(cache.contents()), contents)
+        self.assertEqual(cache.currentofs, currentofs)
+        self.assertEqual(len(cache), length)
+        self.assertEqual(cache.loadBefore(n2, n3), (b'two', n1, n3))
+        self.assertEqual(cache.load(n3), None)
+        self.assertEqual(cache.getLastTid(), n3)
+
+        # The index was saved and the journal started over:
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(os.path.getsize(path + '.journal'),
+                         4 + ZEO.cache.index_header_size)
+        cache.close()
+
+    def test_incomplete_write(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000, journal=True)
+        cache.store(n1, n1, None, b'one')
+        ofs = cache.currentofs
+        cache.store(n2, n1, None, b'two')
+        cache.store(n3, n1, None, b'three')
+        path = self.crash(cache)
+
+        # Damage the record of n2, as if it was being written when we
+        # crashed.  It, and the records written after it, are freed.
+        with open(path, 'rb+') as f:
+            f.seek(ofs + ZEO.cache.allocated_header_size + 3)
+            f.write(b'xxxx')
+        cache = ZEO.cache.ClientCache(path, size=10000, journal=True)
+        self.assertEqual(sorted(cache.contents()), [(n1, n1)])
+        self.assertEqual(cache.currentofs, ofs)
+        cache.store(n2, n1, None, b'two')
+        self.assertEqual(cache.load(n2), (b'two', n1))
+        cache.close()
+
+    def test_journal_is_dropped_by_resize_and_clear(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000, journal=True)
+        cache.store(n1, n1, None, b'one')
+        cache.resize(20000)
+        cache.store(n2, n1, None, b'two')
+        path = self.crash(cache)
+        cache = ZEO.cache.ClientCache(path, size=20000, journal=True)
+        self.assertEqual(sorted(cache.contents()), [(n1, n1), (n2, n1)])
+        cache.clear()
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_index_is_saved_after_background_scan(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000)
+        cache.store(n1, n1, None, b'one')
+        cache.close()
+        os.remove('cache.index')
+        cache = ZEO.cache.ClientCache('cache', size=10000, journal=True,
+                                      background_scan=True)
+        cache._wait_for_scan()
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(os.path.getsize('cache.journal'),
+                         4 + ZEO.cache.index_header_size)
+        cache.store(n2, n1, None, b'two')
+        path = self.crash(cache)
+        cache = ZEO.cache.ClientCache(path, size=10000, journal=True)
+        self.assertTrue(cache._index_saved)
+        self.assertEqual(sorted(cache.contents()), [(n1, n1), (n2, n1)])
+        cache.close()
+
+    def test_index_with_journal_isnt_used_without_journaling(self):
+        cache = ZEO.cache.ClientCache('cache', size=10000, journal=True)
+        cache.store(n1, n1, None, b'one')
+        path = self.crash(cache)
+        cache = ZEO.cache.ClientCache(path, size=10000)
+        self.assertFalse(cache._index_saved)
+        self.assertEqual(sorted(cache.contents()), [(n1, n1)])
+        cache.close()
+
+class ProfileTests(ZODB.tests.util.TestCase):
+
+    def test_access_counter(self):
+        from ZEO.cacheprofile import AccessCounter
+        counter = AccessCounter(2, sample_size=10)
+        for oid in n1, n2, n2, n3, n3, n3, n3:
+            counter.record(oid)
+        self.assertEqual(counter.hottest(), [n3, n2])
+        self.assertEqual(counter.hottest(3), [n3, n2, n1])
+
+        # Counts are halved after sample_size loads, and oids with a
+        # count of 0 are dropped:
+        for i in range(3):
+            counter.record(n4)
+        self.assertEqual(len(counter), 3)
+        self.assertEqual(counter.hottest(1), [n3])
+        self.assertEqual(sorted(counter.hottest(3)), [n2, n3, n4])
+
+    def test_profile(self):
+        cache = ZEO.cache.ClientCache('cache', 10000, profile_size=2)
+        self.assertEqual(cache.profile, [])
+        cache.setLastTid(n1)
+        for oid in n1, n2, n3:
+            cache.store(oid, n1, None, b'data')
+        for oid in n1, n2, n2, n3, n3, n3, n4:
+            cache.load(oid)
+        cache.close()
+
+        cache = ZEO.cache.ClientCache('cache', 10000, profile_size=2)
+        self.assertEqual(cache.profile, [n3, n2])
+        cache.invalidate(n2, n2)
+        self.assertEqual(cache.warm(cache.profile), [n2])
+        cache.close()
+
+        # The profile is kept, even if nothing is loaded:
+        cache = ZEO.cache.ClientCache('cache', 10000, profile_size=2)
+        self.assertEqual(sorted(cache.profile), [n2, n3])
+        cache.close()
+
+        # It's ignored if it's damaged:
+        with open('cache.profile', 'ab') as f:
+            f.write(b'x')
+        cache = ZEO.cache.ClientCache('cache', 10000, profile_size=2)
+        self.assertEqual(cache.profile, [])
+        cache.close()
+
+    def test_segmented_profile(self):
+        from ZEO.segmentedcache import SegmentedClientCache
+        cache = SegmentedClientCache('cache', size=40000, segments=2,
+                                     profile_size=2)
+        cache.setLastTid(n1)
+        for oid in n1, n2, n3:
+            cache.store(oid, n1, None, b'data')
+        for oid in n1, n1, n2, n3, n3, n3, n4, n4:
+            cache.load(oid)
+        cache.close()
+
+        cache = SegmentedClientCache('cache', size=40000, segments=2,
+                                     profile_size=2)
+        self.assertEqual(cache.profile, [n4, n3, n2, n1])
+        self.assertEqual(cache.warm(cache.profile), [n4])
+        cache.close()
+
+    def test_profile_from_trace(self):
+        from ZEO.cacheprofile import read_profile
+        from ZEO.scripts import cache_stats
+        os.environ["ZEO_CACHE_TRACE"] = 'yes'
+        try:
+            cache = ZEO.cache.ClientCache('cache', 10000)
+            for oid in n1, n2, n2:
+                cache.load(oid)
+            cache.close()
+        finally:
+            del os.environ["ZEO_CACHE_TRACE"]
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            cache_stats.main(['-q', '-S', '--profile', 'cache.profile',
+                              '--profile-size', '1', 'cache.trace'])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        self.assertEqual(read_profile('cache.profile'), [n2])
+
+class SharedCacheTests(ZODB.tests.util.TestCase):
+
+    def setUp(self):
+        ZODB.tests.util.TestCase.setUp(self)
+        from ZEO.sharedcache import SharedClientCache
+        # Two caches sharing a file behave like two processes sharing it,
+        # as their flocks are of different open files.
+        self.a = SharedClientCache('cache', size=100000)
+        self.b = SharedClientCache('cache', size=100000)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        ZODB.tests.util.TestCase.tearDown(self)
+
+    def test_shared(self):
+        a, b = self.a, self.b
+        a.setLastTid(n2)
+        b.setLastTid(n2)
+        a.store(n1, n1, None, b'one')
+        a.store(n2, n1, n2, b'old two')
+        b.store_many([(n2, n2, None, b'two')])
+        self.assertEqual((len(a), len(b)), (2, 2))
+        self.assertEqual(b.load(n1), (b'one', n1))
+        self.assertEqual(b.loadBefore(n1, n2), (b'one', n1, None))
+        self.assertEqual(a.load(n2), (b'two', n2))
+        self.assertEqual(a.load(n2, n2), None)
+        self.assertEqual(sorted(b.contents()), [(n1, n1), (n2, n2)])
+
+        # Invalidations applied by one process apply to all:
+        b.invalidate(n1, n3)
+        self.assertEqual(a.load(n1), None)
+
+        # a hasn't seen n3, so it may not know about invalidations
+        # in it, and its stores are ignored:
+        a.store(n1, n1, None, b'one')
+        self.assertEqual(len(a), 1)
+        self.assertEqual(a.getStats()[5], 1)
+
+        # Records from transactions a hasn't seen aren't loaded by it:
+        b.setLastTid(n3)
+        b.store(n1, n3, None, b'new one')
+        self.assertEqual(a.load(n1), None)
+        a.setLastTid(n3)
+        self.assertEqual(a.load(n1), (b'new one', n3))
+
+        # and late invalidations don't remove them:
+        a.invalidate(n1, n3)
+        self.assertEqual(b.load(n1), (b'new one', n3))
+
+        a.clear()
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.getLastTid(), n3)
+
+    def test_eviction(self):
+        a, b = self.a, self.b
+        a.setLastTid(n1)
+        b.setLastTid(n1)
+        for i in range(1000):
+            (a, b)[i % 2].store(p64(i), n1, None, b'x' * 1000)
+        self.assertTrue(0 < len(a) < 100)
+        self.assertEqual(sorted(a.contents()), sorted(b.contents()))
+        for oid, tid in b.contents():
+            self.assertEqual(a.load(oid), (b'x' * 1000, n1))
+        self.assertEqual(a.load(p64(999)), (b'x' * 1000, n1))
+        self.assertEqual(a.load(p64(0)), None)
+
+    def test_reopen_and_recovery(self):
+        from ZEO.sharedcache import SharedClientCache
+        import ZEO.sharedcache
+        self.a.setLastTid(n2)
+        self.a.store(n1, n2, None, b'one')
+        self.a.close()
+        self.a = SharedClientCache('cache', size=200000)
+        self.assertEqual(self.a.maxsize, 100000)
+        self.assertEqual(self.a.getLastTid(), n2)
+        self.assertEqual(self.a.load(n1), (b'one', n2))
+
+        # If a process dies while changing the cache, it's cleared:
+        self.a._begin()
+        self.assertEqual(self.b.load(n1), None)
+        self.assertEqual(len(self.b), 0)
+        self.b.store(n1, n2, None, b'one')
+        self.assertEqual(self.a.load(n1), (b'one', n2))
+
+    def test_processes(self):
+        self.a.setLastTid(n2)
+        self.a.store(n1, n2, None, b'one')
+        import subprocess
+        script = (
+            "import ZEO.sharedcache\n"
+            "from ZODB.utils import p64\n"
+            "cache = ZEO.sharedcache.SharedClientCache('cache')\n"
+            "assert cache.load(p64(1)) == (b'one', p64(2))\n"
+            "cache.invalidate(p64(1), p64(3))\n"
+            "cache.setLastTid(p64(3))\n"
+            "cache.store(p64(2), p64(3), None, b'two')\n"
+            "cache.close()\n")
+        subprocess.check_call([sys.executable, '-c', script])
+        self.assertEqual(self.a.load(n1), None)
+        self.assertEqual(self.a.load(n2), None)
+        self.a.setLastTid(n3)
+        self.assertEqual(self.a.load(n2), (b'two', n3))
+
+class SegmentedCacheTests(ZODB.tests.util.TestCase):
+
+    def test_segments(self):
+        from ZEO.segmentedcache import SegmentedClientCache
+        cache = SegmentedClientCache('cache', size=40000, segments=4)
+        self.assertEqual(cache.maxsize, 40000)
+        self.assertEqual(sorted(f for f in os.listdir('.')
+                                if not f.endswith('.lock')),
+                         ['cache.0-of-4', 'cache.1-of-4',
+                          'cache.2-of-4', 'cache.3-of-4'])
+        cache.setLastTid(n2)
+        cache.store(n1, n2, None, b'one')
+        cache.store(n1, n1, n2, b'old one')
+        cache.store_many([(n2, n2, None, b'two'), (n3, n1, None, b'three'),
+                          (n4, n1, None, b'four')])
+        self.assertEqual(len(cache), 5)
+        self.assertEqual([len(segment) for segment in cache._segments],
+                         [1, 2, 1, 1])
+        self.assertEqual(cache.getStats()[:2],
+                         (5, 5 * ZEO.cache.allocated_record_overhead + 22))
+        cache.invalidate_many([n2, n3], n3)
+        cache.setLastTid(n3)
+        self.assertEqual(cache.load(n1), (b'one', n2))
+        self.assertEqual(cache.loadBefore(n1, n2), (b'old one', n1, n2))
+        self.assertEqual(cache.load(n2), None)
+        self.assertEqual(cache.loadBefore(n3, n3), (b'three', n1, n3))
+        self.assertEqual(sorted(cache.contents()), [(n1, n2), (n4, n1)])
+        self.assertRaises(ValueError, cache.setLastTid, n2)
+        cache.resize(80000)
+        self.assertEqual(cache.maxsize, 80000)
+        self.assertEqual(os.path.getsize('cache.0-of-4'), 20000)
+        cache.resize(40000)
+        cache.close()
+
+        cache = SegmentedClientCache('cache', size=40000, segments=4)
+        self.assertEqual(cache.getLastTid(), n3)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.load(n4), (b'four', n1))
+        cache.close()
+
+        # A different number of segments uses different files:
+        cache = SegmentedClientCache('cache', size=40000, segments=2)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.getLastTid(), z64)
+        cache.close()
+
+    def test_segments_behind_after_crash(self):
+        # If segments have different last tids, because we crashed
+        # while setting them, the cache is as old as the oldest:
+        from ZEO.segmentedcache import SegmentedClientCache
+        cache = SegmentedClientCache('cache', size=40000, segments=2)
+        cache.store(n1, n1, None, b'one')
+        cache.store(n2, n1, None, b'two')
+        cache.setLastTid(n2)
+        cache._segments[0].setLastTid(n3)
+        cache.close()
+
+        cache = SegmentedClientCache('cache', size=40000, segments=2)
+        self.assertEqual(cache.getLastTid(), n2)
+        cache.setLastTid(n3)
+        cache.setLastTid(n4)
+        self.assertEqual([segment.getLastTid() for segment in cache._segments],
+                         [n4, n4])
+        cache.close()
+
 def kill_does_not_cause_cache_corruption():
     r"""
 
@@ -481,6 +1656,69 @@ def thread_safe():
 
 """
 
+def concurrent_reads_are_consistent():
+    r"""
+With concurrent_reads, cache hits don't take the cache lock, but readers
+never see data from a record that's being changed.  The cache is small,
+so records get evicted and overwritten while they're read.
+
+>>> import ZEO.cache, ZODB.utils
+>>> cache = ZEO.cache.ClientCache('cache', 20000, concurrent_reads=True)
+>>> p64, u64 = ZODB.utils.p64, ZODB.utils.u64
+
+>>> for i in range(100):
+...     cache.store(p64(i), p64(1), None, b'1' * 50)
+
+>>> import random2 as random, sys, threading
+>>> stop = False
+>>> read_failures = []
+
+>>> def read_thread(seed):
+...     random_oid = random.Random(seed).randint
+...     try:
+...         while not stop:
+...             oid = p64(random_oid(0, 99))
+...             result = cache.load(oid)
+...             if result is not None:
+...                 data, tid = result
+...                 assert data == str(u64(tid)).encode() * 50, result
+...             result = cache.loadBefore(oid, p64(5))
+...             if result is not None:
+...                 data, tid, end_tid = result
+...                 assert data == str(u64(tid)).encode() * 50, result
+...                 assert tid < p64(5) and (
+...                     end_tid is None or end_tid >= p64(5)), result
+...     except:
+...         read_failures.append(sys.exc_info())
+
+>>> threads = [threading.Thread(target=read_thread, args=(i,))
+...            for i in range(4)]
+>>> for thread in threads:
+...     thread.start()
+
+>>> for tid in range(2,10):
+...     for oid in range(100):
+...         oid = p64(oid)
+...         cache.invalidate(oid, p64(tid))
+...         cache.store(oid, p64(tid), None, str(tid).encode() * 50)
+
+>>> stop = True
+>>> for thread in threads:
+...     thread.join()
+>>> for read_failure in read_failures:
+...    print('Read failure:')
+...    import traceback
+...    traceback.print_exception(*read_failure)
+
+>>> expected = b'9' * 50, p64(9)
+>>> for oid in range(100):
+...     loaded = cache.load(p64(oid))
+...     if loaded not in (None, expected):
+...         print(oid, loaded)
+
+>>> cache.close()
+"""
+
 def broken_non_current():
     r"""
 
@@ -1080,6 +2318,152 @@ Now try to do simulation:
 
     """
 
+def cache_trace_version_2():
+    r"""
+If ZEO_CACHE_TRACE is "2", the trace has version 2 records, with
+nanosecond timestamps, thread ids and the latency of each operation.
+Here we append them to a trace with version 1 records:
+
+    >>> os.environ["ZEO_CACHE_TRACE"] = 'yes'
+    >>> cache = ZEO.cache.ClientCache('cache', 1<<20)
+    >>> cache.store(p64(1), p64(1), None, b'x')
+    >>> cache.close()
+
+    >>> os.environ["ZEO_CACHE_TRACE"] = '2'
+    >>> cache = ZEO.cache.ClientCache('cache', 1<<20)
+    >>> cache.load(p64(1))
+    ('x', '\x00\x00\x00\x00\x00\x00\x00\x01')
+    >>> cache.load(p64(2))
+    >>> cache.close()
+
+The trace can be read with ZEO.cachetrace.read_trace:
+
+    >>> import time, ZEO.cachetrace, six
+    >>> with open('cache.trace', 'rb') as f:
+    ...     records = list(ZEO.cachetrace.read_trace(f))
+    >>> for ts, code, oid, start_tid, end_tid, clen, thread, latency in records:
+    ...     print("%02x %s %s %s" % (
+    ...         code & 0x7e, u64(oid or z64), thread == six.moves._thread.get_ident(),
+    ...         latency is not None and latency < 10**9))
+    00 0 False False
+    52 1 False False
+    00 0 True True
+    22 1 True True
+    20 2 True True
+    >>> abs(records[-1][0] - time.time()) < 60
+    True
+
+Both versions are analyzed by the scripts:
+
+    >>> import ZEO.scripts.cache_stats
+    >>> ZEO.scripts.cache_stats.main('-v cache.trace'.split())
+    ... # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+                       loads    hits  inv(h)  writes hitrate
+    ... 00 '' 0000000000000000 0000000000000000 -
+    ...
+    ... 52 1 0000000000000001 0000000000000000 - 1
+    ...
+    ... 22 1 0000000000000001 0000000000000000 - 1 thread ... ...us
+    ... 20 2 0000000000000000 0000000000000000 - thread ... ...us
+    ...
+    Read 5 trace records (... bytes) in ... seconds
+    ...
+            Count Code Mean latency
+                1  00  ...us
+                1  20  ...us
+                1  22  ...us
+
+    >>> import ZEO.scripts.cache_simul
+    >>> ZEO.scripts.cache_simul.main('-s 1 cache.trace'.split())
+    ... # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+    CircularCacheSimulation, cache size 1,048,576 bytes
+      START TIME   DUR.   LOADS    HITS INVALS WRITES HITRATE  EVICTS   INUSE
+    ...      2       1      0      0   50.0%       0     0.0
+    --------------------------------------------------------------------------
+    ...      2       1      0      0   50.0%       0     0.0
+
+The latency is measured until the operation returns, including work
+done after its record is made:
+
+    >>> cache = ZEO.cache.ClientCache('cache', 1<<20, memory_size=1000)
+    >>> def slow_put(*args):
+    ...     time.sleep(.1)
+    >>> cache._memory.put = slow_put
+    >>> cache.load(p64(1)) == (b'x', p64(1))
+    True
+    >>> cache.close()
+    >>> with open('cache.trace', 'rb') as f:
+    ...     records = list(ZEO.cachetrace.read_trace(f))
+    >>> ts, code, oid, start_tid, end_tid, clen, thread, latency = records[-1]
+    >>> hex(code & 0x7e), latency >= 10**8
+    ('0x22', True)
+
+    >>> del os.environ["ZEO_CACHE_TRACE"]
+    """
+
+def admission_policy():
+    r"""
+A cache can be given an admission policy, which decides whether objects
+passed to store() are worth writing to the cache.
+
+    >>> import ZEO.cacheadmission
+    >>> os.environ["ZEO_CACHE_TRACE"] = 'yes'
+    >>> admission = ZEO.cacheadmission.TinyLFUAdmission(small_size=100)
+    >>> cache = ZEO.cache.ClientCache('cache', 1<<20, admission=admission)
+
+Small objects are always admitted:
+
+    >>> cache.store(p64(1), p64(1), None, b'x')
+    >>> cache.load(p64(1)) == (b'x', p64(1))
+    True
+
+Larger ones are admitted once they've been loaded twice:
+
+    >>> cache.load(p64(2))
+    >>> cache.store(p64(2), p64(1), None, b'y'*1000)
+    >>> cache.load(p64(2))
+    >>> cache.store(p64(2), p64(1), None, b'y'*1000)
+    >>> cache.load(p64(2)) == (b'y'*1000, p64(1))
+    True
+
+Rejections are counted in the sixth and seventh statistics, the number
+of stores rejected and their record sizes:
+
+    >>> cache.getStats()
+    (2, 1087, 0, 0, 2, 1, 1043, 0, 0)
+    >>> cache.close()
+
+and they're traced:
+
+    >>> import ZEO.scripts.cache_stats, ZEO.scripts.cache_simul
+    >>> ZEO.scripts.cache_stats.main(['-q', 'cache.trace'])
+    ... # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+                      loads    hits  inv(h)  writes hitrate
+    ...
+    Hit rate:   50.0% (load hits / loads)
+    <BLANKLINE>
+            Count Code Function (action)
+                1  00  _setup_trace (initialization)
+                2  20  load (miss)
+                2  22  load (hit)
+                2  52  store (current, non-version)
+                1  56  store (rejected by admission policy)
+
+cache_simul can simulate admission policies, showing the number of
+stores rejected:
+
+    >>> ZEO.scripts.cache_simul.main(
+    ...     '-s 1 -a tinylfu --small-object-size 100 cache.trace'.split())
+    ... # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+    CircularCacheSimulation, cache size 1,048,576 bytes
+      START TIME   DUR.   LOADS    HITS INVALS WRITES HITRATE  EVICTS   INUSE REJECTS
+          ...                4       2      0      2   50.0%       0     0.1       1
+    --------------------------------------------------------------------------
+          ...                4       2      0      2   50.0%       0     0.1       1
+
+    >>> del os.environ["ZEO_CACHE_TRACE"]
+    """
+
 def invalidations_with_current_tid_dont_wreck_cache():
     """
     >>> cache = ZEO.cache.ClientCache('cache', 1000)
@@ -1150,6 +2534,20 @@ An attempt to open a bad cache file will cause it to be dropped and recreated.
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(CacheTests))
+    suite.addTest(unittest.makeSuite(MMapCacheTests))
+    suite.addTest(unittest.makeSuite(ConcurrentReadCacheTests))
+    suite.addTest(unittest.makeSuite(CompactIndexCacheTests))
+    suite.addTest(unittest.makeSuite(CompressedCacheTests))
+    suite.addTest(unittest.makeSuite(MemoryCacheTests))
+    suite.addTest(unittest.makeSuite(WriteBehindTests))
+    suite.addTest(unittest.makeSuite(NoncurrentCacheTests))
+    suite.addTest(unittest.makeSuite(ArrayIndexTests))
+    suite.addTest(unittest.makeSuite(AdmissionTests))
+    suite.addTest(unittest.makeSuite(SegmentedCacheTests))
+    suite.addTest(unittest.makeSuite(JournalTests))
+    suite.addTest(unittest.makeSuite(ProfileTests))
+    if sys.platform != 'win32':
+        suite.addTest(unittest.makeSuite(SharedCacheTests))
     suite.addTest(
         doctest.DocTestSuite(
             setUp=zope.testing.setupstack.setUpDirectory,
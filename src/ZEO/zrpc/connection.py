@@ -244,21 +244,27 @@ class Connection(smac.SizedMessageAsyncConnection, object):
     #
     # Z4 -- checkCurrentSerialInTransaction
     #       No-longer call load.
+    #
+    # Z401 -- New server methods:
+    #             loadBeforeMany
+    #
+    # Z402 -- New server methods:
+    #             verifyMany
 
     # Protocol variables:
     # Our preferred protocol.
-    current_protocol = b"Z4"
+    current_protocol = b"Z402"
 
     # If we're a client, an exhaustive list of the server protocols we
     # can accept.
-    servers_we_can_talk_to = [b"Z308", b"Z309", b"Z310", b"Z3101",
-                              current_protocol]
+    servers_we_can_talk_to = [b"Z308", b"Z309", b"Z310", b"Z3101", b"Z4",
+                              b"Z401", current_protocol]
 
     # If we're a server, an exhaustive list of the client protocols we
     # can accept.
     clients_we_can_talk_to = [
         b"Z200", b"Z201", b"Z303", b"Z308", b"Z309", b"Z310", b"Z3101",
-        current_protocol]
+        b"Z4", b"Z401", current_protocol]
 
     # This is pretty excruciating.  Details:
     #
@@ -580,6 +586,17 @@ class Connection(smac.SizedMessageAsyncConnection, object):
         self.send_call(method, args, 1)
         self.call_from_thread()
 
+    def callAsyncMessageNoSend(self, message):
+        # Like callAsyncNoSend, but for a message already encoded with
+        # encode(0, 1, method, args).  This exists so that a message
+        # sent to many connections, like an invalidation, can be
+        # encoded once.  Each connection still frames the message, and
+        # computes its MAC, when it's written.
+        if self.closed:
+            raise DisconnectedError()
+        self.message_output(message)
+        self.call_from_thread()
+
     def callAsyncIterator(self, iterator):
         """Queue a sequence of calls using an iterator
 